@@ -0,0 +1,89 @@
+"""
+Throughput benchmark for `tee_spawn`.
+
+Spawns a process that writes `--size` bytes split between stdout and stderr,
+tees the streams into byte-counting sinks (and optionally real files),
+and reports throughput and the number of bytes lost on the way.
+
+    python benchmarks/bench_tee.py --size 1G
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from valohai_local_run.tee import tee_spawn
+from valohai_local_run.utils import format_size, parse_size
+
+WRITER = '''
+import os, sys
+size, chunk_size, stderr_every = int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3])
+chunk = (b"x" * (chunk_size - 1)) + b"\\n"
+written = 0
+n = 0
+while written < size:
+    data = chunk[:size - written]
+    os.write(2 if (stderr_every and n % stderr_every == 0) else 1, data)
+    written += len(data)
+    n += 1
+'''
+
+
+class CountingSink:
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return len(data)
+
+
+def run(size, chunk_size, stderr_every, to_files):
+    stdout_sink, stderr_sink = CountingSink(), CountingSink()
+    stdout_files, stderr_files = [stdout_sink], [stderr_sink]
+    temp_dir = None
+    if to_files:
+        temp_dir = tempfile.TemporaryDirectory(prefix='valohai-bench-tee-')
+        stdout_files.append(open(os.path.join(temp_dir.name, 'stdout'), 'wb'))
+        stderr_files.append(open(os.path.join(temp_dir.name, 'stderr'), 'wb'))
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    proc = tee_spawn(
+        [sys.executable, '-c', WRITER, str(size), str(chunk_size), str(stderr_every)],
+        stdout_files=stdout_files,
+        stderr_files=stderr_files,
+    )
+    duration = time.perf_counter() - start
+    cpu_time = time.process_time() - cpu_start
+    for file in stdout_files[1:] + stderr_files[1:]:
+        file.close()
+    if temp_dir:
+        temp_dir.cleanup()
+    received = stdout_sink.count + stderr_sink.count
+    return {
+        'size': size,
+        'duration': duration,
+        'tee_cpu_time': cpu_time,
+        'throughput_mb_s': size / duration / 1048576,
+        'lost_bytes': size - received,
+        'returncode': proc.returncode,
+        'errors': len(proc.tee_errors),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('--size', type=parse_size, default=parse_size('1G'), help='Total output size (default 1G)')
+    ap.add_argument('--chunk-size', type=parse_size, default=parse_size('4K'), help='Size of each write')
+    ap.add_argument('--stderr-every', type=int, default=10, help='Write every Nth chunk to stderr (0: never)')
+    ap.add_argument('--to-files', action='store_true', help='Also tee into files on disk')
+    args = ap.parse_args()
+    result = run(args.size, args.chunk_size, args.stderr_every, args.to_files)
+    print('Teed {size} in {duration:.2f} s: {throughput_mb_s:.1f} MB/s, {tee_cpu_time:.2f} s CPU in tee, '
+          '{lost_bytes} bytes lost'.format(**dict(result, size=format_size(result['size']))))
+    return (1 if result['lost_bytes'] or result['returncode'] else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
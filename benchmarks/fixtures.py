@@ -0,0 +1,119 @@
+"""
+Local stand-ins for the benchmarks: an HTTP file server, synthetic Git repositories and a fake `docker` command.
+"""
+import hashlib
+import os
+import re
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+FAKE_DOCKER = '''#!{python}
+# Pretends every image is available, and has `run` write {output_size} bytes of output in {chunk_size} byte lines.
+import os, sys
+if sys.argv[1:2] == ['run']:
+    line = b'x' * ({chunk_size} - 1) + b'\\n'
+    remaining = {output_size}
+    while remaining > 0:
+        remaining -= os.write(1, line[:remaining])
+'''
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves files from memory, with ETags, conditional requests and range requests, like a typical web server.
+
+    Use as a context manager to run it in a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, files=None):
+        super().__init__(('127.0.0.1', 0), FileRequestHandler)
+        self.files = dict(files or {})
+        self.n_requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.n_requests += 1
+        data = self.server.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if range_match and self.headers.get('If-Range', etag) == etag:
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2) or len(data) - 1), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_git_repo(path, n_files, file_size, n_commits=1):
+    """
+    Create a Git repository of `n_files` random files (in directories of at most 100 files),
+    with the files rewritten in each of `n_commits` commits.
+
+    :return: SHA of the last commit
+    """
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME='Benchmark',
+        GIT_AUTHOR_EMAIL='benchmark@example.com',
+        GIT_COMMITTER_NAME='Benchmark',
+        GIT_COMMITTER_EMAIL='benchmark@example.com',
+    )
+    subprocess.check_call(['git', 'init', '--quiet', path], env=env)
+    for commit in range(n_commits):
+        for n in range(n_files):
+            file_path = os.path.join(path, 'dir%03d' % (n // 100), 'file%05d.txt' % n)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as outf:
+                outf.write(os.urandom(file_size))
+        subprocess.check_call(['git', 'add', '--all'], cwd=path, env=env)
+        subprocess.check_call(['git', 'commit', '--quiet', '-m', 'Commit %d' % commit], cwd=path, env=env)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path).decode().strip()
+
+
+def make_fake_docker(path, output_size, chunk_size=4096):
+    """
+    Write a fake `docker` command whose `run` writes `output_size` bytes to stdout, and does nothing else.
+    """
+    with open(path, 'w') as outf:
+        outf.write(FAKE_DOCKER.format(python=sys.executable, output_size=output_size, chunk_size=chunk_size))
+    os.chmod(path, 0o755)
+    return path
@@ -0,0 +1,296 @@
+"""
+Benchmarks of the stages of a local run, with regression tracking.
+
+Each benchmark is run `--repeat` times, each time in a fresh temporary directory (so the caches start
+out cold), and the median of every timing is reported.  Only local stand-ins are used: an HTTP server
+on localhost, synthetic Git repositories and a fake `docker` command (see `fixtures.py`).
+
+Save the results as JSON, and later compare against them to flag regressions:
+
+    python benchmarks/run_benchmarks.py --output baseline.json
+    python benchmarks/run_benchmarks.py --baseline baseline.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_tee
+from fixtures import FileServer, make_fake_docker, make_git_repo
+
+from valohai_local_run.checkout import CheckoutCache
+from valohai_local_run.download import download_urls
+from valohai_local_run.inputs import prepare_inputs
+from valohai_local_run.utils import parse_size
+
+BENCHMARKS = {}  # Name -> function taking the work directory and the options, and returning a dict of timings
+
+# Environment variables pointing caches elsewhere than the temporary directory
+CACHE_ENV_VARS = (
+    'VALOHAI_LOCAL_RUN_CACHE_DIR',
+    'VALOHAI_LOCAL_RUN_CHECKOUT_DIR',
+    'VALOHAI_LOCAL_RUN_CONFIG_CACHE_DIR',
+    'VALOHAI_LOCAL_RUN_INPUT_STORE_DIR',
+    'VALOHAI_LOCAL_RUN_POOL_DIR',
+)
+
+CONFIG = '''
+- step:
+    name: bench
+    image: busybox
+    command: cat $VH_INPUTS_DIR/data/*
+    inputs:
+      - name: data
+'''
+
+QUICK_OPTIONS = dict(
+    output_size=parse_size('16M'),
+    inputs=4,
+    input_size=parse_size('1M'),
+    small_files=50,
+    repo_files=200,
+    repo_file_size=parse_size('1K'),
+    repeat=1,
+)
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__[len('benchmark_'):]] = function
+    return function
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+@benchmark
+def benchmark_tee(workdir, options):
+    result = bench_tee.run(options.output_size, chunk_size=4096, stderr_every=10, to_files=True)
+    if result['lost_bytes'] or result['returncode']:
+        raise RuntimeError('tee_spawn lost {} bytes'.format(result['lost_bytes']))
+    return {'tee': result['duration']}
+
+
+@benchmark
+def benchmark_prepare_inputs(workdir, options):
+    files = {'/input%d.bin' % n: os.urandom(options.input_size) for n in range(options.inputs)}
+    local_paths = []
+    for n in range(options.inputs):
+        local_paths.append(os.path.join(workdir, 'local%d.bin' % n))
+        with open(local_paths[-1], 'wb') as outf:
+            outf.write(os.urandom(options.input_size))
+    with FileServer(files) as server:
+        inputs = {'remote': [server.url + path for path in sorted(files)], 'local': local_paths}
+
+        def prepare(**kwargs):
+            list(prepare_inputs(inputs, download_concurrency=4, **kwargs))
+
+        return {
+            'cold': timed(prepare),
+            'warm': timed(prepare),
+            'revalidate': timed(lambda: prepare(revalidate=True)),
+        }
+
+
+@benchmark
+def benchmark_download_cache(workdir, options):
+    # Lots of small files, so the bookkeeping of the cache dominates
+    files = {'/small%d.txt' % n: os.urandom(1024) for n in range(options.small_files)}
+    with FileServer(files) as server:
+        urls = [server.url + path for path in sorted(files)]
+        return {
+            'miss': timed(lambda: download_urls(urls, with_progress=False)),
+            'hit': timed(lambda: download_urls(urls, with_progress=False)),
+            'revalidate': timed(lambda: download_urls(urls, with_progress=False, revalidate=True)),
+        }
+
+
+@benchmark
+def benchmark_checkout(workdir, options):
+    repo_path = os.path.join(workdir, 'repo')
+    commit = make_git_repo(repo_path, options.repo_files, options.repo_file_size)
+    cache = CheckoutCache(root=os.path.join(workdir, 'checkouts'))
+    timings = {'cold': timed(lambda: cache.acquire(repo_path, commit, lease_id='cold'))}
+    timings['warm'] = timed(lambda: cache.acquire(repo_path, commit, lease_id='warm'))
+    for lease_id in ('cold', 'warm'):
+        cache.release(commit, lease_id=lease_id)
+    return timings
+
+
+@benchmark
+def benchmark_cli(workdir, options):
+    project = os.path.join(workdir, 'project')
+    os.makedirs(project)
+    with open(os.path.join(project, 'valohai.yaml'), 'w') as outf:
+        outf.write(CONFIG)
+    data_path = os.path.join(workdir, 'data.txt')
+    with open(data_path, 'w') as outf:
+        outf.write('data\n')
+    docker = make_fake_docker(os.path.join(workdir, 'docker'), options.output_size)
+    run_argv = [
+        '--directory', project,
+        '--no-git',
+        '--output-root', os.path.join(workdir, 'outputs'),
+        '--docker-command', docker,
+        'bench',
+        '--data', data_path,
+    ]
+
+    def run_python(code, *argv):
+        subprocess.check_call([sys.executable, '-c', code] + list(argv), stdout=subprocess.DEVNULL)
+
+    return {
+        'python': timed(lambda: run_python('pass')),
+        'import': timed(lambda: run_python('import valohai_local_run.cli')),
+        'run': timed(lambda: run_python('from valohai_local_run.cli import cli; cli()', *run_argv)),
+    }
+
+
+@contextlib.contextmanager
+def isolated_temp_dir():
+    """
+    Point the temporary directory (and thus all the caches) at a new directory, here and in subprocesses.
+    """
+    saved_env = {name: os.environ.get(name) for name in CACHE_ENV_VARS + ('TMPDIR',)}
+    saved_tempdir = tempfile.tempdir
+    with tempfile.TemporaryDirectory(prefix='valohai-bench-') as path:
+        for name in CACHE_ENV_VARS:
+            os.environ.pop(name, None)
+        os.environ['TMPDIR'] = tempfile.tempdir = path
+        try:
+            yield path
+        finally:
+            tempfile.tempdir = saved_tempdir
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def run_benchmarks(names, options, log=None):
+    """
+    :return: Dict of "benchmark.timing" -> dict of the median, the minimum and all the runs, in seconds
+    """
+    results = {}
+    for name in names:
+        runs = []
+        for n in range(options.repeat):
+            with isolated_temp_dir() as workdir:
+                runs.append(BENCHMARKS[name](workdir, options))
+        for timing in runs[0]:
+            values = [run[timing] for run in runs]
+            key = '{}.{}'.format(name, timing)
+            results[key] = {'median': statistics.median(values), 'min': min(values), 'runs': values}
+            if log:
+                log('{:<32} {:>10.4f} s'.format(key, results[key]['median']))
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2, min_delta=0.01):
+    """
+    Compare the median timings of two runs.
+
+    A timing regresses when it's more than `tolerance` (a fraction) and `min_delta` seconds slower than
+    in the baseline; the absolute threshold keeps noise in very quick timings from being flagged.
+
+    :return: List of (key, baseline median, median, status) tuples; status is `regression`, `improvement`,
+             `ok`, `new` (not in the baseline) or `missing` (only in the baseline)
+    """
+    rows = []
+    for key in sorted(set(results) | set(baseline)):
+        if key not in baseline or key not in results:
+            rows.append((
+                key,
+                baseline.get(key, {}).get('median'),
+                results.get(key, {}).get('median'),
+                ('new' if key not in baseline else 'missing'),
+            ))
+            continue
+        old, new = baseline[key]['median'], results[key]['median']
+        status = 'ok'
+        if new > old * (1 + tolerance) and new - old > min_delta:
+            status = 'regression'
+        elif new < old / (1 + tolerance) and old - new > min_delta:
+            status = 'improvement'
+        rows.append((key, old, new, status))
+    return rows
+
+
+def format_comparison(rows):
+    lines = []
+    for key, old, new, status in rows:
+        change = ('{:+.1f}%'.format(100.0 * (new - old) / old) if old and new is not None else '')
+        lines.append('{key:<32} {old:>10} {new:>10} {change:>8}  {status}'.format(
+            key=key,
+            old=('{:.4f}'.format(old) if old is not None else '-'),
+            new=('{:.4f}'.format(new) if new is not None else '-'),
+            change=change,
+            status=status,
+        ))
+    return lines
+
+
+def get_argument_parser():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument('benchmarks', nargs='*', choices=([[]] + sorted(BENCHMARKS)), metavar='benchmark',
+        help='Benchmarks to run (default: all of them; one of {})'.format(', '.join(sorted(BENCHMARKS))))
+    ap.add_argument('--repeat', '-n', type=int, default=3, help='Number of times to run each benchmark')
+    ap.add_argument('--output', '-o', default=None, metavar='FILE', help='Write the results into a JSON file')
+    ap.add_argument('--baseline', '-b', default=None, metavar='FILE',
+        help='Compare against earlier results, exiting with 1 if any timing regresses')
+    ap.add_argument('--tolerance', type=float, default=0.2,
+        help='Fraction a timing may slow down by before it counts as a regression (default 0.2)')
+    ap.add_argument('--min-delta', type=float, default=0.01,
+        help='Seconds a timing must slow down by to count as a regression (default 0.01)')
+    ap.add_argument('--output-size', type=parse_size, default=parse_size('256M'),
+        help='Output written by the (fake) container, and teed (default 256M)')
+    ap.add_argument('--inputs', type=int, default=8, help='Number of remote and local inputs (default 8)')
+    ap.add_argument('--input-size', type=parse_size, default=parse_size('16M'), help='Size of each input')
+    ap.add_argument('--small-files', type=int, default=500, help='Number of files in the download cache benchmark')
+    ap.add_argument('--repo-files', type=int, default=2000, help='Number of files in the Git repository')
+    ap.add_argument('--repo-file-size', type=parse_size, default=parse_size('4K'), help='Size of each file')
+    ap.add_argument('--quick', action='store_true', default=False,
+        help='Use small sizes and a single run, e.g. to check the benchmarks work')
+    return ap
+
+
+def main(argv=None):
+    ap = get_argument_parser()
+    args = ap.parse_args(argv)
+    if args.quick:
+        for name, value in QUICK_OPTIONS.items():
+            setattr(args, name, value)
+    names = (args.benchmarks or sorted(BENCHMARKS))
+    results = run_benchmarks(names, args, log=(lambda line: print(line, file=sys.stderr)))
+    if args.output:
+        with open(args.output, 'w') as outf:
+            json.dump({
+                'time': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': {name: getattr(args, name) for name in sorted(QUICK_OPTIONS)},
+                'results': results,
+            }, outf, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as infp:
+        baseline = json.load(infp)['results']
+    # Only compare the benchmarks that were run
+    baseline = {key: value for (key, value) in baseline.items() if key.split('.')[0] in names}
+    rows = compare_results(results, baseline, tolerance=args.tolerance, min_delta=args.min_delta)
+    print('\n'.join(format_comparison(rows)))
+    return (1 if any(status == 'regression' for (key, old, new, status) in rows) else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,14 +13,22 @@ setup(
     author='Valohai',
     author_email='hait@valohai.com',
     license='MIT',
+    python_requires='>=3.9',  # As required by valohai-yaml 0.50.0
     install_requires=[
-        'valohai-yaml>=0.5',
+        'valohai-yaml>=0.50.0',  # Pipelines with node overrides, edge merge modes and on-error, and node commits
         'click>=6.7',
     ],
     extras_require={
         'online': [
             'requests>=2.0.0',
         ],
+        'zstd': [
+            'zstandard>=0.11',
+        ],
+        'lazy': [
+            'fusepy>=3.0',
+            'requests>=2.0.0',
+        ],
     },
     packages=find_packages(include=('valohai_local_run*',)),
 )
@@ -0,0 +1,74 @@
+import hashlib
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileRequestHandler)
+        self.files = {}
+        self.requests = []
+        self.ranges = True  # Whether to support range requests
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        data = self.server.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if range_match and (self.headers.get('If-Range', etag) != etag or not self.server.ranges):
+            range_match = None
+        if range_match:
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def temp_root(tmpdir, monkeypatch):
+    """Point `tempfile.gettempdir()` (and thus the download cache) at a per-test directory."""
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    return tempfile.tempdir
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import stat
+
+import pytest
+
+from valohai_local_run.api import run_execution
+from valohai_local_run.cli import run_cli
+from valohai_local_run.excs import BadUsage
+from valohai_local_run.executor import LocalExecutor
+from valohai_local_run.utils import ensure_makedirs
+
+CONFIG = '''
+- step:
+    name: greet
+    image: busybox
+    command:
+      - echo hello {parameters}
+      - echo oops >&2
+      - echo bye {parameters}
+      - exit 3
+    parameters:
+      - name: name
+        type: string
+'''
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_run_executions(tmpdir):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    outputs_dir = tmpdir.join('outputs')
+    original_umask = os.umask(0o022)
+
+    async def run_one(name):
+        execution = await run_execution(
+            'greet',
+            directory=str(tmpdir),
+            parameters={'name': name},
+            output_root=str(outputs_dir),
+        )
+        stdout, stderr = await asyncio.gather(execution.stdout.read(), execution.stderr.read())
+        return (execution, await execution, stdout, stderr)
+
+    async def run_all():
+        return await asyncio.gather(*[run_one('n%d' % index) for index in range(8)])
+
+    try:
+        results = run(run_all())
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(original_umask)
+    for index, (execution, exit_code, stdout, stderr) in enumerate(results):
+        assert exit_code == 3
+        assert stdout == 'hello --name=n{0}\nbye --name=n{0}\n'.format(index).encode()
+        assert stderr == b'oops\n'
+        assert os.path.isdir(execution.output_dir)
+    assert len({execution.output_dir for (execution, exit_code, stdout, stderr) in results}) == 8
+
+
+def test_run_execution_errors(tmpdir):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    with pytest.raises(BadUsage):  # Missing a required parameter
+        run(run_execution('greet', directory=str(tmpdir)))
+    with pytest.raises(BadUsage):
+        run(run_execution('greet', directory=str(tmpdir), parameters={'name': 'x', 'nope': 1}))
+
+
+def test_executor_init_has_no_side_effects(tmpdir):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    from valohai_local_run.cli import get_step_table
+    step = get_step_table(str(tmpdir), False, None).get_step('greet')
+    executor = LocalExecutor(
+        project_id=None,
+        directory=str(tmpdir),
+        commit=None,
+        step=step,
+        inputs={},
+        parameters={'name': 'x'},
+        output_root=str(tmpdir.join('outputs')),
+        gitless=True,
+    )
+    assert not os.path.exists(executor.output_dir)
+
+
+def test_ensure_makedirs(tmpdir):
+    original_umask = os.umask(0o077)
+    try:
+        path = tmpdir.join('a', 'b')
+        ensure_makedirs(str(path), 0o750)
+        assert os.umask(0o077) == 0o077
+    finally:
+        os.umask(original_umask)
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o750
+    assert stat.S_IMODE(os.stat(str(tmpdir.join('a'))).st_mode) == 0o750
+
+
+def test_run_cli_returns(tmpdir):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    argv = ['--directory', str(tmpdir), '--output-root', str(tmpdir.join('outputs')), 'greet', '--name=x']
+    assert run_cli(argv) == 3
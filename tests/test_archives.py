@@ -0,0 +1,116 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from valohai_local_run.archives import ExtractionCache, extract_tar, get_archive_type
+from valohai_local_run.inputs import prepare_inputs
+
+
+def make_tar(files, mode='w:gz', links=()):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+def read_tree(path):
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            with open(os.path.join(dirpath, filename), 'rb') as infp:
+                contents[os.path.relpath(os.path.join(dirpath, filename), path)] = infp.read()
+    return contents
+
+
+def test_get_archive_type():
+    assert get_archive_type('https://example.com/data.tar.gz?sig=1') == 'tar'
+    assert get_archive_type('/data/set.TGZ') == 'tar'
+    assert get_archive_type('s3://bucket/set.zip') == 'zip'
+    assert get_archive_type('/data/set.csv') is None
+
+
+def test_streaming_extraction(file_server, temp_root):
+    files = {'data/train.csv': os.urandom(200000), 'data/test.csv': b'1,2,3\n'}
+    file_server.files['/dataset.tar.gz'] = make_tar(files)
+    url = file_server.url + '/dataset.tar.gz'
+    mount, = prepare_inputs({'dataset': url}, extract_archives=True)
+    assert mount['destination'] == '/valohai/inputs/dataset'
+    assert read_tree(mount['source']) == files
+    # Nothing but the extracted tree is kept
+    cache_root = os.path.join(temp_root, 'valohai-local-run-cache')
+    assert not [name for name in os.listdir(cache_root) if name.startswith('download-') and '.part' not in name]
+
+    # Later runs use the extracted tree as is, or after a conditional request
+    assert list(prepare_inputs({'dataset': url}, extract_archives=True)) == [mount]
+    assert len(file_server.requests) == 1
+    assert list(prepare_inputs({'dataset': url}, extract_archives=True, revalidate=True)) == [mount]
+    assert len(file_server.requests) == 2
+    assert 'If-None-Match' in file_server.requests[-1][1]
+
+
+def test_zip_and_local_archives(file_server, temp_root, tmpdir):
+    file_server.files['/images.zip'] = make_zip({'a.png': b'a', 'b/c.png': b'c'})
+    archive = make_tar({'x.txt': b'x'}, mode='w')
+    for name in ('one.tar', 'two.tar'):
+        tmpdir.join(name).write_binary(archive)
+    mounts = list(prepare_inputs({
+        'images': [file_server.url + '/images.zip', str(tmpdir.join('one.tar'))],
+        'other': str(tmpdir.join('two.tar')),
+    }, extract_archives=True))
+    assert [mount['destination'] for mount in mounts] == [
+        '/valohai/inputs/images/images',
+        '/valohai/inputs/images/one',
+        '/valohai/inputs/other',
+    ]
+    assert read_tree(mounts[0]['source']) == {'a.png': b'a', os.path.join('b', 'c.png'): b'c'}
+    # Identical archives share their extracted tree
+    assert mounts[1]['source'] == mounts[2]['source']
+    assert len(ExtractionCache().list_digests()) == 2
+
+
+def test_gc_skips_leased_trees(temp_root, tmpdir):
+    for name in ('one.tar', 'two.tar'):
+        tmpdir.join(name).write_binary(make_tar({name: b'x'}, mode='w'))
+    mounts = list(prepare_inputs({
+        'one': str(tmpdir.join('one.tar')),
+        'two': str(tmpdir.join('two.tar')),
+    }, extract_archives=True, lease_id='execution-1'))
+    cache = ExtractionCache()
+    with open(os.path.join(mounts[1]['source'] + '.leases', 'execution-1'), 'w') as outf:
+        outf.write('999999999')  # Not a live process; as if the execution had died without releasing its lease
+    assert cache.gc(max_age=0) == [os.path.basename(mounts[1]['source'])]
+    assert os.path.isdir(mounts[0]['source'])
+    cache.release('execution-1')
+    assert cache.gc(max_age=0) == [os.path.basename(mounts[0]['source'])]
+    assert cache.list_digests() == []
+
+
+@pytest.mark.parametrize('files, links', [
+    ({'../evil.txt': b'x'}, ()),
+    ({}, [('link', '/etc')]),
+    ({'link/../../evil.txt': b'x'}, [('link', '.')]),
+])
+def test_path_traversal(tmpdir, files, links):
+    dest = tmpdir.mkdir('dest')
+    with pytest.raises(ValueError):
+        extract_tar(io.BytesIO(make_tar(files, links=links)), str(dest))
+    assert not tmpdir.join('evil.txt').exists()
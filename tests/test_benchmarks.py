@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'benchmarks'))
+
+run_benchmarks = pytest.importorskip('run_benchmarks')
+
+
+def test_compare_results():
+    baseline = {key: {'median': value} for (key, value) in {
+        'a.slower': 1.0, 'a.faster': 1.0, 'a.same': 1.0, 'a.quick': 0.001, 'a.gone': 1.0,
+    }.items()}
+    results = {key: {'median': value} for (key, value) in {
+        'a.slower': 1.5, 'a.faster': 0.5, 'a.same': 1.1, 'a.quick': 0.005, 'a.added': 1.0,
+    }.items()}
+    statuses = {key: status for (key, old, new, status) in run_benchmarks.compare_results(results, baseline)}
+    assert statuses == {
+        'a.slower': 'regression',
+        'a.faster': 'improvement',
+        'a.same': 'ok',
+        'a.quick': 'ok',  # Slower by far more than the tolerance, but only by a few milliseconds
+        'a.gone': 'missing',
+        'a.added': 'new',
+    }
+
+
+def test_run_benchmarks(tmpdir, capsys):
+    output = str(tmpdir.join('results.json'))
+    assert run_benchmarks.main(['--quick', '--output', output, 'checkout', 'download_cache']) == 0
+    with open(output) as infp:
+        results = json.load(infp)['results']
+    assert set(results) == {'checkout.cold', 'checkout.warm', 'download_cache.miss', 'download_cache.hit',
+                            'download_cache.revalidate'}
+    # Everything got 100 times slower
+    for value in results.values():
+        value['median'] = value['median'] / 100
+    with open(output, 'w') as outf:
+        json.dump({'results': results}, outf)
+    assert run_benchmarks.main(['--quick', '--baseline', output, '--min-delta', '0', 'checkout']) == 1
+    assert 'regression' in capsys.readouterr().out
@@ -0,0 +1,63 @@
+import os
+import shutil
+import subprocess
+
+from valohai_local_run.checkout import CheckoutCache
+
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', '-c', 'protocol.file.allow=always'] +
+        list(args),
+        cwd=str(cwd),
+        stderr=subprocess.DEVNULL,
+    ).decode().strip()
+
+
+def make_repo(tmpdir):
+    sub_dir = tmpdir.mkdir('sub')
+    git(sub_dir, 'init')
+    sub_dir.join('sub.txt').write('submodule')
+    git(sub_dir, 'add', '.')
+    git(sub_dir, 'commit', '-m', 'sub')
+
+    main_dir = tmpdir.mkdir('main')
+    git(main_dir, 'init')
+    main_dir.join('valohai.yaml').write('[]')
+    main_dir.mkdir('bin').join('run.sh').write('#!/bin/sh\n')
+    os.chmod(str(main_dir.join('bin', 'run.sh')), 0o755)
+    git(main_dir, 'add', '.')
+    git(main_dir, 'submodule', 'add', str(sub_dir), 'sub')
+    git(main_dir, 'commit', '-m', 'main')
+    return main_dir, git(main_dir, 'rev-parse', 'HEAD')
+
+
+def test_checkout_cache(tmpdir):
+    main_dir, commit = make_repo(tmpdir)
+    # Force the submodule objects to be fetched into the cache's mirror
+    shutil.rmtree(str(main_dir.join('.git', 'modules')))
+    cache = CheckoutCache(root=str(tmpdir.join('checkouts')))
+
+    path = cache.acquire(str(main_dir), commit, lease_id='one')
+    assert cache.acquire(str(main_dir), commit, lease_id='two') == path
+    with open(os.path.join(path, 'sub', 'sub.txt')) as infp:
+        assert infp.read() == 'submodule'
+    assert os.access(os.path.join(path, 'bin', 'run.sh'), os.X_OK)
+    assert not os.stat(os.path.join(path, 'valohai.yaml')).st_mode & 0o222
+    assert os.listdir(str(tmpdir.join('checkouts', 'modules')))
+
+    cache.release(commit, lease_id='one')
+    assert cache.gc(max_age=0) == []  # Still leased by "two"
+    cache.release(commit, lease_id='two')
+    assert cache.gc(max_age=0) == [commit]
+    assert not os.path.exists(path)
+
+
+def test_release_gc_is_throttled(tmpdir, monkeypatch):
+    cache = CheckoutCache(root=str(tmpdir.join('checkouts')))
+    gc = cache.gc
+    scans = []
+    monkeypatch.setattr(cache, 'gc', lambda: scans.append(gc()))
+    for lease_id in ('one', 'two', 'three'):
+        cache.release('0' * 40, lease_id=lease_id)
+    assert len(scans) == 1  # Only the first release looks at every checkout
@@ -0,0 +1,97 @@
+import subprocess
+
+import pytest
+
+from valohai_local_run.checkout import read_head_commit
+from valohai_local_run.completion import complete
+from valohai_local_run.utils import PrefixIndex
+
+CONFIG = '''
+- step:
+    name: Train model
+    image: busybox
+    command: python train.py {parameters}
+    parameters:
+      - name: optimizer
+        type: string
+        default: adam
+        choices: [adam, sgd, rmsprop]
+      - name: max_steps
+        type: integer
+        default: 300
+    inputs:
+      - name: training-data
+- step:
+    name: Train ensemble
+    image: busybox
+    command: python ensemble.py
+- step:
+    name: evaluate
+    image: busybox
+    command: python evaluate.py
+- pipeline:
+    name: train-and-evaluate
+    nodes:
+      - {name: train, type: execution, step: Train model}
+      - {name: evaluate, type: execution, step: evaluate}
+    edges:
+      - [train.output.*, evaluate.input.model]
+'''
+
+
+def test_prefix_index():
+    index = PrefixIndex(['beta', 'Alpha', 'alphabet', 'gamma'])
+    assert index.find('ALPH') == ['Alpha', 'alphabet']
+    assert index.find('') == ['Alpha', 'alphabet', 'beta', 'gamma']
+    assert index.find('delta') == []
+    assert PrefixIndex(pairs=index.pairs).find('b') == ['beta']
+
+
+@pytest.mark.parametrize('words, expected', [
+    (['tr'], ['Train ensemble', 'Train model']),
+    (['sw'], ['sweep']),
+    (['pi'], ['pipeline']),
+    (['Train\\ m'], ['Train model']),
+    (['--no-'], ['--no-git', '--no-manifest', '--no-metrics', '--no-save-logs']),
+    (['train m', '--o'], ['--optimizer', '--output-root']),
+    (['train m', '--optimizer', ''], ['adam', 'rmsprop', 'sgd']),
+    (['train m', '--optimizer', '=', 'rm'], ['rmsprop']),
+    (['train m', '--max-steps', ''], ['300']),
+    (['train m', '--training-data', ''], []),
+    (['sweep', 'Train model', '--max'], ['--max-steps']),
+    (['train', '--'], []),  # Ambiguous step
+    (['cache', ''], []),
+    (['pipeline', 'tr'], ['train-and-evaluate']),
+])
+def test_complete(tmpdir, temp_root, monkeypatch, words, expected):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    monkeypatch.chdir(tmpdir)
+    assert sorted(complete(words)) == expected
+
+
+def test_complete_in_other_directory(tmpdir, temp_root, monkeypatch):
+    tmpdir.mkdir('project').join('valohai.yaml').write(CONFIG)
+    monkeypatch.chdir(tmpdir)
+    project = str(tmpdir.join('project'))
+    assert complete(['--directory', project, 'ev']) == ['evaluate']
+    assert complete(['pipeline', '--directory', project, 'tr']) == ['train-and-evaluate']
+    assert complete(['pipeline', '-d', project, '--no-git', '']) == ['train-and-evaluate']
+    assert complete(['pipeline', '--directory', project, 'train-and-evaluate', '']) == []
+    assert complete(['pipeline', 'tr']) == []  # No valohai.yaml in the working directory
+
+
+def test_read_head_commit(tmpdir):
+    def git(*args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+            cwd=str(tmpdir),
+        ).decode().strip()
+
+    git('init')
+    git('commit', '--allow-empty', '-m', 'first')
+    assert read_head_commit(str(tmpdir)) == git('rev-parse', 'HEAD')
+    git('pack-refs', '--all')
+    assert read_head_commit(str(tmpdir)) == git('rev-parse', 'HEAD')
+    git('commit', '--allow-empty', '-m', 'second')
+    git('checkout', '--detach', 'HEAD~1')
+    assert read_head_commit(str(tmpdir)) == git('rev-parse', 'HEAD')
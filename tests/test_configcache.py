@@ -0,0 +1,44 @@
+import os
+
+from valohai_local_run.configcache import ConfigCache
+
+CONFIG = '''
+- step:
+    name: train
+    image: busybox
+    command: python train.py {parameters}
+    parameters:
+      - name: learning-rate
+        type: float
+        default: 0.1
+- step:
+    name: evaluate
+    image: busybox
+    command: python evaluate.py
+'''
+
+
+def test_config_cache(tmpdir):
+    cache = ConfigCache(root=str(tmpdir.join('cache')))
+    config_path = tmpdir.join('valohai.yaml')
+    config_path.write(CONFIG)
+    reads = []
+
+    def read_config():
+        reads.append(1)
+        return config_path.read()
+
+    key = cache.get_file_key(str(config_path))
+    table = cache.get_step_table(key, read_config)
+    assert sorted(table.steps) == ['evaluate', 'train']
+    step = cache.get_step_table(key, read_config).get_step('train')
+    assert step.build_command({'learning-rate': 0.5}) == ['python train.py --learning-rate=0.5']
+    assert len(reads) == 1
+
+    # Changing the file changes the key
+    config_path.write(CONFIG.replace('evaluate', 'test'))
+    os.utime(str(config_path), ns=(0, 0))
+    table = cache.get_step_table(cache.get_file_key(str(config_path)), read_config)
+    assert sorted(table.steps) == ['test', 'train']
+    assert len(reads) == 2
+    assert cache.prune(max_age=0) == 2
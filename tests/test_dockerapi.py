@@ -0,0 +1,195 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from io import BytesIO
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import pytest
+
+from valohai_local_run.cli import cli
+from valohai_local_run.consts import EXECUTION_METADATA_JSON_NAME, STDERR_LOG_NAME, STDOUT_LOG_NAME
+from valohai_local_run.dockerapi import (
+    FRAME_HEADER, DockerAPIError, DockerClient, build_container_config, get_docker_client, split_image_tag,
+)
+from valohai_local_run.excs import BadUsage
+
+
+class FakeDockerDaemon(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, FakeDockerRequestHandler)
+        self.images = set()
+        self.containers = {}
+        self.requests = []
+        self.connections = set()
+        self.output = [(1, b'hello\n'), (2, b'oops\n'), (1, b'world\n')]
+        self.exit_code = 3
+
+
+class FakeDockerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return 'docker'
+
+    def send_json(self, status, value=None):
+        data = (json.dumps(value).encode() if value is not None else b'')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def handle_request(self):
+        server = self.server
+        server.connections.add(id(self.connection))
+        path, _, query = self.path.partition('?')
+        parts = path.split('/')[2:]  # Skip the API version
+        server.requests.append((self.command, '/'.join(parts)))
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if parts == ['images', 'create']:
+            server.images.add(query)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'{"status": "Pulling"}\n{"status": "Done"}\n')
+            self.close_connection = True
+        elif parts == ['containers', 'create']:
+            config = json.loads(body.decode())
+            if not server.images:
+                return self.send_json(404, {'message': 'No such image: %s' % config['Image']})
+            container_id = 'c%d' % len(server.containers)
+            server.containers[container_id] = {'config': config, 'started': threading.Event()}
+            self.send_json(201, {'Id': container_id})
+        elif parts[-1] == 'attach':
+            container = server.containers[parts[1]]
+            self.send_response(101)
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Upgrade', 'tcp')
+            self.end_headers()
+            container['started'].wait(5)
+            for stream_type, data in server.output:
+                self.wfile.write(FRAME_HEADER.pack(stream_type, len(data)) + data)
+            self.close_connection = True
+        elif parts[-1] == 'start':
+            server.containers[parts[1]]['started'].set()
+            self.send_json(204)
+        elif parts[-1] == 'wait':
+            self.send_json(200, {'StatusCode': server.exit_code})
+        elif self.command == 'DELETE':
+            server.containers.pop(parts[1])
+            self.send_json(204)
+        else:
+            self.send_json(404, {'message': 'page not found'})
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+
+@pytest.fixture
+def docker_daemon(tmpdir):
+    daemon = FakeDockerDaemon(str(tmpdir.join('docker.sock')))
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server_close()
+
+
+def test_run_container(docker_daemon):
+    client = DockerClient(docker_daemon.server_address)
+    config = build_container_config('busybox:1.28', 'echo hello', {'A': '1'}, [], '/valohai/repository')
+    stdout, stderr = BytesIO(), BytesIO()
+    proc = client.run_container(config, name='valohai-local-x', stdout_files=[stdout], stderr_files=[stderr])
+    assert proc.returncode == 3
+    assert stdout.getvalue() == b'hello\nworld\n'
+    assert stderr.getvalue() == b'oops\n'
+    assert proc.tee_bytes == {'stdout': 12, 'stderr': 5}
+    assert docker_daemon.images == {'fromImage=busybox&tag=1.28'}  # Pulled when creating the container failed
+    assert not docker_daemon.containers  # Removed once done
+    assert [request for request in docker_daemon.requests if request[0] == 'DELETE'] == [('DELETE', 'containers/c0')]
+
+    # Keep-alive connections are reused for requests other than attaching and pulling
+    docker_daemon.connections.clear()
+    client.run_container(config, name='valohai-local-y', stdout_files=[], stderr_files=[])
+    assert len(docker_daemon.connections) == 2
+    client.close()
+
+
+def test_api_error(docker_daemon):
+    client = DockerClient(docker_daemon.server_address)
+    with pytest.raises(DockerAPIError) as ei:
+        client.request('GET', '/nope')
+    assert ei.value.status == 404 and ei.value.message == 'page not found'
+
+
+def test_get_docker_client(tmpdir, monkeypatch):
+    socket_path = tmpdir.join('docker.sock')
+    monkeypatch.setenv('DOCKER_HOST', 'unix://%s' % socket_path)
+    assert get_docker_client('auto') is None  # No socket
+    socket_path.write('')
+    assert get_docker_client('auto').socket_path == str(socket_path)
+    assert get_docker_client('auto', docker_command='nvidia-docker') is None
+    assert get_docker_client('cli') is None
+    with pytest.raises(BadUsage):
+        get_docker_client('api', docker_add_args='--runtime=nvidia')
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://127.0.0.1:2375')
+    assert get_docker_client('auto') is None
+    with pytest.raises(BadUsage):
+        get_docker_client('api')
+
+
+@pytest.mark.parametrize('image, expected', [
+    ('busybox', ('busybox', 'latest')),
+    ('python:3.6', ('python', '3.6')),
+    ('localhost:5000/app', ('localhost:5000/app', 'latest')),
+    ('localhost:5000/app:1.0', ('localhost:5000/app', '1.0')),
+    ('app@sha256:abc', ('app', 'sha256:abc')),
+])
+def test_split_image_tag(image, expected):
+    assert split_image_tag(image) == expected
+
+
+def test_container_config():
+    volumes = [
+        {'source': '/tmp', 'destination': '/valohai/inputs', 'readonly': True},
+        {'source': os.getcwd(), 'destination': '/valohai/outputs'},
+    ]
+    env_vars = {'B': '2', 'A': '1'}
+    config = build_container_config('busybox', 'a && b', env_vars, volumes, '/work', cpus='1.5', memory='1G')
+    assert config['Cmd'] == ['/bin/sh', '-c', 'a && b']
+    assert config['Env'] == ['A=1', 'B=2']
+    assert config['HostConfig'] == {
+        'Binds': ['%s:/valohai/inputs:ro' % os.path.realpath('/tmp'), '%s:/valohai/outputs' % os.path.realpath('.')],
+        'NanoCpus': 1500000000,
+        'Memory': 1024 ** 3,
+    }
+
+
+def test_execute_with_api(tmpdir, docker_daemon, monkeypatch):
+    monkeypatch.setenv('DOCKER_HOST', 'unix://%s' % docker_daemon.server_address)
+    code_dir = tmpdir.mkdir('code')
+    outputs_dir = tmpdir.mkdir('outputs')
+    code_dir.join('valohai.yaml').write('''
+- step:
+    name: greet
+    image: busybox
+    command:
+      - echo hello
+      - echo world
+''')
+    with pytest.raises(SystemExit) as ei:
+        cli(['--directory', str(code_dir), '--output-root', str(outputs_dir), '--docker-backend', 'api', 'greet'])
+    assert ei.value.code == 3
+    output_dir, = outputs_dir.listdir(lambda path: path.isdir())
+    assert output_dir.join(STDOUT_LOG_NAME).read() == 'hello\nworld\n'
+    assert output_dir.join(STDERR_LOG_NAME).read() == 'oops\n'
+    metadata = json.loads(output_dir.join(EXECUTION_METADATA_JSON_NAME).read())
+    assert metadata['docker_command']['Cmd'] == ['/bin/sh', '-c', 'echo hello && echo world']
+    assert not docker_daemon.containers
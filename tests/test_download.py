@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+from valohai_local_run.cache import DownloadCache, get_cache_key
+from valohai_local_run.download import download_urls
+
+
+def test_download_urls_parallel(file_server, temp_root):
+    urls = []
+    for i in range(10):
+        file_server.files['/shard-%d.bin' % i] = os.urandom(50000)
+        urls.append('%s/shard-%d.bin?sig=%d' % (file_server.url, i, i))
+    paths = download_urls(urls, concurrency=4, with_progress=False)
+    assert set(paths) == set(urls)
+    for i, url in enumerate(urls):
+        with open(paths[url], 'rb') as infp:
+            assert infp.read() == file_server.files['/shard-%d.bin' % i]
+    # A second round is served from the cache
+    n_requests = len(file_server.requests)
+    assert download_urls(urls, with_progress=False) == paths
+    assert len(file_server.requests) == n_requests
+
+
+def test_download_resume(file_server, temp_root):
+    data = os.urandom(300000)
+    file_server.files['/big.bin'] = data
+    url = file_server.url + '/big.bin'
+    partial_path = DownloadCache().get_partial_path(get_cache_key(url))
+    with open(partial_path, 'wb') as outf:
+        outf.write(data[:100000])
+    with open(partial_path + '.json', 'w') as outf:
+        json.dump({'etag': '"%s"' % hashlib.md5(data).hexdigest()}, outf)
+    path = download_urls([url], with_progress=False)[url]
+    assert file_server.requests[-1][1]['Range'] == 'bytes=100000-'
+    assert not os.path.exists(partial_path)
+    with open(path, 'rb') as infp:
+        assert infp.read() == data
+
+
+def test_cache_verification_and_revalidation(file_server, temp_root):
+    data = os.urandom(10000)
+    file_server.files['/data.bin'] = data
+    url = file_server.url + '/data.bin'
+    path = download_urls([url], with_progress=False)[url]
+    with open(path, 'r+b') as outf:  # Corrupt the cached copy; it must not be served again
+        outf.write(b'garbage')
+    assert download_urls([url], with_progress=False)[url] == path
+    assert len(file_server.requests) == 2
+    with open(path, 'rb') as infp:
+        assert infp.read() == data
+
+    download_urls([url], with_progress=False, revalidate=True)
+    assert file_server.requests[-1][1]['If-None-Match'] == '"%s"' % hashlib.md5(data).hexdigest()
+    assert DownloadCache().lookup(get_cache_key(url))['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+def test_cache_lru_eviction(file_server, temp_root):
+    cache = DownloadCache(size_limit=25000)
+    urls = []
+    for i in range(4):
+        file_server.files['/%d.bin' % i] = os.urandom(10000)
+        urls.append('%s/%d.bin' % (file_server.url, i))
+        download_urls(urls[-1:], cache=cache, with_progress=False)
+    assert [entry['url'] for (key, entry) in cache.entries()] == urls[:1:-1]
+    assert cache.stats()['size'] == 20000
+    cache.prune(limit=0)
+    assert cache.stats()['entries'] == 0
+
+
+def test_quiet_downloads(file_server, temp_root, capfd, caplog):
+    file_server.files['/data.bin'] = os.urandom(10000)
+    urls = [file_server.url + '/data.bin', file_server.url + '/other.bin']
+    file_server.files['/other.bin'] = b'other'
+    paths = download_urls(urls, with_progress=False)
+    del file_server.files['/data.bin']
+    assert download_urls(urls[:1], with_progress=False, revalidate=True) == {urls[0]: paths[urls[0]]}
+    assert capfd.readouterr() == ('', '')  # No progress bar label, and the warning is only logged
+    assert 'Could not revalidate' in caplog.text
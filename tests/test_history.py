@@ -0,0 +1,90 @@
+import datetime
+import json
+import os
+
+from valohai_local_run.cli import run_cli
+from valohai_local_run.consts import EXECUTION_METADATA_JSON_NAME
+from valohai_local_run.history import HistoryIndex
+
+CONFIG = '''
+- step:
+    name: train
+    image: busybox
+    command: exit {parameters}
+    parameters:
+      - name: code
+        type: integer
+        pass-as: '{v}'
+'''
+
+
+def write_execution(output_root, execution_id, days_ago=0, **metadata):
+    output_dir = output_root.mkdir(execution_id)
+    metadata.setdefault('time', (datetime.datetime.now() - datetime.timedelta(days=days_ago)).isoformat())
+    output_dir.join(EXECUTION_METADATA_JSON_NAME).write(json.dumps(metadata))
+    return output_dir
+
+
+def test_executions_are_indexed(tmpdir, capsys):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    output_root = tmpdir.join('outputs')
+    for code in (0, 3):
+        argv = ['--directory', str(tmpdir), '--output-root', str(output_root), 'train', '--code=%d' % code]
+        assert run_cli(argv) == code
+    index = HistoryIndex(str(output_root))
+    failed, succeeded = index.query()
+    assert (failed['exit_code'], failed['parameters'], failed['step']) == (3, {'code': 3}, 'train')
+    assert failed['duration'] > 0
+    assert [execution['exit_code'] for execution in index.query(parameters={'code': '0'})] == [0]
+    assert index.query(failed=False) == [succeeded]
+    assert index.query(step='nope') == []
+
+    capsys.readouterr()
+    assert run_cli(['history', '--output-root', str(output_root), 'query', '--failed', '--json']) == 0
+    assert [json.loads(line)['execution_id'] for line in capsys.readouterr().out.splitlines()] == [
+        failed['execution_id'],
+    ]
+
+
+def test_backfill(tmpdir):
+    output_root = tmpdir.mkdir('outputs')
+    write_execution(output_root, 'a', step='train', commit='abcdef', exit_code=0, parameters={'lr': 0.01})
+    write_execution(output_root, 'b', step='train', commit='123456', exit_code=1, parameters={'lr': 0.1})
+    index = HistoryIndex(str(output_root))
+    assert index.backfill() == (2, 0)
+    assert index.backfill() == (0, 0)
+    assert [execution['execution_id'] for execution in index.query(parameters={'lr': '0.01'})] == ['a']
+    assert [execution['execution_id'] for execution in index.query(commit='1234')] == ['b']
+
+    write_execution(output_root, 'c', step='evaluate', exit_code=0, profile={'total': 12.5})
+    output_root.join('a').remove()
+    assert index.backfill() == (1, 1)
+    assert [execution['execution_id'] for execution in index.query(min_duration=10)] == ['c']
+
+
+def test_backfill_before_first_query(tmpdir, capsys):
+    output_root = tmpdir.mkdir('outputs')
+    write_execution(output_root, 'old', days_ago=1, step='train', exit_code=0)
+    # An execution run since creates the index, which doesn't know of the earlier one
+    path = write_execution(output_root, 'new', step='train', exit_code=0).join(EXECUTION_METADATA_JSON_NAME)
+    index = HistoryIndex(str(output_root))
+    index.update('new', json.loads(path.read()), os.stat(str(path)).st_mtime_ns)
+    assert not index.is_backfilled()
+
+    assert run_cli(['history', '--output-root', str(output_root), 'query', '--json']) == 0
+    assert [json.loads(line)['execution_id'] for line in capsys.readouterr().out.splitlines()] == ['new', 'old']
+    assert index.is_backfilled()
+
+
+def test_prune(tmpdir):
+    output_root = tmpdir.mkdir('outputs')
+    for days_ago in range(5):
+        write_execution(output_root, 'e%d' % days_ago, days_ago=days_ago, exit_code=(days_ago % 2))
+    write_execution(output_root, 'running', days_ago=10)  # No exit code yet
+    index = HistoryIndex(str(output_root))
+    index.backfill()
+    assert index.prune(older_than=1.5, dry_run=True) == ['e4', 'e3', 'e2']
+    assert index.prune(older_than=1.5, failed_only=True) == ['e3']
+    assert not output_root.join('e3').exists()
+    assert index.prune(keep=2) == ['e4', 'e2']
+    assert sorted(os.listdir(str(output_root))) == ['.valohai-history.sqlite3', 'e0', 'e1', 'running']
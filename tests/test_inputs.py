@@ -0,0 +1,85 @@
+import os
+
+from valohai_local_run.inputs import InputStore, prepare_inputs
+
+
+def test_input_store(tmpdir, temp_root):
+    data_dir = tmpdir.mkdir('data')
+    data_dir.join('a.txt').write('alpha')
+    data_dir.join('b.txt').write('alpha')  # Same content as a.txt
+    images_dir = data_dir.mkdir('images')
+    images_dir.mkdir('cats').join('cat.jpg').write('meow')
+    os.symlink('cats/cat.jpg', str(images_dir.join('latest.jpg')))
+
+    mounts = list(prepare_inputs({
+        'texts': [str(data_dir.join('a.txt')), str(data_dir.join('b.txt'))],
+        'images': str(images_dir),
+    }))
+    store = InputStore()
+    volumes = store.build_tree('one', mounts)
+    tree = store.get_tree_path('one')
+    # Directories are mounted as they are (on top of a placeholder in the tree), without hashing their contents
+    assert volumes == [
+        {'source': tree, 'destination': '/valohai/inputs', 'readonly': True},
+        {'source': str(images_dir), 'destination': '/valohai/inputs/images', 'readonly': True},
+    ]
+    assert os.path.isdir(os.path.join(tree, 'images'))
+    with open(os.path.join(tree, 'texts', 'b.txt')) as infp:
+        assert infp.read() == 'alpha'
+    assert not any(path.startswith(str(images_dir)) for path in store._read_digests())
+    # Identical files are stored once, also across trees
+    store.build_tree('two', mounts)
+    inodes = {
+        os.stat(os.path.join(store.get_tree_path(tree_id), 'texts', name)).st_ino
+        for tree_id in ('one', 'two')
+        for name in ('a.txt', 'b.txt')
+    }
+    assert len(inodes) == 1
+    assert len(store.list_objects()) == 1
+
+    # Modifying a file in place may also modify its object (if it was hardlinked), which must be noticed
+    data_dir.join('a.txt').write('beta')
+    store.build_tree('three', mounts[:2])
+    for name, content in [('a.txt', 'beta'), ('b.txt', 'alpha')]:
+        with open(os.path.join(store.get_tree_path('three'), 'texts', name)) as infp:
+            assert infp.read() == content
+
+    for tree_id in ('one', 'two', 'three'):
+        store.release_tree(tree_id)
+    assert not os.listdir(store.trees_dir)
+    data_dir.remove()
+    assert len(store.gc(max_age=0)) == 2  # alpha and beta
+    assert not store.list_objects()
+    assert not store._read_digests()  # Entries of removed files are dropped too
+
+
+def test_release_tree_gc_is_throttled(tmpdir, temp_root, monkeypatch):
+    tmpdir.join('a.txt').write('alpha')
+    mounts = list(prepare_inputs({'texts': str(tmpdir.join('a.txt'))}))
+    store = InputStore()
+    gc = store.gc
+    scans = []
+    monkeypatch.setattr(store, 'gc', lambda: scans.append(gc()))
+    for tree_id in ('one', 'two', 'three'):
+        store.build_tree(tree_id, mounts)
+        store.release_tree(tree_id)
+    assert len(scans) == 1  # Only the first release scans the store
+    assert not os.listdir(store.trees_dir)
+
+
+def test_input_store_digests(tmpdir, temp_root, monkeypatch):
+    monkeypatch.setattr('valohai_local_run.inputs.MAX_DIGEST_ENTRIES', 3)
+    store = InputStore()
+    paths = []
+    for n in range(4):
+        paths.append(str(tmpdir.join('%d.txt' % n)))
+        with open(paths[-1], 'w') as outf:
+            outf.write(str(n))
+        store.get_digests([paths[-1]])
+    assert list(store._read_digests()) == paths[1:]  # The least recently hashed entry is dropped
+
+    # Entries of modified files are dropped by garbage collection
+    with open(paths[1], 'w') as outf:
+        outf.write('changed')
+    store.gc()
+    assert list(store._read_digests()) == paths[2:]
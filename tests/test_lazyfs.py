@@ -0,0 +1,131 @@
+import errno
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from valohai_local_run.download import download_url
+from valohai_local_run.inputs import prepare_inputs
+from valohai_local_run.lazyfs import BlockCache, LazyInputFS, LazyMount, RangeReader, get_fuse, group_runs
+
+BLOCK_SIZE = 1000
+
+
+@pytest.fixture
+def block_cache(temp_root):
+    return BlockCache(block_size=BLOCK_SIZE)
+
+
+def test_group_runs():
+    assert group_runs([]) == []
+    assert group_runs([1, 2, 3, 5, 7, 8]) == [(1, 3), (5, 5), (7, 8)]
+
+
+def test_range_reader(file_server, block_cache):
+    data = os.urandom(10 * BLOCK_SIZE + 123)
+    file_server.files['/big.bin'] = data
+    reader = RangeReader(file_server.url + '/big.bin', block_cache).open()
+    assert reader.size == len(data)
+    assert len(file_server.requests) == 1  # The first block
+
+    assert reader.read(10, 20) == data[10:30]
+    assert len(file_server.requests) == 1
+    # Consecutive missing blocks are fetched at once
+    assert reader.read(1500, 3000) == data[1500:4500]
+    assert file_server.requests[-1][1]['Range'] == 'bytes=1000-4999'
+    assert reader.read(len(data) - 50, 1000) == data[-50:]
+    assert reader.read(len(data), 10) == b''
+    n_requests = len(file_server.requests)
+
+    # Other readers (e.g. of later executions) share the blocks
+    reader = RangeReader(file_server.url + '/big.bin?signature=x', block_cache).open()
+    assert reader.read(0, 5000) == data[:5000]
+    assert len(file_server.requests) == n_requests
+
+    # Changes to the file are noticed
+    file_server.files['/big.bin'] = os.urandom(len(data))
+    with pytest.raises(IOError):
+        reader.read(6000, 10)
+    reader = RangeReader(file_server.url + '/big.bin', block_cache).open(revalidate=True)
+    assert reader.read(0, 10) == file_server.files['/big.bin'][:10]
+
+
+def test_concurrent_reads(file_server, block_cache, monkeypatch):
+    data = os.urandom(3 * BLOCK_SIZE)
+    file_server.files['/big.bin'] = data
+    reader = RangeReader(file_server.url + '/big.bin', block_cache).open()
+    get_block = block_cache.get_block
+    sizes = []
+
+    def get_block_and_record_size(*args):
+        block = get_block(*args)
+        sizes.append(len(block) if block else None)
+        return block
+
+    monkeypatch.setattr(block_cache, 'get_block', get_block_and_record_size)
+    assert reader.read(10, 20) == data[10:30]
+    assert sizes == [20]  # Only the range is read from the cached block
+
+    # Threads reading the same missing block wait for a single fetch of it
+    file_server.requests.clear()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: reader.read(BLOCK_SIZE + i, 100), range(8)))
+    assert results == [data[BLOCK_SIZE + i:BLOCK_SIZE + i + 100] for i in range(8)]
+    assert len(file_server.requests) == 1
+
+
+def test_lazy_input_fs(file_server, block_cache):
+    data = os.urandom(2500)
+    file_server.files['/a.bin'] = data
+    reader = RangeReader(file_server.url + '/a.bin', block_cache).open()
+    fs = LazyInputFS({'train/a.bin': reader})
+    assert fs('readdir', '/', 0) == ['.', '..', 'train']
+    assert fs('readdir', '/train', 0) == ['.', '..', 'a.bin']
+    assert stat.S_ISDIR(fs('getattr', '/train')['st_mode'])
+    assert fs('getattr', '/train/a.bin')['st_size'] == 2500
+    assert fs('read', '/train/a.bin', 100, 2450, 0) == data[2450:]
+    with pytest.raises(OSError) as ei:
+        fs('getattr', '/nope')
+    assert ei.value.errno == errno.ENOENT
+    with pytest.raises(OSError) as ei:
+        fs('open', '/train/a.bin', os.O_RDWR)
+    assert ei.value.errno == errno.EROFS
+
+
+def test_prepare_lazy_inputs(file_server, temp_root):
+    for name in ('lazy.csv', 'cached.csv', 'unranged.csv'):
+        file_server.files['/' + name] = b'1,2,3\n' * 100
+    download_url(file_server.url + '/cached.csv', with_progress=False)
+    file_server.requests.clear()
+    mounts = list(prepare_inputs({'data': [file_server.url + '/lazy.csv', file_server.url + '/cached.csv']}, lazy=True))
+    assert mounts[0]['destination'] == '/valohai/inputs/data/lazy.csv'
+    assert mounts[0]['reader'].size == 600 and mounts[0]['source'] is None
+    assert os.path.isfile(mounts[1]['source'])  # Downloaded already, so mounted as is
+    assert len(file_server.requests) == 1
+
+    # Servers that don't support ranges get the files downloaded as usual
+    file_server.ranges = False
+    mount, = prepare_inputs({'data': file_server.url + '/unranged.csv'}, lazy=True)
+    assert 'reader' not in mount and os.path.isfile(mount['source'])
+
+
+def test_lazy_mount(file_server, block_cache):
+    try:
+        get_fuse()
+    except RuntimeError as exc:
+        pytest.skip(str(exc))
+    data = os.urandom(5 * BLOCK_SIZE)
+    file_server.files['/a.bin'] = data
+    reader = RangeReader(file_server.url + '/a.bin', block_cache).open()
+    try:
+        mount = LazyMount({'data/a.bin': reader}).start()
+    except RuntimeError as exc:  # e.g. no FUSE device, or not allowed to mount
+        pytest.skip(str(exc))
+    try:
+        with open(mount.get_path('data/a.bin'), 'rb') as infp:
+            infp.seek(3 * BLOCK_SIZE)
+            assert infp.read(10) == data[3 * BLOCK_SIZE:3 * BLOCK_SIZE + 10]
+        assert len(file_server.requests) == 2  # Only the blocks that were read
+    finally:
+        mount.stop()
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from valohai_local_run.logstore import INDEX_INTERVAL, StructuredLogReader, StructuredLogWriter, logs_cli
+
+
+def test_structured_log(tmpdir):
+    n_lines = INDEX_INTERVAL * 3
+    with StructuredLogWriter(str(tmpdir)) as writer:
+        stdout, stderr = writer.stream('stdout'), writer.stream('stderr')
+        for i in range(n_lines):
+            # Lines are split across writes
+            stdout.write(b'line %d ' % i)
+            stdout.write(b'out\n')
+            if i % 100 == 0:
+                stderr.write(b'error %d\n' % i)
+        stdout.write(b'no newline at end')
+
+    reader = StructuredLogReader(str(tmpdir))
+    records = list(reader.read())
+    assert len(records) == n_lines + (n_lines // 100 + 1) + 1
+    assert [r.line for r in records] == list(range(len(records)))
+    assert records[0].data == b'line 0 out\n' and records[0].stream == 'stdout'
+    assert records[1].data == b'error 0\n' and records[1].stream == 'stderr' and records[1].offset == 0
+    assert records[2].offset == len(b'line 0 out\n')
+    assert records[-1].data == b'no newline at end'
+    assert len(reader.read_index()) == len(records) // INDEX_INTERVAL + 1
+
+    # Seeking by line starts close to the requested line
+    assert reader.find_start(line=600)[0] == 512
+    assert next(reader.read(line=600)).line == 600
+    # Seeking by time
+    late = records[-50]
+    assert all(r.time >= late.time for r in reader.read(since=late.time))
+    assert len(list(reader.read(since=late.time))) >= 50
+
+
+def test_logs_cli_follow(tmpdir, capsys):
+    writer = StructuredLogWriter(str(tmpdir))
+    stdout = writer.stream('stdout')
+    stdout.write(b'one\n')
+
+    def write_more():
+        time.sleep(0.3)
+        stdout.write(b'two\n')
+        writer.stream('stderr').write(b'three\n')
+        time.sleep(0.3)
+        writer.close()
+
+    thread = threading.Thread(target=write_more)
+    thread.start()
+    try:
+        assert logs_cli([str(tmpdir), '--follow', '--stream', 'stdout']) == 0
+    finally:
+        thread.join()
+    assert capsys.readouterr().out == 'one\ntwo\n'
+
+
+def test_logs_cli_without_log(tmpdir, capsys):
+    execution_dir = tmpdir.mkdir('20190101-000000-abcde')
+    for argv in ([str(execution_dir)], ['--output-root', str(tmpdir)], ['--output-root', str(tmpdir), '2019']):
+        with pytest.raises(SystemExit) as ei:
+            logs_cli(argv)
+        assert ei.value.code == 2
+        assert '--structured-logs' in capsys.readouterr().err
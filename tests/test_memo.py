@@ -0,0 +1,105 @@
+import json
+import subprocess
+
+import pytest
+
+from valohai_local_run.cli import cli
+from valohai_local_run.consts import EXECUTION_METADATA_JSON_NAME
+from valohai_local_run.memo import MemoIndex, get_fingerprint, link_outputs
+
+FINGERPRINT_ARGS = {
+    'commit': 'f' * 40,
+    'image': 'busybox',
+    'interpolated_command': ['python train.py --rate=0.1'],
+    'parameters': {'rate': 0.1},
+    'input_digests': {'/valohai/inputs/data/a.csv': 'a' * 64},
+}
+
+
+@pytest.mark.parametrize('key, value', [
+    ('commit', 'e' * 40),
+    ('image', 'python:3.6'),
+    ('interpolated_command', ['python train.py --rate=0.2']),
+    ('parameters', {'rate': 0.2}),
+    ('input_digests', {'/valohai/inputs/data/a.csv': 'b' * 64}),
+    ('input_digests', {'/valohai/inputs/data/b.csv': 'a' * 64}),
+    ('docker_add_args', '--env FOO=bar'),
+])
+def test_fingerprint(key, value):
+    fingerprint = get_fingerprint(**FINGERPRINT_ARGS)
+    assert fingerprint == get_fingerprint(**dict(FINGERPRINT_ARGS))
+    assert fingerprint != get_fingerprint(**dict(FINGERPRINT_ARGS, **{key: value}))
+
+
+def test_memo_index(tmpdir):
+    index = MemoIndex(str(tmpdir))
+    output_dir = tmpdir.mkdir('20180101-000000-abcde')
+    output_dir.join(EXECUTION_METADATA_JSON_NAME).write(json.dumps({'fingerprint': 'abc', 'exit_code': 0}))
+    assert not index.get('abc')
+    index.add('abc', '20180101-000000-abcde')
+    assert index.get('abc') == str(output_dir)
+    assert not index.get('def')
+
+    output_dir.join(EXECUTION_METADATA_JSON_NAME).write(json.dumps({'fingerprint': 'abc', 'exit_code': 1}))
+    assert not index.get('abc')
+    output_dir.remove()
+    index.add('def', '20180101-000001-abcde')
+    assert not index.get('abc')
+    assert list(index._read_index()) == ['def']  # Entries of removed executions are forgotten
+
+
+def test_link_outputs(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('model.pkl').write('model')
+    source.mkdir('sub').join('data.csv').write('data')
+    source.join(EXECUTION_METADATA_JSON_NAME).write('{}')
+    dest = tmpdir.mkdir('dest')
+    link_outputs(str(source), str(dest))
+    assert dest.join('model.pkl').read() == 'model'
+    assert dest.join('sub', 'data.csv').read() == 'data'
+    assert not dest.join(EXECUTION_METADATA_JSON_NAME).exists()
+
+
+def test_memoized_execution(tmpdir, temp_root, capsys):
+    code_dir = tmpdir.mkdir('code')
+    outputs_dir = tmpdir.mkdir('outputs')
+    code_dir.join('valohai.yaml').write('''
+- step:
+    name: count
+    image: busybox
+    command:
+      - wc -l $VH_INPUTS_DIR/data/data.txt > $VH_OUTPUTS_DIR/count.txt
+    inputs:
+      - name: data
+''')
+    tmpdir.join('data.txt').write('1\n2\n3\n')
+    subprocess.check_call(['git', 'init', '-q'], cwd=str(code_dir))
+    subprocess.check_call(['git', 'add', '.'], cwd=str(code_dir))
+    subprocess.check_call(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', 'commit', '-q', '-m', 'initial'],
+        cwd=str(code_dir),
+    )
+    args = [
+        '--directory', str(code_dir),
+        '--output-root', str(outputs_dir),
+        '--data=%s' % tmpdir.join('data.txt'),
+        '--memoize',
+        'count',
+    ]
+
+    def run(*extra_args):
+        existing = set(outputs_dir.listdir(lambda path: path.isdir()))
+        with pytest.raises(SystemExit) as ei:
+            cli(args + list(extra_args))
+        output_dir, = set(outputs_dir.listdir(lambda path: path.isdir())) - existing
+        count_path = output_dir.join('count.txt')
+        return (ei.value.code, (count_path.read() if count_path.exists() else None))
+
+    code, count = run()
+    assert code == 0 and count.startswith('3')
+    # Docker isn't even started for an identical execution...
+    assert run('--docker-command', 'false') == (0, count)
+    assert 'Reusing the outputs of identical execution' in capsys.readouterr().out
+    # ...but is when the contents of an input change
+    tmpdir.join('data.txt').write('1\n2\n3\n4\n')
+    assert run('--docker-command', 'false') == (1, None)
@@ -0,0 +1,42 @@
+import csv
+import json
+import os
+
+from valohai_local_run.metrics import MetricsCollector
+
+
+def test_metrics_collector(tmpdir):
+    with MetricsCollector(str(tmpdir)) as collector:
+        for step in range(10):
+            line = json.dumps({'step': step, 'loss': 1.0 / (step + 1), 'phase': 'train'}).encode() + b'\n'
+            # Split lines across writes, with regular output in between
+            collector.write(b'Training...\n' + line[:7])
+            collector.write(line[7:])
+        collector.write(b'{"not json": \n[1, 2, 3]\n{"final/accuracy": 0.9}')
+    summary = collector.summary()  # The unterminated last line is only processed on close
+
+    assert summary['step'] == {'count': 10, 'last': 9, 'min': 0, 'max': 9, 'mean': 4.5}
+    assert summary['loss']['min'] == 0.1
+    assert summary['phase'] == {'count': 10, 'last': 'train'}
+    assert summary['final/accuracy']['last'] == 0.9
+    with open(os.path.join(str(tmpdir), 'valohai-metrics', 'loss.csv')) as infp:
+        rows = list(csv.DictReader(infp))
+    assert [int(row['index']) for row in rows] == list(range(10))
+    assert float(rows[3]['value']) == 0.25
+    assert os.path.isfile(os.path.join(str(tmpdir), 'valohai-metrics', 'final_accuracy.csv'))
+
+
+def test_metrics_collector_file_names(tmpdir, monkeypatch):
+    monkeypatch.setattr('valohai_local_run.metrics.MAX_OPEN_WRITERS', 2)
+    with MetricsCollector(str(tmpdir)) as collector:
+        for step in range(3):
+            collector.write(json.dumps({'a/b': step, 'a_b': -step, 'c': step, 'd': step}).encode() + b'\n')
+        assert len(collector.writers) == 2
+    metrics_dir = os.path.join(str(tmpdir), 'valohai-metrics')
+    filenames = sorted(os.listdir(metrics_dir))
+    assert len(filenames) == 4 and 'a_b.csv' in filenames
+    for filename in filenames:
+        with open(os.path.join(metrics_dir, filename)) as infp:
+            rows = list(csv.reader(infp))
+        assert rows[0] == ['index', 'time', 'value']  # A single header, even when reopened
+        assert [row[0] for row in rows[1:]] == ['0', '1', '2']
@@ -0,0 +1,88 @@
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+
+import pytest
+
+from valohai_local_run.cli import cli
+from valohai_local_run.consts import (
+    EXECUTION_METADATA_JSON_NAME, OUTPUTS_ARCHIVE_NAME, OUTPUTS_MANIFEST_NAME, STDOUT_LOG_NAME,
+)
+from valohai_local_run.outputs import build_manifest, outputs_cli, read_manifest, write_archive, write_manifest
+
+
+def make_outputs(directory):
+    directory.join('model.pkl').write('model')
+    directory.mkdir('sub').join('data.csv').write('data')
+    directory.join(STDOUT_LOG_NAME).write('log')
+    directory.join(EXECUTION_METADATA_JSON_NAME).write('{}')
+
+
+def test_manifest(tmpdir):
+    make_outputs(tmpdir)
+    entries, n_hashed = build_manifest(str(tmpdir))
+    assert n_hashed == 2
+    assert [entry['path'] for entry in entries] == ['model.pkl', 'sub/data.csv']
+    assert entries[0]['size'] == 5
+    assert entries[0]['sha256'] == hashlib.sha256(b'model').hexdigest()
+    assert entries[1]['mtime'] == os.stat(str(tmpdir.join('sub', 'data.csv'))).st_mtime
+    write_manifest(str(tmpdir), entries)
+    assert read_manifest(str(tmpdir)) == entries
+
+    # Only changed files are rehashed incrementally
+    tmpdir.join('sub', 'data.csv').write('more data')
+    entries, n_hashed = build_manifest(str(tmpdir), previous=read_manifest(str(tmpdir)))
+    assert n_hashed == 1
+    assert entries[1]['sha256'] == hashlib.sha256(b'more data').hexdigest()
+
+
+def test_archive(tmpdir):
+    pytest.importorskip('zstandard')
+    import zstandard
+    make_outputs(tmpdir)
+    archive_path = write_archive(str(tmpdir), ['model.pkl', 'sub/data.csv'])
+    assert archive_path == str(tmpdir.join(OUTPUTS_ARCHIVE_NAME))
+    with open(archive_path, 'rb') as infp:
+        data = zstandard.ZstdDecompressor().stream_reader(infp).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert tar.getnames() == ['model.pkl', 'sub/data.csv']
+        assert tar.extractfile('sub/data.csv').read() == b'data'
+
+
+def test_archive_without_zstandard(tmpdir, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'zstandard', None)  # Makes importing it fail
+    with pytest.raises(RuntimeError):
+        write_archive(str(tmpdir), [])
+
+
+def test_outputs_cli(tmpdir):
+    execution_dir = tmpdir.mkdir('20180101-000000-abcde')
+    make_outputs(execution_dir)
+    assert outputs_cli(['manifest', '--output-root', str(tmpdir)]) == 0
+    assert [entry['path'] for entry in read_manifest(str(execution_dir))] == ['model.pkl', 'sub/data.csv']
+
+
+def test_execution_manifest(tmpdir):
+    code_dir = tmpdir.mkdir('code')
+    outputs_dir = tmpdir.mkdir('outputs')
+    code_dir.join('valohai.yaml').write('''
+- step:
+    name: write
+    image: busybox
+    command:
+      - echo hello > $VH_OUTPUTS_DIR/hello.txt
+''')
+    with pytest.raises(SystemExit) as ei:
+        cli(['--directory', str(code_dir), '--output-root', str(outputs_dir), 'write'])
+    assert ei.value.code == 0
+    output_dir, = outputs_dir.listdir(lambda path: path.isdir())
+    entries = read_manifest(str(output_dir))
+    assert [(entry['path'], entry['sha256']) for entry in entries] == [
+        ('hello.txt', hashlib.sha256(b'hello\n').hexdigest()),
+    ]
+    metadata = json.loads(output_dir.join(EXECUTION_METADATA_JSON_NAME).read())
+    assert metadata['outputs'] == {'files': 1, 'size': 6, 'hashed': 1}
+    assert output_dir.join(OUTPUTS_MANIFEST_NAME).check(file=True)
@@ -0,0 +1,181 @@
+import threading
+import time
+from io import StringIO
+
+import pytest
+import valohai_yaml
+
+from valohai_local_run.cli import parameter_type_map, run_cli
+from valohai_local_run.configcache import StepTable
+from valohai_local_run.excs import BadUsage
+from valohai_local_run.pipeline import (
+    apply_arguments, find_outputs, get_dependencies, get_descendants, get_pipeline_nodes, run_pipeline, sort_nodes,
+)
+
+CONFIG = '''
+- step:
+    name: prepare
+    image: busybox
+    command: prepare
+    parameters:
+      - name: rows
+        type: integer
+        default: 10
+- step:
+    name: train
+    image: busybox
+    command: train {parameters}
+    inputs:
+      - name: data
+        default: http://example.com/default.csv
+    parameters:
+      - name: rows
+        type: integer
+        default: 1
+- pipeline:
+    name: training
+    nodes:
+      - {name: prepare-a, type: execution, step: prepare}
+      - {name: prepare-b, type: execution, step: prepare, override: {parameters: [{name: rows, default: 20}]}}
+      - {name: train, type: execution, step: train, edge-merge-mode: append}
+    edges:
+      - [prepare-a.output.*.csv, train.input.data]
+      - [prepare-b.output.b/*, train.input.data]
+      - [prepare-b.parameter.rows, train.parameter.rows]
+    parameters:
+      - {name: rows, target: prepare-a.parameter.rows, default: 5}
+'''
+
+
+def get_pipeline(config=CONFIG, name='training'):
+    step_table = StepTable.from_yaml(config)
+    return (step_table, step_table.get_pipeline(name))
+
+
+class FakeExecutor:
+    def __init__(self, node, inputs, parameters, output_dir, run):
+        self.step = node.step
+        self.inputs = inputs
+        self.parameters = parameters
+        self.output_dir = output_dir
+        self.execution_id = node.name
+        self.results = {}
+        self.run = run
+
+    def execute(self, **kwargs):
+        return self.run(self)
+
+
+def test_dependencies():
+    step_table, pipeline = get_pipeline()
+    dependencies = get_dependencies(pipeline)
+    assert dependencies == {'prepare-a': set(), 'prepare-b': set(), 'train': {'prepare-a', 'prepare-b'}}
+    assert sort_nodes(dependencies) == ['prepare-a', 'prepare-b', 'train']
+    assert get_descendants({'a': set(), 'b': {'a'}, 'c': {'b'}, 'd': set()}, 'a') == {'b', 'c'}
+    with pytest.raises(BadUsage):
+        sort_nodes({'a': {'b'}, 'b': {'a'}, 'c': set()})
+
+
+def test_unsupported_edges():
+    config = CONFIG.replace('[prepare-b.parameter.rows,', '[prepare-b.output.rows,')
+    step_table, pipeline = get_pipeline(config)
+    with pytest.raises(BadUsage):
+        get_dependencies(pipeline)
+
+
+def test_node_arguments():
+    step_table, pipeline = get_pipeline()
+    nodes = get_pipeline_nodes(pipeline, step_table, parameter_types=parameter_type_map)
+    assert nodes['prepare-a'].parameters == {'rows': 5}  # From the pipeline parameter
+    assert nodes['prepare-b'].parameters == {'rows': 20}  # From the override
+    apply_arguments(pipeline, nodes, parameters=['rows=7', 'train.rows=3'], inputs=['train.data=/extra.csv'])
+    assert nodes['prepare-a'].parameters == {'rows': 7}
+    assert nodes['train'].parameters == {'rows': 3}
+    assert nodes['train'].inputs == {'data': ['/extra.csv']}  # Replaces the default
+    with pytest.raises(BadUsage):
+        apply_arguments(pipeline, nodes, parameters=['train.rows=many'])
+    with pytest.raises(BadUsage):
+        apply_arguments(pipeline, nodes, inputs=['nope.data=/x'])
+
+
+def test_find_outputs(tmpdir):
+    tmpdir.join('a.csv').write('a')
+    tmpdir.join('b.txt').write('b')
+    tmpdir.mkdir('sub').join('c.csv').write('c')
+    tmpdir.join('valohai-stdout.log').write('log')
+    tmpdir.mkdir('valohai-metrics').join('loss.csv').write('index,time,value')
+    assert find_outputs(str(tmpdir), '*.csv') == [str(tmpdir.join('a.csv')), str(tmpdir.join('sub', 'c.csv'))]
+    assert find_outputs(str(tmpdir), 'sub/*') == [str(tmpdir.join('sub', 'c.csv'))]
+    assert find_outputs(str(tmpdir), '*.log') == []
+
+
+def test_run_pipeline(tmpdir):
+    step_table, pipeline = get_pipeline()
+    nodes = get_pipeline_nodes(pipeline, step_table)
+    running = set()
+    concurrent = []
+    lock = threading.Lock()
+
+    def run(executor):
+        with lock:
+            running.add(executor.execution_id)
+            concurrent.append(set(running))
+        output_dir = tmpdir.join(executor.execution_id)
+        if executor.execution_id == 'prepare-a':
+            output_dir.join('data.csv').write('a')
+        elif executor.execution_id == 'prepare-b':
+            output_dir.mkdir('b').join('data.bin').write('b')
+        time.sleep(0.1)
+        with lock:
+            running.discard(executor.execution_id)
+        return 0
+
+    executors = []
+
+    def build_executor(node, inputs, parameters):
+        executors.append(FakeExecutor(node, inputs, parameters, str(tmpdir.mkdir(node.name)), run))
+        return executors[-1]
+
+    assert run_pipeline(pipeline, nodes, build_executor, jobs=2) == {'prepare-a': 0, 'prepare-b': 0, 'train': 0}
+    assert {'prepare-a', 'prepare-b'} in concurrent  # Independent nodes ran at the same time
+    train = executors[-1]
+    assert train.parameters == {'rows': 20}
+    assert train.inputs == {'data': [  # Appended to the default; upstream outputs are used in place
+        'http://example.com/default.csv',
+        str(tmpdir.join('prepare-a', 'data.csv')),
+        str(tmpdir.join('prepare-b', 'b', 'data.bin')),
+    ]}
+
+
+@pytest.mark.parametrize('on_error, expected', [
+    ('stop-all', {'prepare-a': 1, 'prepare-b': None, 'train': None}),
+    ('stop-next', {'prepare-a': 1, 'prepare-b': 0, 'train': None}),
+    ('continue', {'prepare-a': 1, 'prepare-b': 0, 'train': 0}),
+])
+def test_run_pipeline_errors(tmpdir, on_error, expected):
+    config = CONFIG.replace('step: prepare}', 'step: prepare, on-error: %s}' % on_error, 1)
+    step_table, pipeline = get_pipeline(config)
+    nodes = get_pipeline_nodes(pipeline, step_table)
+
+    def build_executor(node, inputs, parameters):
+        run = (lambda executor: (1 if executor.execution_id == 'prepare-a' else 0))
+        return FakeExecutor(node, inputs, parameters, str(tmpdir.mkdir(node.name)), run)
+
+    assert run_pipeline(pipeline, nodes, build_executor, jobs=1) == expected
+
+
+@pytest.mark.parametrize('jobs', ['0', '-3'])
+def test_pipeline_cli_jobs(tmpdir, capsys, jobs):
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    with pytest.raises(SystemExit) as ei:
+        run_cli(['pipeline', 'training', '--directory', str(tmpdir), '--no-git', '--jobs', jobs])
+    assert ei.value.code == 2
+    assert 'expected a positive integer' in capsys.readouterr().err
+
+
+def test_step_table_pipelines():
+    step_table = StepTable.from_yaml(CONFIG)
+    assert list(step_table.pipelines) == ['training']
+    pipeline = step_table.get_pipeline('training')
+    config = valohai_yaml.parse(StringIO(CONFIG))
+    assert pipeline.serialize() == config.pipelines['training'].serialize()
@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+import threading
+
+from valohai_local_run.pool import ContainerPool
+
+FAKE_DOCKER = '''#!{python}
+import json, sys
+with open({log!r}, 'a') as outf:
+    outf.write(json.dumps(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'inspect':
+    print('false' if sys.argv[-1] in open({dead!r}).read() else 'true')
+'''
+
+
+def make_pool(tmpdir):
+    log_path = str(tmpdir.join('docker.log'))
+    dead_path = tmpdir.join('dead.txt')
+    dead_path.write('')
+    docker_path = tmpdir.join('docker')
+    docker_path.write(FAKE_DOCKER.format(python=sys.executable, log=log_path, dead=str(dead_path)))
+    os.chmod(str(docker_path), 0o755)
+    pool = ContainerPool(root=str(tmpdir.mkdir('pool')), docker_command=str(docker_path))
+
+    def get_calls():
+        with open(log_path) as infp:
+            return [json.loads(line) for line in infp]
+
+    return (pool, get_calls, dead_path)
+
+
+def test_pool_reuse(tmpdir):
+    pool, get_calls, dead_path = make_pool(tmpdir)
+    roots = [(str(tmpdir.mkdir('checkouts')), True), (str(tmpdir.mkdir('outputs')), False)]
+    container = pool.acquire('busybox', roots, run_args=['--cpus=1'])
+    (run_call,) = get_calls()
+    assert run_call[:2] == ['run', '--detach']
+    assert '--cpus=1' in run_call
+    assert '%s:/valohai-pool/0:ro' % os.path.realpath(roots[0][0]) in run_call
+    pool.release(container)
+
+    # The same configuration gets the same container; a different one gets a new one
+    assert pool.acquire('busybox', roots, run_args=['--cpus=1']).name == container.name
+    other = pool.acquire('busybox', roots, run_args=['--cpus=1'])
+    assert other.name != container.name
+    assert pool.acquire('busybox', roots[:1]).name not in (container.name, other.name)
+    assert sum(1 for call in get_calls() if call[0] == 'run') == 3
+
+    command = pool.build_exec_command(
+        container,
+        volumes=[{'source': os.path.join(roots[1][0], 'exec-1'), 'destination': '/valohai/outputs'}],
+        env_vars={'FOO': 'bar'},
+        command='echo hello',
+        workdir='/valohai/outputs',
+    )
+    assert command[2:7] == ['exec', '-i', '-e', 'FOO=bar', container.name]
+    assert 'ln -s /valohai-pool/1/exec-1 /valohai/outputs && cd /valohai/outputs && echo hello' in command[-1]
+
+
+def test_pool_health_and_idle(tmpdir):
+    pool, get_calls, dead_path = make_pool(tmpdir)
+    roots = [(str(tmpdir), False)]
+    container = pool.acquire('busybox', roots)
+    pool.release(container)
+    dead_path.write(container.name)  # The container has died; it gets replaced
+    replacement = pool.acquire('busybox', roots)
+    assert replacement.name != container.name
+    assert ['rm', '--force', container.name] in get_calls()
+    assert pool.gc(idle_timeout=0) == []  # Busy containers are kept
+    pool.release(replacement)
+    assert pool.gc(idle_timeout=0) == [replacement.name]
+    assert pool.entries() == []
+
+
+def test_pool_concurrent_acquire(tmpdir):
+    pool, get_calls, dead_path = make_pool(tmpdir)
+    containers = []
+    threads = [
+        threading.Thread(target=lambda: containers.append(pool.acquire('busybox', [(str(tmpdir), False)])))
+        for x in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({container.name for container in containers}) == 4
+
+
+def test_pool_output_slots(tmpdir):
+    pool, get_calls, dead_path = make_pool(tmpdir)
+    roots = [(str(tmpdir.mkdir('checkouts')), True)]
+    output_root = tmpdir.mkdir('outputs')
+    output_root.mkdir('other-execution').join('secret.txt').write('secret')
+    output_dir = str(output_root.mkdir('exec-1'))
+    container = pool.acquire('busybox', roots, output_root=str(output_root))
+    (run_call,) = get_calls()
+    # Only the container's slot in the output root is mounted, not the output root itself
+    assert '%s:/valohai-pool/1' % container.slot in run_call
+    assert not any(arg.startswith(os.path.realpath(str(output_root)) + ':') for arg in run_call)
+
+    pool.lend_output_dir(container, output_dir)
+    assert os.path.islink(output_dir)
+    with open(os.path.join(output_dir, 'result.txt'), 'w') as outf:
+        outf.write('42')
+    command = pool.build_exec_command(
+        container,
+        volumes=[{'source': output_dir, 'destination': '/valohai/outputs'}],
+        env_vars={},
+        command='true',
+        workdir='/valohai/outputs',
+    )
+    assert 'ln -s /valohai-pool/1/exec-1 /valohai/outputs' in command[-1]
+    pool.return_output_dir(container, output_dir)
+    assert not os.path.islink(output_dir)
+    assert os.listdir(output_dir) == ['result.txt'] and not os.listdir(container.slot)
+
+    # Output directories left behind by interrupted executions are moved back
+    output_dir = str(output_root.mkdir('exec-2'))
+    pool.lend_output_dir(container, output_dir)
+    pool.release(container)
+    assert pool.acquire('busybox', roots, output_root=str(output_root)).name == container.name
+    assert os.path.isdir(output_dir) and not os.path.islink(output_dir)
@@ -0,0 +1,137 @@
+import json
+import sys
+import threading
+import time
+
+import pytest
+from requests import HTTPError
+
+from valohai_local_run.cli import get_step_table, run_cli
+from valohai_local_run.dockerapi import PullCancelled
+from valohai_local_run.executor import LocalExecutor
+from valohai_local_run.prefetch import ensure_image, run_concurrently
+from valohai_local_run.profiling import Profiler
+
+FAKE_DOCKER = '''#!{python}
+import json, os, sys, time
+with open({log!r}, 'a') as outf:
+    outf.write(json.dumps(sys.argv[1:]) + '\\n')
+images = {images!r}
+if sys.argv[1:3] == ['image', 'inspect']:
+    sys.exit(0 if os.path.exists(images) and sys.argv[-1] in open(images).read().split() else 1)
+if sys.argv[1] == 'pull':
+    time.sleep({pull_time})
+    with open(images, 'a') as outf:
+        outf.write(sys.argv[-1] + '\\n')
+'''
+
+CONFIG = '''
+- step:
+    name: train
+    image: busybox
+    command: cat $VH_INPUTS_DIR/data/data.txt
+    inputs:
+      - name: data
+        default: {url}
+- step:
+    name: evaluate
+    image: python:3.7
+    command: 'true'
+'''
+
+
+@pytest.fixture
+def fake_docker(tmpdir):
+    log_path = tmpdir.join('docker.log')
+
+    def make(pull_time=0):
+        docker_path = tmpdir.join('docker')
+        docker_path.write(FAKE_DOCKER.format(
+            python=sys.executable,
+            log=str(log_path),
+            images=str(tmpdir.join('images.txt')),
+            pull_time=pull_time,
+        ))
+        docker_path.chmod(0o755)
+        return str(docker_path)
+
+    def get_calls():
+        if not log_path.exists():
+            return []
+        return [json.loads(line) for line in log_path.read().splitlines()]
+
+    return (make, get_calls)
+
+
+def test_run_concurrently():
+    cancel = threading.Event()
+    cancelled = []
+
+    def wait():
+        cancelled.append(cancel.wait(5))
+        raise RuntimeError('cancelled')
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError('oops')
+
+    profiler = Profiler()
+    with profiler.phase('prepare'), pytest.raises(ValueError):
+        run_concurrently({'wait': wait, 'fail': fail, 'ok': lambda: 1}, cancel, profiler=profiler)
+    assert cancelled == [True]
+    # The phases run in other threads still nest under the current one
+    assert {phase['name']: phase['depth'] for phase in profiler.get_phases()} == {
+        'prepare': 0, 'wait': 1, 'fail': 1, 'ok': 1,
+    }
+    assert run_concurrently({'a': lambda: 1, 'b': lambda: 2}, threading.Event()) == {'a': 1, 'b': 2}
+
+
+def test_ensure_image(fake_docker):
+    make, get_calls = fake_docker
+    docker = make()
+    assert ensure_image('busybox', docker) is True
+    assert ensure_image('busybox', docker) is False
+    assert [call[0] for call in get_calls()] == ['image', 'pull', 'image']
+
+    cancel = threading.Event()
+    cancel.set()
+    start = time.time()
+    with pytest.raises(PullCancelled):
+        ensure_image('python:3.7', make(pull_time=30), cancel=cancel)
+    assert time.time() - start < 5
+
+
+def test_failed_input_cancels_pull(tmpdir, fake_docker, file_server, temp_root):
+    make, get_calls = fake_docker
+    tmpdir.join('valohai.yaml').write(CONFIG.format(url=file_server.url + '/data.txt'))
+    executor = LocalExecutor(
+        project_id=None,
+        directory=str(tmpdir),
+        commit=None,
+        step=get_step_table(str(tmpdir), False, None).get_step('train'),
+        inputs={'data': file_server.url + '/missing.txt'},
+        parameters={},
+        output_root=str(tmpdir.join('outputs')),
+        docker_command=make(pull_time=30),
+        gitless=True,
+    )
+    start = time.time()
+    with pytest.raises(HTTPError):
+        executor.prepare(verbose=False)
+    assert time.time() - start < 5
+
+
+def test_prefetch_cli(tmpdir, fake_docker, file_server, temp_root):
+    make, get_calls = fake_docker
+    file_server.files['/data.txt'] = b'hello\n'
+    tmpdir.join('valohai.yaml').write(CONFIG.format(url=file_server.url + '/data.txt'))
+    argv = ['prefetch', '--directory', str(tmpdir), '--no-git', '--docker-command', make(), '--docker-backend', 'cli']
+    assert run_cli(argv) == 0
+    assert sorted(call[-1] for call in get_calls() if call[0] == 'pull') == ['busybox', 'python:3.7']
+    assert len(file_server.requests) == 1
+
+    # Everything is in place already
+    n_calls = len(get_calls())
+    assert run_cli(argv + ['train']) == 0
+    assert [call[0] for call in get_calls()[n_calls:]] == ['image']
+    assert len(file_server.requests) == 1
@@ -0,0 +1,31 @@
+import json
+import threading
+
+from valohai_local_run.profiling import Profiler
+
+
+def test_profiler(tmpdir):
+    profiler = Profiler()
+    with profiler.phase('prepare'):
+        with profiler.phase('download'):
+            threads = [threading.Thread(target=profiler.count, args=('download_bytes', 100)) for x in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    with profiler.phase('run'):
+        pass
+
+    data = profiler.as_dict()
+    phases = [(phase['name'], phase['depth']) for phase in data['phases']]
+    assert phases == [('prepare', 0), ('download', 1), ('run', 0)]
+    assert data['phases'][0]['duration'] >= data['phases'][1]['duration']
+    assert data['counters'] == {'download_bytes': 1000}
+    assert data['total'] >= sum(phase['duration'] for phase in data['phases'] if not phase['depth'])
+
+    trace_path = str(tmpdir.join('trace.json'))
+    profiler.write_chrome_trace(trace_path)
+    with open(trace_path) as infp:
+        events = json.load(infp)['traceEvents']
+    assert [event['name'] for event in events] == ['prepare', 'download', 'run', 'counters']
+    assert all(event['ph'] == 'X' for event in events[:3])
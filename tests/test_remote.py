@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+import pytest
+
+from valohai_local_run.cli import get_step_table, run_cli
+from valohai_local_run.consts import EXECUTION_METADATA_JSON_NAME, STDOUT_LOG_NAME
+from valohai_local_run.remote import RemoteExecutor, RemoteHost
+
+CONFIG = '''
+- step:
+    name: remote
+    image: busybox
+    command:
+      - cat $VH_REPOSITORY_DIR/hello.txt $VH_INPUTS_DIR/data/data.txt
+      - mkdir -p $VH_OUTPUTS_DIR/sub
+      - echo result > $VH_OUTPUTS_DIR/sub/result.txt
+    inputs:
+      - name: data
+'''
+
+
+@pytest.fixture
+def fake_ssh(tmpdir):
+    """An `ssh` that runs the command locally, logging the commands it's given."""
+    log = tmpdir.join('ssh.log')
+    ssh = tmpdir.join('ssh')
+    ssh.write('#!/bin/sh\necho "$2" >> %s\nexec sh -c "$2"\n' % log)
+    ssh.chmod(0o755)
+    return (str(ssh), log)
+
+
+def run_remote(tmpdir, fake_ssh):
+    ssh, log = fake_ssh
+    project = tmpdir.join('project')
+    argv = [
+        '--directory', str(project),
+        '--output-root', str(tmpdir.join('outputs')),
+        '--no-git',
+        '--remote', 'gpu-box',
+        '--ssh-command', ssh,
+        '--remote-root', str(tmpdir.join('remote')),
+        'remote',
+        '--data', str(tmpdir.join('data.txt')),
+    ]
+    outputs_dir = tmpdir.ensure_dir('outputs')
+    previous = set(outputs_dir.listdir(lambda path: path.isdir()))
+    assert run_cli(argv) == 0
+    output_dir, = set(outputs_dir.listdir(lambda path: path.isdir())) - previous
+    return (output_dir, json.loads(output_dir.join(EXECUTION_METADATA_JSON_NAME).read()))
+
+
+def test_remote_execution(tmpdir, fake_ssh):
+    project = tmpdir.mkdir('project')
+    project.join('valohai.yaml').write(CONFIG)
+    project.join('hello.txt').write('hello\n')
+    project.ensure('.git', 'HEAD').write('ref: refs/heads/master\n')  # Not sent, even without Git
+    tmpdir.join('data.txt').write('data\n')
+
+    output_dir, metadata = run_remote(tmpdir, fake_ssh)
+    assert output_dir.join(STDOUT_LOG_NAME).read() == 'hello\ndata\n'
+    assert output_dir.join('sub', 'result.txt').read() == 'result\n'
+    assert metadata['profile']['counters']['remote_objects_sent'] == 3  # The repository has valohai.yaml too
+    assert metadata['docker_command'][:2] == [fake_ssh[0], 'gpu-box']
+    assert 'rm --force valohai-local-%s' % os.path.basename(str(output_dir)) in fake_ssh[1].read()
+    # The execution directory is cleaned up, but the objects are kept for later executions
+    assert tmpdir.join('remote', 'executions').listdir() == []
+    objects = list(tmpdir.join('remote', 'objects').visit(lambda path: path.isfile()))
+    assert len(objects) == 3
+
+    # Objects no execution uses are removed once they're old enough, but reused objects are kept
+    for path in objects:
+        os.utime(str(path), (time.time() - 2 * 24 * 60 * 60,) * 2)
+    project.join('hello.txt').write('hello again\n')
+    output_dir, metadata = run_remote(tmpdir, fake_ssh)
+    assert output_dir.join(STDOUT_LOG_NAME).read() == 'hello again\ndata\n'
+    assert metadata['profile']['counters']['remote_objects_sent'] == 1
+    assert metadata['profile']['counters']['remote_objects_reused'] == 2
+    assert len(list(tmpdir.join('remote', 'objects').visit(lambda path: path.isfile()))) == 3
+
+
+def test_incremental_output_pull(tmpdir, fake_ssh):
+    ssh, log = fake_ssh
+    tmpdir.join('valohai.yaml').write(CONFIG)
+    executor = RemoteExecutor(
+        remote_host=RemoteHost('gpu-box', ssh_command=ssh, root=str(tmpdir.join('remote'))),
+        project_id=None,
+        directory=str(tmpdir),
+        commit=None,
+        step=get_step_table(str(tmpdir), False, None).get_step('remote'),
+        inputs={},
+        parameters={},
+        output_root=str(tmpdir.join('outputs')),
+        gitless=True,
+    )
+    remote_outputs = tmpdir.join('remote', 'executions', executor.execution_id, 'outputs')
+    remote_outputs.ensure('a.txt').write('a')
+    remote_outputs.ensure('b', 'c.txt').write('c')
+    os.makedirs(executor.output_dir)
+
+    def pull():
+        log.write('')
+        executor.pull_outputs()
+        return [line for line in log.read().splitlines() if 'tar -c' in line]
+
+    assert len(pull()) == 1
+    assert tmpdir.join('outputs', executor.execution_id, 'b', 'c.txt').read() == 'c'
+    assert pull() == []  # Nothing has changed
+    remote_outputs.join('a.txt').write('aa')
+    assert len(pull()) == 1
+    assert tmpdir.join('outputs', executor.execution_id, 'a.txt').read() == 'aa'
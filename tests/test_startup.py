@@ -0,0 +1,30 @@
+import re
+import subprocess
+import sys
+
+HEAVY_MODULES = ('click', 'requests', 'valohai_yaml', 'yaml')
+
+
+def test_cli_import_is_light():
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, valohai_local_run.cli; print("\\n".join(sorted(sys.modules)))',
+    ]).decode()
+    modules = output.splitlines()
+    assert 'valohai_local_run.cli' in modules
+    heavy = sorted(name for name in modules if name.split('.')[0] in HEAVY_MODULES)
+    assert not heavy, 'importing the CLI should not import %s' % ', '.join(heavy)
+
+
+def test_cli_import_time():
+    # `python -X importtime` lists every module imported, with its own and cumulative import time in microseconds
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import valohai_local_run.cli'],
+        stderr=subprocess.STDOUT,
+    ).decode()
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$', line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    assert times['valohai_local_run.cli'] < 500000  # Generous, to not be flaky on slow machines
@@ -0,0 +1,46 @@
+import pytest
+
+from valohai_local_run.cli import run_cli
+from valohai_local_run.excs import BadUsage
+from valohai_local_run.sweep import expand_parameter_sets, parse_parameter_values
+
+
+def test_parse_parameter_values():
+    assert parse_parameter_values(['1:10:3', '20'], int) == [1, 4, 7, 10, 20]
+    assert parse_parameter_values(['0.1:0.3:0.1'], float) == [0.1, 0.2, 0.3]
+    assert parse_parameter_values(['a:b:c'], None) == ['a:b:c']
+    assert parse_parameter_values(0.5, float) == [0.5]  # Defaults pass through
+    with pytest.raises(BadUsage):
+        parse_parameter_values(['1:10:-1'], int)
+    with pytest.raises(BadUsage):
+        parse_parameter_values(['x'], float)
+
+
+def test_expand_parameter_sets():
+    grid = expand_parameter_sets({'a': [1, 2, 3], 'b': ['x', 'y'], 'c': [True]})
+    assert len(grid) == 6
+    assert {'a': 3, 'b': 'y', 'c': True} in grid
+    sample = expand_parameter_sets({'a': list(range(100)), 'b': list(range(100))}, random_count=10, seed=42)
+    assert len(sample) == 10
+    assert len({(p['a'], p['b']) for p in sample}) == 10
+    assert sample == expand_parameter_sets({'a': list(range(100)), 'b': list(range(100))}, random_count=10, seed=42)
+    for random_count in (0, -1):
+        with pytest.raises(BadUsage):
+            expand_parameter_sets({'a': [1, 2]}, random_count=random_count)
+    with pytest.raises(BadUsage):
+        expand_parameter_sets({'a': [1, 2], 'b': []})
+
+
+def test_sweep_cli_counts(tmpdir, capsys):
+    tmpdir.join('valohai.yaml').write('''
+- step:
+    name: train
+    image: busybox
+    command: 'true'
+''')
+    for option in ('--random', '--jobs'):
+        for value in ('0', '-3', 'x'):
+            with pytest.raises(SystemExit) as ei:
+                run_cli(['sweep', 'train', '--directory', str(tmpdir), '--no-git', option, value])
+            assert ei.value.code == 2
+            assert 'expected a positive integer' in capsys.readouterr().err
@@ -0,0 +1,31 @@
+import io
+import sys
+
+from valohai_local_run.tee import tee_spawn
+
+# Writes a lot of output into both streams and exits immediately, leaving data in the pipes
+WRITER = '''
+import os
+for i in range(40):
+    os.write(1, b"o" * 131072)
+    os.write(2, b"e" * 65536)
+'''
+
+
+class BrokenFile:
+    def write(self, data):
+        raise IOError('Nope')
+
+
+def test_tee_spawn_drains_output():
+    stdout, stderr, stdout_copy = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    broken = BrokenFile()
+    proc = tee_spawn(
+        [sys.executable, '-c', WRITER],
+        stdout_files=(broken, stdout, stdout_copy),
+        stderr_files=(stderr,),
+    )
+    assert proc.returncode == 0
+    assert stdout.getvalue() == stdout_copy.getvalue() == b'o' * 131072 * 40
+    assert stderr.getvalue() == b'e' * 65536 * 40
+    assert [file for (file, exc) in proc.tee_errors] == [broken]
@@ -0,0 +1,137 @@
+import csv
+import json
+import time
+
+import pytest
+
+from valohai_local_run import telemetry
+from valohai_local_run.cli import cli
+from valohai_local_run.consts import EXECUTION_METADATA_JSON_NAME, TELEMETRY_CSV_NAME
+from valohai_local_run.telemetry import (
+    CgroupSource, TelemetrySampler, parse_api_stats, parse_docker_size, parse_docker_stats, stream_docker_stats,
+)
+
+
+def test_cgroup_source(tmpdir):
+    tmpdir.join('cgroup.controllers').write('cpu io memory')
+    cgroup = tmpdir.mkdir('system.slice').mkdir('docker-abc.scope')
+    cgroup.join('cpu.stat').write('usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n')
+    cgroup.join('memory.current').write('1048576\n')
+    cgroup.join('io.stat').write('8:0 rbytes=1000 wbytes=200 rios=1 wios=1\n8:16 rbytes=24 wbytes=0 rios=1 wios=0\n')
+    cgroup.join('cgroup.procs').write('1234\n')
+    tmpdir.mkdir('proc').mkdir('1234').mkdir('net').join('dev').write(
+        'Inter-|   Receive                            |  Transmit\n'
+        ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets ...\n'
+        '    lo:     100       1    0    0    0     0          0         0      100       1    0    0    0     0 0 0\n'
+        '  eth0:    5000      10    0    0    0     0          0         0      300       3    0    0    0     0 0 0\n'
+    )
+    assert not CgroupSource.find('def', root=str(tmpdir))
+    source = CgroupSource.find('abc', root=str(tmpdir))
+    source.proc_root = str(tmpdir.join('proc'))
+    assert source.read() == {
+        'cpu_time': 2.5,
+        'memory': 1048576,
+        'io_read': 1024,
+        'io_write': 200,
+        'net_rx': 5000,
+        'net_tx': 300,
+    }
+    assert not CgroupSource.find('abc', root=str(cgroup))  # Not a cgroup v2 root
+
+
+def test_parse_stats():
+    assert parse_docker_size('1.5MiB') == 1572864
+    assert parse_docker_size('3.2kB') == 3200
+    assert parse_docker_stats({
+        'CPUPerc': '150.00%',
+        'MemUsage': '1.5MiB / 7.7GiB',
+        'BlockIO': '4.1MB / 0B',
+        'NetIO': '648B / 1kB',
+    }) == {'cpu': 1.5, 'memory': 1572864, 'io_read': 4100000, 'io_write': 0, 'net_rx': 648, 'net_tx': 1000}
+    assert parse_api_stats({
+        'cpu_stats': {'cpu_usage': {'total_usage': 3000000000}},
+        'memory_stats': {'usage': 2048},
+        'blkio_stats': {'io_service_bytes_recursive': [{'op': 'Read', 'value': 10}, {'op': 'Write', 'value': 5}]},
+        'networks': {'eth0': {'rx_bytes': 7, 'tx_bytes': 3}},
+    }) == {'cpu_time': 3.0, 'memory': 2048, 'io_read': 10, 'io_write': 5, 'net_rx': 7, 'net_tx': 3}
+
+
+def test_stream_docker_stats(tmpdir):
+    docker = tmpdir.join('docker')
+    docker.write('''#!/bin/sh
+printf '\\033[2J\\033[H{"CPUPerc": "50%%", "MemUsage": "1kB / 2GB"}\\n'
+exec sleep 10
+''')
+    docker.chmod(0o755)
+    source = stream_docker_stats('abc', docker_command=str(docker))
+    try:
+        for attempt in range(100):
+            if source.read():
+                break
+            time.sleep(0.05)
+        assert source.read() == {'cpu': 0.5, 'memory': 1000}
+    finally:
+        source.close()
+
+
+class FakeSource:
+    name = 'fake'
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.n_reads = 0
+
+    def read(self):
+        end_time = time.thread_time() + self.delay
+        while time.thread_time() < end_time:  # Burn CPU time; sleeping doesn't count as overhead
+            pass
+        self.n_reads += 1
+        return {'cpu_time': self.n_reads * 0.01, 'memory': 100 * self.n_reads, 'io_read': 10 * self.n_reads}
+
+
+def test_sampler(tmpdir):
+    with TelemetrySampler(str(tmpdir), get_source=FakeSource, interval=0.02) as sampler:
+        time.sleep(0.3)
+    with tmpdir.join(TELEMETRY_CSV_NAME).open() as infp:
+        rows = list(csv.DictReader(infp))
+    n_samples = len(rows)
+    assert n_samples > 5
+    assert rows[0]['cpu'] == ''  # Needs two samples of the CPU time
+    assert float(rows[1]['cpu']) > 0
+    summary = sampler.summary()
+    assert summary['source'] == 'fake'
+    assert summary['samples'] == n_samples
+    assert summary['memory'] == {'peak': 100 * n_samples, 'mean': 50 * (n_samples + 1)}
+    assert summary['io_read'] == {'total': 10 * n_samples}
+    assert summary['overhead']['fraction'] < telemetry.MAX_OVERHEAD
+    json.dumps(summary)
+
+
+def test_sampler_overhead_is_bounded(tmpdir):
+    # Each sample takes 10 ms of CPU time, so spending at most 2% of the time sampling leaves room for two samples
+    # a second, instead of the hundred asked for
+    with TelemetrySampler(str(tmpdir), get_source=(lambda: FakeSource(delay=0.01)), interval=0.01) as sampler:
+        time.sleep(1.2)
+    summary = sampler.summary()
+    assert 2 <= summary['samples'] <= 3
+    elapsed = sampler.end_time - sampler.start_time
+    # The bound can only be exceeded by the latest sample
+    assert summary['overhead']['seconds'] <= telemetry.MAX_OVERHEAD * elapsed + 0.011
+
+
+def test_execution_telemetry(tmpdir):
+    code_dir = tmpdir.mkdir('code')
+    outputs_dir = tmpdir.mkdir('outputs')
+    code_dir.join('valohai.yaml').write('''
+- step:
+    name: nap
+    image: busybox
+    command: sleep 0.2
+''')
+    with pytest.raises(SystemExit) as ei:
+        cli(['--directory', str(code_dir), '--output-root', str(outputs_dir), '--telemetry', 'nap'])
+    assert ei.value.code == 0
+    output_dir, = outputs_dir.listdir(lambda path: path.isdir())
+    telemetry = json.loads(output_dir.join(EXECUTION_METADATA_JSON_NAME).read())['telemetry']
+    assert telemetry['interval'] == 1.0
+    assert output_dir.join(TELEMETRY_CSV_NAME).read().startswith('time,cpu,memory')
@@ -54,8 +54,8 @@ def test_valohai_local_run(tmpdir, capsys):
 
     out, err = capsys.readouterr()
 
-    # Find the execution ID by looking at the hopefully only directory in the base path
-    output_dir_basename = first(os.listdir(str(outputs_dir)))
+    # Find the execution ID by looking at the hopefully only directory in the base path (next to the history index)
+    output_dir_basename = first(name for name in os.listdir(str(outputs_dir)) if not name.startswith('.'))
     # Ensure it was printed for the user too
     assert output_dir_basename in out
 
@@ -74,6 +74,7 @@ def test_valohai_local_run(tmpdir, capsys):
             'floaty': 17.3,
             'inty': -7,
         }
+        assert '--rm' in meta['docker_command']  # The container doesn't outlive the execution
 
     # Check stdout and stderr gets saved and teed
 
@@ -84,3 +85,36 @@ def test_valohai_local_run(tmpdir, capsys):
         assert stdout_cookie in s
     for s in (err_data, err):
         assert stderr_cookie in s
+
+
+def test_step_named_like_subcommand(tmpdir, capsys, monkeypatch):
+    tmpdir.join('valohai.yaml').write('''
+- step:
+    name: cache
+    image: busybox
+    command: 'true'
+    parameters:
+      - name: warm
+        type: integer
+        default: 1
+''')
+    with pytest.raises(SystemExit):
+        cli(['cache', '--directory', str(tmpdir), '--no-git', '--help'])
+    assert 'parameters for "cache"' in capsys.readouterr().out
+
+    # Without such a step, the subcommand is run
+    monkeypatch.chdir(str(tmpdir.mkdir('other')))
+    with pytest.raises(SystemExit):
+        cli(['cache', '--help'])
+    assert 'prune' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('argument', ['--memory=lots', '--cpus=0', '--cpus=-1'])
+def test_bad_limits(tmpdir, capsys, argument):
+    tmpdir.join('valohai.yaml').write('[{"step": {"name": "train", "image": "busybox", "command": "true"}}]')
+    output_root = tmpdir.join('outputs')
+    with pytest.raises(SystemExit) as ei:
+        cli(['--directory', str(tmpdir), '--no-git', '--output-root', str(output_root), argument, 'train'])
+    assert ei.value.code == 2
+    assert 'error: argument --' in capsys.readouterr().err
+    assert not output_root.exists()  # Nothing was done before the error
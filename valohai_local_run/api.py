@@ -0,0 +1,206 @@
+"""
+An asyncio API for running executions from within another program, e.g. a service running dozens of
+executions at a time from a single event loop:
+
+    execution = await run_execution('train', directory='/path/to/project', parameters={'learning-rate': 0.1})
+    async for line in execution.stdout:
+        ...
+    exit_code = await execution
+
+Executions run on threads of their own, print nothing and leave the process state (such as the umask and
+the working directory) alone.
+"""
+import asyncio
+import os
+import threading
+
+from .cli import get_step_table, resolve_commit
+from .consts import DEFAULT_OUTPUT_ROOT
+from .excs import BadUsage
+from .utils import match_step
+
+
+class LogStream:
+    """
+    An asynchronous iterator over the lines of an output stream of an execution, as they are written.
+
+    Data is written in from the thread running the execution, and buffered until it's read.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.buffer = b''
+        self.eof = False
+
+    def write(self, data):  # Called by the thread running the execution
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, bytes(data))
+        return len(data)
+
+    def close(self):  # Ditto
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while b'\n' not in self.buffer and not self.eof:
+            data = await self.queue.get()
+            if data is None:
+                self.eof = True
+            else:
+                self.buffer += data
+        if not self.buffer:
+            raise StopAsyncIteration
+        line, newline, self.buffer = self.buffer.partition(b'\n')
+        return line + newline
+
+    async def read(self):
+        """
+        Read the rest of the stream, until the execution finishes.
+        """
+        lines = []
+        async for line in self:
+            lines.append(line)
+        return b''.join(lines)
+
+
+class Execution:
+    """
+    A handle to an execution started with `run_execution()`.
+
+    Await the handle (or its `exit_code` future) for the exit code of the execution.
+    `stdout` and `stderr` are `LogStream`s of its output (unless disabled with `stream_logs=False`).
+    `results` has the results recorded into the metadata file (such as `metrics`), once the execution finishes.
+    """
+
+    def __init__(self, executor, exit_code, stdout=None, stderr=None):
+        self.executor = executor
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def execution_id(self):
+        return self.executor.execution_id
+
+    @property
+    def output_dir(self):
+        return self.executor.output_dir
+
+    @property
+    def results(self):
+        return self.executor.results
+
+    def __await__(self):
+        return asyncio.shield(self.exit_code).__await__()
+
+
+def resolve_step(directory, step_name, commit=None, use_git=True):
+    """
+    Resolve the commit and the step to run, like the command line does.
+
+    :return: Tuple of (commit, has_git, step)
+    """
+    has_git = (use_git and os.path.isdir(os.path.join(directory, '.git')))
+    commit = resolve_commit(directory, has_git, commit)
+    step_table = get_step_table(directory, has_git, commit)
+    return (commit, has_git, step_table.get_step(match_step(step_table, step_name)))
+
+
+def get_arguments(step, inputs, parameters):
+    """
+    Fill in the defaults of the step for the inputs and parameters not given.
+
+    :raises BadUsage: if a required input or parameter is missing, or an unknown one is given
+    """
+    for kind, given, known in (('input', inputs, step.inputs), ('parameter', parameters, step.parameters)):
+        unknown = sorted(set(given) - set(known))
+        if unknown:
+            raise BadUsage('Unknown {}(s) for step "{}": {}'.format(kind, step.name, ', '.join(unknown)))
+        for name, obj in known.items():
+            if given.get(name) is None and obj.default is None and not obj.optional:
+                raise BadUsage('The {} "{}" is required'.format(kind, name))
+    return (
+        {name: (inputs.get(name) or input.default) for (name, input) in step.inputs.items()},
+        {
+            name: (parameters[name] if parameters.get(name) is not None else parameter.default)
+            for (name, parameter) in step.parameters.items()
+        },
+    )
+
+
+async def run_execution(
+    step,
+    directory=None,
+    inputs=None,
+    parameters=None,
+    commit=None,
+    use_git=True,
+    output_root=DEFAULT_OUTPUT_ROOT,
+    stream_logs=True,
+    save_logs=True,
+    **executor_kwargs
+):
+    """
+    Start running an execution of a step in the `valohai.yaml` of the project in `directory`.
+
+    Returns once the execution has been started (but not prepared); await the returned `Execution`
+    for its exit code.
+
+    :param step: Name of the step (or a prefix of one)
+    :param inputs: Dict of input name -> URL or path, or a list of them
+    :param parameters: Dict of parameter name -> value
+    :param use_git: Whether to run the commit (by default, the HEAD) of the project's Git repository,
+                    rather than the working directory
+    :param stream_logs: Whether to make the output of the execution available as `Execution.stdout` and
+                        `Execution.stderr`; output that's not read is buffered in memory
+    :param executor_kwargs: Other arguments to `LocalExecutor`, such as `cpus` or `image`
+    :raises BadUsage: if the step or its arguments are invalid
+    """
+    from .executor import LocalExecutor
+    loop = asyncio.get_event_loop()
+    directory = os.path.abspath(directory or os.getcwd())
+    commit, has_git, step = await loop.run_in_executor(None, resolve_step, directory, step, commit, use_git)
+    inputs, parameters = get_arguments(step, (inputs or {}), (parameters or {}))
+    executor = LocalExecutor(
+        project_id=None,
+        directory=directory,
+        commit=commit,
+        step=step,
+        inputs=inputs,
+        parameters=parameters,
+        output_root=os.path.realpath(output_root),
+        gitless=(not has_git),
+        **executor_kwargs
+    )
+    streams = ({'stdout': LogStream(loop), 'stderr': LogStream(loop)} if stream_logs else {})
+    exit_code = loop.create_future()
+
+    def set_result(future, ret, exc):
+        if future.cancelled():
+            return
+        if exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(ret)
+
+    def run():
+        ret = exc = None
+        try:
+            ret = executor.execute(
+                verbose=False,
+                save_logs=save_logs,
+                tee_output=False,
+                output_files={name: [stream] for (name, stream) in streams.items()},
+            )
+        except Exception as e:
+            exc = e
+        finally:
+            for stream in streams.values():
+                stream.close()
+        loop.call_soon_threadsafe(set_result, exit_code, ret, exc)
+
+    # A thread of its own rather than the loop's executor, which would limit the number of concurrent executions
+    threading.Thread(target=run, name='execution-{}'.format(executor.execution_id), daemon=True).start()
+    return Execution(executor, exit_code, stdout=streams.get('stdout'), stderr=streams.get('stderr'))
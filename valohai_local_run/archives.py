@@ -0,0 +1,278 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from .checkout import get_live_leases
+from .consts import DEFAULT_CHECKOUT_MAX_AGE
+from .utils import ensure_makedirs, get_random_string, hash_file
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_SUFFIXES = ('.zip',)
+SOURCES_NAME = 'sources.json'
+
+# Python versions with extraction filters also strip special permission bits and refuse device files
+extract_kwargs = ({'filter': 'data'} if hasattr(tarfile, 'data_filter') else {})
+
+
+def get_archive_type(filename):
+    """
+    :return: 'tar' or 'zip' if the file (or URL) is named like an archive of that kind, None otherwise
+    """
+    name = posixpath.basename(filename.split('?')[0]).lower()
+    if name.endswith(TAR_SUFFIXES):
+        return 'tar'
+    if name.endswith(ZIP_SUFFIXES):
+        return 'zip'
+    return None
+
+
+def get_archive_stem(filename):
+    name = posixpath.basename(filename.split('?')[0])
+    for suffix in TAR_SUFFIXES + ZIP_SUFFIXES:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def check_member_path(root, name):
+    """
+    :raises ValueError: if the archive member `name` would end up outside `root` (e.g. `../../etc/passwd`),
+                        including by way of symlinks extracted earlier
+    """
+    path = os.path.realpath(os.path.join(root, name))
+    if path != root and not path.startswith(root + os.sep):
+        raise ValueError('Archive member {} points outside the extraction directory'.format(name))
+
+
+def extract_tar(fileobj, dest, stream=True):
+    """
+    Extract a (possibly compressed) tar archive into `dest`, refusing members that would escape it.
+
+    :param stream: Whether `fileobj` can only be read sequentially (e.g. it's a download in progress)
+    """
+    dest = os.path.realpath(dest)
+    with tarfile.open(fileobj=fileobj, mode=('r|*' if stream else 'r:*')) as tar:
+        for member in tar:
+            check_member_path(dest, member.name)
+            if member.issym():
+                check_member_path(dest, posixpath.join(posixpath.dirname(member.name), member.linkname))
+            elif member.islnk():
+                check_member_path(dest, member.linkname)
+            elif not (member.isfile() or member.isdir()):  # Devices and FIFOs make no sense as inputs
+                continue
+            tar.extract(member, dest, **extract_kwargs)
+
+
+def extract_zip(path, dest):
+    dest = os.path.realpath(dest)
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            check_member_path(dest, info.filename)
+            zf.extract(info, dest)
+
+
+class HashingReader:
+    """
+    A file-like object reading from an iterable of chunks (e.g. a download in progress), hashing the data as it goes.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.hasher.update(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def hexdigest(self):
+        """
+        Read the rest of the data (e.g. padding after the end of a tar archive), and return its digest.
+        """
+        while self.read(1048576):
+            pass
+        return self.hasher.hexdigest()
+
+
+class ExtractionCache:
+    """
+    A cache of the trees extracted from archive inputs, by the SHA256 digest of the archive.
+
+    Layout of the cache directory (`extracted` in the download cache directory, by default):
+
+    * `<sha256>/`: the contents of an archive
+    * `<sha256>.leases/<lease id>`: a file per execution using the tree, containing its PID
+    * `sources.json`: the digest of the archive last seen at each URL or local path, with the validators
+      (e.g. the ETag, or the size and modification time of a local file) to tell whether it has changed since
+
+    Identical archives share a tree, however many URLs or paths they're found at.
+    Trees without live leases that have not been used in `max_age` seconds are removed by `gc()`.
+
+    :param lease_id: If set, the trees looked up are leased with this ID until `release()` is called with it
+    """
+
+    def __init__(self, root=None, max_age=DEFAULT_CHECKOUT_MAX_AGE, lease_id=None):
+        if not root:
+            from .cache import DownloadCache
+            root = os.path.join(DownloadCache().root, 'extracted')
+        self.root = root
+        self.max_age = max_age
+        self.lease_id = lease_id
+        ensure_makedirs(self.root, 0o770)
+
+    def get_path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def lookup(self, source, validators=None):
+        """
+        Look up the tree extracted from an archive at a URL or local path, marking it used.
+
+        :param validators: Dict of validators the archive must still match, if known
+        :return: Path of the tree, or None
+        """
+        with self._locked_sources() as sources:
+            entry = sources.get(source)
+            if not entry or (validators is not None and entry['validators'] != validators):
+                return None
+            path = self.get_path(entry['sha256'])
+            if not os.path.isdir(path):
+                del sources[source]
+                return None
+            if self.lease_id:  # While the sources are locked, so `gc()` can't remove the tree before it's leased
+                ensure_makedirs(path + '.leases', 0o770)
+                with open(os.path.join(path + '.leases', self.lease_id), 'w') as outf:
+                    outf.write(str(os.getpid()))
+        os.utime(path)
+        return path
+
+    def release(self, lease_id):
+        for digest in self.list_digests():
+            try:
+                os.unlink(os.path.join(self.get_path(digest) + '.leases', lease_id))
+            except FileNotFoundError:
+                pass
+
+    def get_validators(self, source):
+        with self._locked_sources() as sources:
+            return dict(sources.get(source, {}).get('validators') or {})
+
+    def extract_stream(self, source, chunks, validators=None):
+        """
+        Extract a tar archive as it's being read, e.g. while it's downloaded, without storing the archive itself.
+
+        :param chunks: Iterable of chunks of the archive
+        :return: Path of the tree
+        """
+        reader = HashingReader(chunks)
+        return self._extract(source, lambda dest: extract_tar(reader, dest), reader.hexdigest, validators)
+
+    def extract_file(self, path, archive_type=None, source=None):
+        """
+        Extract an archive file, unless an identical one has been extracted before.
+
+        :param source: URL the file was downloaded from, if any; local files are looked up by path,
+                       and re-extracted if their size or modification time changes
+        :return: Path of the tree
+        """
+        stat = os.stat(path)
+        validators = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        source = (source or os.path.realpath(path))
+        tree_path = self.lookup(source, validators)
+        if tree_path:
+            return tree_path
+        digest = hash_file(path)
+        if os.path.isdir(self.get_path(digest)):
+            self._record(source, digest, validators)
+            return self.lookup(source)
+
+        def extract(dest):
+            if (archive_type or get_archive_type(path)) == 'zip':
+                extract_zip(path, dest)
+            else:
+                with open(path, 'rb') as infp:
+                    extract_tar(infp, dest, stream=False)
+
+        return self._extract(source, extract, lambda: digest, validators)
+
+    def gc(self, max_age=None):
+        """
+        Remove trees that have no live leases and have not been used in `max_age` seconds.
+
+        :return: List of digests of the removed trees.
+        """
+        max_age = (self.max_age if max_age is None else max_age)
+        removed = []
+        with self._locked_sources() as sources:
+            for digest in self.list_digests():
+                path = self.get_path(digest)
+                if get_live_leases(path + '.leases'):
+                    continue
+                if time.time() - os.stat(path).st_mtime >= max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+                    shutil.rmtree(path + '.leases', ignore_errors=True)
+                    removed.append(digest)
+            for source in [source for (source, entry) in sources.items() if entry['sha256'] in removed]:
+                del sources[source]
+        return removed
+
+    def list_digests(self):
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith('.') and not name.endswith('.leases') and
+            os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def _extract(self, source, extract, get_digest, validators):
+        temp_path = os.path.join(self.root, '.extract-{}'.format(get_random_string(12)))
+        os.mkdir(temp_path)
+        try:
+            extract(temp_path)
+            digest = get_digest()
+            try:
+                os.rename(temp_path, self.get_path(digest))
+            except OSError:  # Someone else extracted an identical archive in the meanwhile
+                if not os.path.isdir(self.get_path(digest)):
+                    raise
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._record(source, digest, validators)
+        return self.lookup(source)
+
+    def _record(self, source, digest, validators):
+        with self._locked_sources() as sources:
+            sources[source] = {'sha256': digest, 'validators': (validators or {})}
+
+    @contextlib.contextmanager
+    def _locked_sources(self):
+        with open(os.path.join(self.root, '.sources.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(os.path.join(self.root, SOURCES_NAME), 'r') as infp:
+                        sources = json.load(infp)
+                except (IOError, ValueError):
+                    sources = {}
+                yield sources
+                fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.sources-')
+                with os.fdopen(fd, 'w') as outf:
+                    json.dump(sources, outf, sort_keys=True)
+                os.rename(temp_path, os.path.join(self.root, SOURCES_NAME))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
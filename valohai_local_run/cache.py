@@ -0,0 +1,279 @@
+import argparse
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from click import echo, secho, style
+
+from .checkout import CheckoutCache
+from .configcache import ConfigCache
+from .consts import CACHE_DIR_ENV, CACHE_LIMIT_ENV, DEFAULT_CACHE_SIZE_LIMIT, DEFAULT_CHECKOUT_MAX_AGE
+from .utils import ensure_makedirs, format_size, hash_file, parse_size
+
+INDEX_NAME = 'index.json'
+LOCK_NAME = 'index.lock'
+
+
+def get_cache_key(url):
+    # Query strings (e.g. signatures of pre-signed URLs) are not part of the identity of a file
+    if '?' in url:
+        url = url[:url.index('?')]
+    return url
+
+
+class DownloadCache:
+    """
+    A size-bounded cache of downloaded files.
+
+    The cache directory contains the downloaded files and an `index.json` file mapping cache keys
+    to metadata (source URL, size, SHA256 digest, HTTP validators and last use time).
+    Files are only ever added to the cache by atomically renaming a completed download into place,
+    and the least recently used files are evicted once the total size exceeds `size_limit` bytes.
+
+    The index is guarded by an advisory lock, so a cache may be shared by concurrent processes.
+    """
+
+    def __init__(self, root=None, size_limit=None):
+        self.root = (
+            root or
+            os.environ.get(CACHE_DIR_ENV) or
+            os.path.join(tempfile.gettempdir(), 'valohai-local-run-cache')
+        )
+        if size_limit is None:
+            size_limit = parse_size(os.environ.get(CACHE_LIMIT_ENV) or DEFAULT_CACHE_SIZE_LIMIT)
+        self.size_limit = size_limit
+        ensure_makedirs(self.root, 0o770)
+
+    def get_filename(self, key):
+        _, ext = os.path.splitext(key)
+        return 'download-%s%s' % (hashlib.sha1(key.encode('utf-8')).hexdigest(), ext)
+
+    def get_path(self, key):
+        return os.path.join(self.root, self.get_filename(key))
+
+    def get_partial_path(self, key):
+        return self.get_path(key) + '.part'
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        with open(os.path.join(self.root, LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.root, INDEX_NAME), 'r') as infp:
+                return json.load(infp)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.index-')
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(index, outf, sort_keys=True)
+        os.rename(temp_path, os.path.join(self.root, INDEX_NAME))
+
+    def lookup(self, key):
+        """
+        Look up a cache entry, marking it used.
+
+        Entries whose files have gone missing or no longer match their recorded size and digest
+        are evicted.
+
+        :return: A copy of the entry dict, or None.
+        """
+        with self.locked_index() as index:
+            entry = index.get(key)
+            if not entry:
+                return None
+            if not self._check_entry(entry):
+                self._remove(index, key)
+                return None
+            entry['last_used'] = time.time()
+            return dict(entry)
+
+    def store(self, key, partial_path, url, sha256, etag=None, last_modified=None, keep=()):
+        """
+        Atomically move a completely downloaded file into the cache, then evict files over the size limit.
+
+        :param keep: Keys that must not be evicted (e.g. other inputs of the same execution).
+        :return: Path of the cached file.
+        """
+        path = self.get_path(key)
+        with self.locked_index() as index:
+            os.rename(partial_path, path)
+            stat = os.stat(path)
+            index[key] = {
+                'url': url,
+                'filename': os.path.basename(path),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': sha256,
+                'etag': etag,
+                'last_modified': last_modified,
+                'created': time.time(),
+                'last_used': time.time(),
+            }
+            self._evict(index, self.size_limit, keep=set(keep) | {key})
+        return path
+
+    def entries(self):
+        with self.locked_index() as index:
+            return sorted(index.items(), key=lambda pair: pair[1]['last_used'], reverse=True)
+
+    def prune(self, limit=None):
+        """
+        Evict least recently used files until the cache is within `limit` bytes (default: the size limit),
+        and remove stray files not tracked by the index.
+
+        :return: List of evicted (key, entry) pairs.
+        """
+        with self.locked_index() as index:
+            evicted = self._evict(index, (self.size_limit if limit is None else limit))
+            self._remove_strays(index)
+        return evicted
+
+    def verify(self):
+        """
+        Re-hash every cached file, evicting the ones that don't match their recorded digest.
+
+        :return: List of evicted (key, entry) pairs.
+        """
+        with self.locked_index() as index:
+            corrupt = [(key, entry) for (key, entry) in index.items() if not self._check_entry(entry, full=True)]
+            for key, entry in corrupt:
+                self._remove(index, key)
+        return corrupt
+
+    def stats(self):
+        with self.locked_index() as index:
+            partial_size = sum(
+                os.path.getsize(os.path.join(self.root, name))
+                for name in os.listdir(self.root)
+                if name.endswith('.part')
+            )
+            return {
+                'root': self.root,
+                'entries': len(index),
+                'size': sum(entry['size'] for entry in index.values()),
+                'size_limit': self.size_limit,
+                'partial_size': partial_size,
+            }
+
+    def _check_entry(self, entry, full=False):
+        path = os.path.join(self.root, entry['filename'])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        # The digest is only recomputed if the file appears to have been touched since it was stored
+        if full or stat.st_mtime != entry['mtime']:
+            if hash_file(path) != entry['sha256']:
+                return False
+            entry['mtime'] = stat.st_mtime
+        return True
+
+    def _evict(self, index, limit, keep=()):
+        total = sum(entry['size'] for entry in index.values())
+        evicted = []
+        for key, entry in sorted(index.items(), key=lambda pair: pair[1]['last_used']):
+            if total <= limit:
+                break
+            if key in keep:
+                continue
+            total -= entry['size']
+            self._remove(index, key)
+            evicted.append((key, entry))
+        return evicted
+
+    def _remove(self, index, key):
+        entry = index.pop(key)
+        try:
+            os.unlink(os.path.join(self.root, entry['filename']))
+        except FileNotFoundError:
+            pass
+
+    def _remove_strays(self, index):
+        known = {entry['filename'] for entry in index.values()}
+        for name in os.listdir(self.root):
+            if name.startswith('download-') and not name.endswith(('.part', '.part.json', '.part.lock')) and \
+                    name not in known:
+                os.unlink(os.path.join(self.root, name))
+
+
+def cache_cli(argv):
+    ap = argparse.ArgumentParser(prog='valohai-local-run cache', description='Manage the input download cache.')
+    subparsers = ap.add_subparsers(dest='action', metavar='action')
+    subparsers.add_parser('list', help='List cached files, most recently used first')
+    subparsers.add_parser('stats', help='Show cache statistics')
+    subparsers.add_parser('verify', help='Re-hash cached files and evict corrupted ones')
+    prune_ap = subparsers.add_parser('prune', help='Evict least recently used files')
+    prune_ap.add_argument('--limit', type=parse_size, default=None, metavar='SIZE',
+        help='Size to prune the cache down to (e.g. 500M; defaults to the configured limit)')
+    prune_ap.add_argument('--all', action='store_const', const=0, dest='limit', help='Empty the cache entirely')
+    args = ap.parse_args(argv)
+    cache = DownloadCache()
+    from .archives import ExtractionCache
+    from .inputs import InputStore  # Avoid a circular import (inputs -> download -> cache)
+    from .lazyfs import BlockCache
+    checkout_cache = CheckoutCache()
+    input_store = InputStore()
+    extraction_cache = ExtractionCache(os.path.join(cache.root, 'extracted'))
+    block_cache = BlockCache(os.path.join(cache.root, 'blocks'))
+
+    if args.action == 'list':
+        for key, entry in cache.entries():
+            echo('{size:>12}  {last_used}  {url}'.format(
+                size=format_size(entry['size']),
+                last_used=datetime.datetime.fromtimestamp(entry['last_used']).strftime('%Y-%m-%d %H:%M'),
+                url=style(entry['url'], bold=True),
+            ))
+    elif args.action == 'prune':
+        evicted = cache.prune(limit=args.limit)
+        for key, entry in evicted:
+            echo('Evicted {} ({})'.format(style(entry['url'], bold=True), format_size(entry['size'])))
+        secho('{} files ({}) evicted.'.format(
+            len(evicted),
+            format_size(sum(entry['size'] for key, entry in evicted)),
+        ), bold=True)
+        removed_checkouts = checkout_cache.gc(max_age=(0 if args.limit == 0 else None))
+        secho('{} unused checkouts removed.'.format(len(removed_checkouts)), bold=True)
+        removed_objects = input_store.gc(max_age=(0 if args.limit == 0 else None))
+        secho('{} unused input files removed.'.format(len(removed_objects)), bold=True)
+        removed_trees = extraction_cache.gc(max_age=(0 if args.limit == 0 else None))
+        secho('{} unused extracted archives removed.'.format(len(removed_trees)), bold=True)
+        removed_blocks = block_cache.gc(max_age=(0 if args.limit == 0 else None))
+        secho('{} unused lazily read files removed.'.format(len(removed_blocks)), bold=True)
+        ConfigCache().prune(max_age=(0 if args.limit == 0 else DEFAULT_CHECKOUT_MAX_AGE))
+    elif args.action == 'verify':
+        corrupt = cache.verify()
+        for key, entry in corrupt:
+            secho('Evicted corrupted {}'.format(entry['url']), fg='red')
+        secho('{} corrupted files found.'.format(len(corrupt)), bold=True, fg=('red' if corrupt else 'green'))
+    else:
+        stats = cache.stats()
+        echo('Cache directory: {}'.format(style(stats['root'], bold=True)))
+        echo('Files:           {}'.format(stats['entries']))
+        echo('Size:            {} (limit {})'.format(format_size(stats['size']), format_size(stats['size_limit'])))
+        echo('Partial files:   {}'.format(format_size(stats['partial_size'])))
+        echo('Checkouts:       {} (in {})'.format(len(checkout_cache.list_commits()), checkout_cache.root))
+        echo('Input files:     {} (in {})'.format(len(input_store.list_objects()), input_store.root))
+        echo('Extracted:       {} (in {})'.format(len(extraction_cache.list_digests()), extraction_cache.root))
+        echo('Lazy blocks:     {} files, {} (in {})'.format(
+            len(block_cache.list_files()),
+            format_size(block_cache.get_size()),
+            block_cache.root,
+        ))
+    return 0
@@ -0,0 +1,305 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+
+from .consts import CHECKOUT_DIR_ENV, DEFAULT_CHECKOUT_MAX_AGE, GC_INTERVAL
+from .utils import claim_periodic_run, ensure_makedirs
+
+SHA_RE = re.compile(r'^(?:[0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+def git(args, git_dir, work_tree=None, env=None, **kwargs):
+    command = ['git', '--git-dir=%s' % git_dir]
+    if work_tree:
+        command.append('--work-tree=%s' % work_tree)
+    return subprocess.check_output(
+        command + list(args),
+        env=(dict(os.environ, **env) if env else None),
+        stderr=subprocess.DEVNULL,
+        **kwargs
+    ).decode('utf-8')
+
+
+def get_git_dir(directory):
+    return os.path.realpath(os.path.join(
+        directory,
+        subprocess.check_output(
+            ['git', 'rev-parse', '--git-common-dir'],
+            cwd=directory,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip(),
+    ))
+
+
+def read_head_commit(directory):
+    """
+    Read the commit checked out in `directory` straight from the files in `.git`, without running git.
+
+    :return: Commit SHA, or None if it can't be determined this simply (e.g. HEAD is unborn); ask git then.
+    """
+    git_dir = os.path.join(directory, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as infp:
+            head = infp.read().strip()
+        if not head.startswith('ref:'):  # Detached HEAD
+            return (head if SHA_RE.match(head) else None)
+        ref = head[4:].strip()
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path) as infp:
+                commit = infp.read().strip()
+            return (commit if SHA_RE.match(commit) else None)
+        with open(os.path.join(git_dir, 'packed-refs')) as infp:
+            for line in infp:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref and SHA_RE.match(parts[0]):
+                    return parts[0]
+    except IOError:
+        pass
+    return None
+
+
+def export_tree(git_dir, commit, dest):
+    """
+    Write the tree of `commit` into the (existing) directory `dest` without touching the repository's index.
+
+    Submodule paths are created as empty directories.
+    """
+    with tempfile.TemporaryDirectory(prefix='valohai-index-') as index_dir:
+        env = {'GIT_INDEX_FILE': os.path.join(index_dir, 'index')}
+        git(['read-tree', commit], git_dir=git_dir, work_tree=dest, env=env)
+        git(['checkout-index', '--all', '--force'], git_dir=git_dir, work_tree=dest, env=env)
+
+
+def make_read_only(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if not os.path.islink(file_path):
+                mode = os.lstat(file_path).st_mode
+                os.chmod(file_path, stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        os.chmod(dirpath, 0o555)
+
+
+def remove_read_only_tree(path):
+    def make_writable_and_retry(function, failed_path, exc_info):
+        os.chmod(os.path.dirname(failed_path), 0o755)
+        if os.path.isdir(failed_path) and not os.path.islink(failed_path):
+            os.chmod(failed_path, 0o755)
+        function(failed_path)
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        os.chmod(dirpath, 0o755)
+    shutil.rmtree(path, onerror=make_writable_and_retry)
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Exists, but isn't ours
+        return True
+    return True
+
+
+def get_live_leases(leases_dir):
+    """
+    Look at a directory of lease files (each containing the PID of its holder), removing the leases of dead processes.
+
+    :return: List of the IDs of the live leases
+    """
+    live = []
+    for lease_id in (os.listdir(leases_dir) if os.path.isdir(leases_dir) else ()):
+        lease_path = os.path.join(leases_dir, lease_id)
+        try:
+            with open(lease_path) as infp:
+                pid = int(infp.read().strip())
+        except (IOError, ValueError):
+            continue
+        if is_process_alive(pid):
+            live.append(lease_id)
+        else:  # The execution holding this lease has died without releasing it
+            os.unlink(lease_path)
+    return live
+
+
+class CheckoutCache:
+    """
+    A cache of immutable, read-only checkouts of commits, shared by all executions of those commits.
+
+    Layout of the cache directory:
+
+    * `<commit>/`: the checked out tree of a commit (including submodules)
+    * `<commit>.leases/<lease id>`: a file per execution using the checkout, containing its PID
+    * `<commit>.lock`: lock file guarding the creation and removal of the checkout
+    * `modules/<hash>.git`: bare mirrors of submodule repositories, reused across commits
+
+    Checkouts without live leases are garbage collected once they've been unused for `max_age` seconds
+    (by `gc()`, which releasing a checkout runs at most once per `GC_INTERVAL`).
+    """
+
+    def __init__(self, root=None, max_age=DEFAULT_CHECKOUT_MAX_AGE):
+        self.root = (
+            root or
+            os.environ.get(CHECKOUT_DIR_ENV) or
+            os.path.join(tempfile.gettempdir(), 'valohai-local-run-checkouts')
+        )
+        self.max_age = max_age
+        ensure_makedirs(self.root, 0o770)
+
+    def get_path(self, commit):
+        return os.path.join(self.root, commit)
+
+    def acquire(self, directory, commit, lease_id):
+        """
+        Get a checkout of `commit` from the repository in `directory`, creating it if necessary.
+
+        The checkout is guaranteed to stay in place until `release()` is called with the same lease ID.
+
+        :return: Path to the checkout.
+        """
+        path = self.get_path(commit)
+        with self._locked(commit):
+            if not os.path.isdir(path):
+                self._materialize(directory, commit, path)
+            leases_dir = path + '.leases'
+            ensure_makedirs(leases_dir, 0o770)
+            with open(os.path.join(leases_dir, lease_id), 'w') as outf:
+                outf.write(str(os.getpid()))
+            os.utime(path)
+        return path
+
+    def release(self, commit, lease_id):
+        try:
+            os.unlink(os.path.join(self.get_path(commit) + '.leases', lease_id))
+        except FileNotFoundError:
+            pass
+        if claim_periodic_run(os.path.join(self.root, '.last-gc'), GC_INTERVAL):
+            self.gc()
+
+    def gc(self, max_age=None):
+        """
+        Remove checkouts that have no live leases and have not been used in `max_age` seconds.
+
+        :return: List of removed commits.
+        """
+        max_age = (self.max_age if max_age is None else max_age)
+        removed = []
+        for commit in self.list_commits():
+            path = self.get_path(commit)
+            with self._locked(commit):
+                if get_live_leases(path + '.leases'):
+                    continue
+                try:
+                    if time.time() - os.stat(path).st_mtime < max_age:
+                        continue
+                except FileNotFoundError:
+                    continue
+                remove_read_only_tree(path)
+                shutil.rmtree(path + '.leases', ignore_errors=True)
+            removed.append(commit)
+        return removed
+
+    def list_commits(self):
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith('.') and name != 'modules' and os.path.isdir(os.path.join(self.root, name)) and
+            not name.endswith('.leases')
+        )
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        with open(os.path.join(self.root, name + '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _materialize(self, directory, commit, path):
+        temp_path = tempfile.mkdtemp(dir=self.root, prefix='.%s-' % commit)
+        try:
+            git_dir = get_git_dir(directory)
+            export_tree(git_dir, commit, temp_path)
+            for name, submodule_path, submodule_commit, url in self._get_submodules(git_dir, commit, temp_path):
+                submodule_git_dir = self._get_submodule_git_dir(
+                    directory, git_dir, name, submodule_path, submodule_commit, url,
+                )
+                export_tree(submodule_git_dir, submodule_commit, os.path.join(temp_path, submodule_path))
+            make_read_only(temp_path)
+            os.rename(temp_path, path)
+        except:  # noqa
+            remove_read_only_tree(temp_path)
+            raise
+
+    def _get_submodules(self, git_dir, commit, tree_path):
+        gitmodules_path = os.path.join(tree_path, '.gitmodules')
+        if not os.path.isfile(gitmodules_path):
+            return
+        gitlinks = {}
+        for line in git(['ls-tree', '-r', '-z', commit], git_dir=git_dir).split('\0'):
+            if line.startswith('160000 '):
+                meta, path = line.split('\t', 1)
+                gitlinks[path] = meta.split()[2]
+        config = subprocess.check_output(['git', 'config', '-z', '-f', gitmodules_path, '--list']).decode('utf-8')
+        config = dict(item.split('\n', 1) for item in config.split('\0') if '\n' in item)
+        for key, path in config.items():
+            if key.startswith('submodule.') and key.endswith('.path') and path in gitlinks:
+                name = key[len('submodule.'):-len('.path')]
+                yield (name, path, gitlinks[path], config.get('submodule.%s.url' % name))
+
+    def _get_submodule_git_dir(self, directory, git_dir, name, path, commit, url):
+        # Prefer objects already present in the source repository's initialized submodules...
+        candidates = [os.path.join(git_dir, 'modules', name)]
+        if os.path.exists(os.path.join(directory, path, '.git')):
+            try:
+                candidates.insert(0, get_git_dir(os.path.join(directory, path)))
+            except subprocess.CalledProcessError:  # Not a functional repository
+                pass
+        for candidate in candidates:
+            if os.path.isdir(candidate) and self._has_commit(candidate, commit):
+                return candidate
+
+        # ... otherwise keep a mirror of the submodule's repository around.
+        if not url:
+            raise ValueError('Submodule %s has no URL, and its commit %s is not available locally' % (path, commit))
+        url = self._resolve_submodule_url(directory, git_dir, url)
+        mirror_dir = os.path.join(self.root, 'modules', hashlib.sha1(url.encode('utf-8')).hexdigest() + '.git')
+        with self._locked('modules'):
+            if not os.path.isdir(mirror_dir):
+                subprocess.check_call(['git', 'clone', '--quiet', '--mirror', '--', url, mirror_dir])
+            if not self._has_commit(mirror_dir, commit):
+                subprocess.check_call(['git', '--git-dir=%s' % mirror_dir, 'fetch', '--quiet', 'origin'])
+            if not self._has_commit(mirror_dir, commit):
+                subprocess.check_call(['git', '--git-dir=%s' % mirror_dir, 'fetch', '--quiet', 'origin', commit])
+        return mirror_dir
+
+    def _resolve_submodule_url(self, directory, git_dir, url):
+        if not url.startswith(('./', '../')):
+            return url
+        try:
+            base = git(['config', 'remote.origin.url'], git_dir=git_dir).strip()
+        except subprocess.CalledProcessError:
+            base = os.path.realpath(directory)
+        for part in url.split('/'):
+            if part == '..':
+                base = base.rstrip('/').rsplit('/', 1)[0]
+            elif part not in ('.', ''):
+                base = base.rstrip('/') + '/' + part
+        return base
+
+    def _has_commit(self, git_dir, commit):
+        try:
+            git(['cat-file', '-e', '%s^{commit}' % commit], git_dir=git_dir)
+            return True
+        except subprocess.CalledProcessError:
+            return False
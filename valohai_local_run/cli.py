@@ -1,22 +1,26 @@
 import argparse
+import importlib
 import os
-import re
 import sys
 from collections import defaultdict
-from io import StringIO
 from subprocess import check_output
 
-import valohai_yaml
-
-from .consts import DEFAULT_OUTPUT_ROOT
+from .configcache import ConfigCache
+from .consts import (
+    DEFAULT_DOWNLOAD_CONCURRENCY, DEFAULT_OUTPUT_ROOT, DEFAULT_OUTPUT_SYNC_INTERVAL, DEFAULT_POOL_IDLE_TIMEOUT,
+    DEFAULT_REMOTE_ROOT, DEFAULT_TELEMETRY_INTERVAL,
+)
 from .excs import BadUsage
-from .executor import LocalExecutor
-from .utils import match_step
+from .profiling import Profiler
+from .utils import match_step, parse_size, sanitize_name
+
+# Heavier modules (click, valohai_yaml, requests, and the modules of this package that use them)
+# are only imported once they're needed, so e.g. completion and `--help` start up quickly.
 
 
-def get_argument_parser():
-    ap = argparse.ArgumentParser(add_help=False)
-    ap.add_argument('step')
+def get_argument_parser(prog=None, target='step'):
+    ap = argparse.ArgumentParser(prog=prog, add_help=False)
+    ap.add_argument(target)
     ap.add_argument('--commit', '-c', default=None, metavar='SHA',
         help='The commit to use. Defaults to the current HEAD.')
     ap.add_argument('--environment', '-e', default=None, help='Ignored.')
@@ -29,8 +33,54 @@ def get_argument_parser():
     ap.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT, help='Output root')
     ap.add_argument('--docker-command', default='docker', help='Docker executable')
     ap.add_argument('--docker-add-args', help='Additional arguments to Docker run')
+    ap.add_argument('--docker-backend', choices=('auto', 'api', 'cli'), default='auto',
+        help='Run containers with the Docker Engine API over its Unix socket, or with the docker command. '
+             'By default, the API is used when the socket is available and the command line isn\'t customized.')
     ap.add_argument('--no-save-logs', action='store_false', default=True, dest='save_logs', help='Skip saving logs?')
     ap.add_argument('--no-git', action='store_false', default=True, dest='use_git', help='Use Git?')
+    ap.add_argument('--download-concurrency', type=int, default=DEFAULT_DOWNLOAD_CONCURRENCY, metavar='N',
+        help='Number of inputs to download simultaneously')
+    ap.add_argument('--revalidate-inputs', action='store_true', default=False,
+        help='Check cached input downloads for changes with a conditional request')
+    ap.add_argument('--extract-inputs', action='store_true', default=False,
+        help='Extract tar and zip archive inputs (once, into the cache) and mount their contents instead')
+    ap.add_argument('--lazy-inputs', action='store_true', default=False,
+        help='Mount HTTP/HTTPS inputs with a FUSE filesystem that only downloads the parts the step reads, '
+             'instead of downloading them up front (requires the `fusepy` package)')
+    ap.add_argument('--cpus', type=positive_float, default=None,
+        help='Number of CPUs the container may use (e.g. 1.5)')
+    ap.add_argument('--memory', type=memory_size, default=None, help='Memory limit of the container (e.g. 4g)')
+    ap.add_argument('--structured-logs', action='store_true', default=False,
+        help='Also save a timestamped, indexed log (see the `logs` subcommand)')
+    ap.add_argument('--no-metrics', action='store_false', default=True, dest='collect_metrics',
+        help='Skip collecting metrics from JSON lines in the output')
+    ap.add_argument('--no-manifest', action='store_false', default=True, dest='manifest',
+        help='Skip writing the manifest of output files (with their sizes and SHA256 digests)')
+    ap.add_argument('--pack-outputs', action='store_true', default=False,
+        help='Also pack the output files into a zstd-compressed tarball (requires the `zstandard` package)')
+    ap.add_argument('--telemetry', action='store_true', default=False,
+        help='Sample the CPU, memory, I/O and network usage of the container while it runs')
+    ap.add_argument('--telemetry-interval', type=float, default=DEFAULT_TELEMETRY_INTERVAL, metavar='SECONDS',
+        help='Time between telemetry samples')
+    ap.add_argument('--pool', action='store_true', default=False,
+        help='Run in a warm, reusable container instead of starting a new one (see the `pool` subcommand)')
+    ap.add_argument('--pool-idle-timeout', type=float, default=DEFAULT_POOL_IDLE_TIMEOUT, metavar='SECONDS',
+        help='Remove pooled containers that have been idle for this long')
+    ap.add_argument('--remote', default=None, metavar='HOST',
+        help='Run on a remote Docker host over SSH (e.g. user@gpu-box), syncing only changed files over')
+    ap.add_argument('--ssh-command', default='ssh', metavar='COMMAND',
+        help='Command to connect to the remote host with (e.g. "ssh -p 2222")')
+    ap.add_argument('--remote-root', default=DEFAULT_REMOTE_ROOT, metavar='DIR',
+        help='Directory for synced files on the remote host (relative to the home directory, unless absolute)')
+    ap.add_argument('--remote-sync-interval', type=float, default=DEFAULT_OUTPUT_SYNC_INTERVAL, metavar='SECONDS',
+        help='Time between pulling changed output files from the remote host while the execution runs')
+    ap.add_argument('--memoize', action='store_true', default=False,
+        help='Reuse the outputs of an identical earlier execution (same commit, image, command, parameters and '
+             'input contents) in the output root instead of running again')
+    ap.add_argument('--profile', action='store_true', default=False,
+        help='Print how long each phase of the run took')
+    ap.add_argument('--profile-trace', default=None, metavar='FILE',
+        help='Write the phases of the run into a Chrome trace file')
     return ap
 
 
@@ -40,13 +90,14 @@ parameter_type_map = {
 }
 
 
-def sanitize_name(name):
-    return re.sub(r'[_ ]', '-', name).lower()
-
-
-def add_step_arguments(ap, step):
+def add_step_arguments(ap, step, sweep=False):
     param_group = ap.add_argument_group('parameters for "{}"'.format(step.name))
     for parameter in step.parameters.values():
+        kwargs = {
+            'type': parameter_type_map.get(parameter.type),
+        }
+        if sweep:  # Accept multiple values and ranges; see `sweep.parse_parameter_values()`
+            kwargs = {'nargs': '+'}
         param_group.add_argument(
             '--%s' % sanitize_name(parameter.name),
             dest=':parameters:%s' % parameter.name,
@@ -54,7 +105,7 @@ def add_step_arguments(ap, step):
             default=parameter.default,
             help=parameter.description,
             metavar=str(parameter.type or 'value').upper(),
-            type=parameter_type_map.get(parameter.type),
+            **kwargs
         )
     input_group = ap.add_argument_group('inputs for "{}"'.format(step.name))
     for input in step.inputs.values():
@@ -69,25 +120,75 @@ def add_step_arguments(ap, step):
         )
 
 
-def resolve_commit_and_config(directory, has_git, commit):
+def positive_int(value):
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError('expected a positive integer')
+    return value
+
+
+def positive_float(value):
+    try:
+        value = float(value)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise argparse.ArgumentTypeError('expected a positive number')
+    return value
+
+
+def memory_size(value):
+    # Validated here, but passed on as given, as the `docker` command understands the same suffixes
+    try:
+        parse_size(value)
+    except BadUsage as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+    return value
+
+
+def resolve_commit(directory, has_git, commit):
     if has_git:
         if not commit:
-            commit = check_output(['git', 'rev-parse', 'HEAD'], cwd=directory).strip().decode()
-        else:
-            commit = check_output(['git', 'rev-parse', '--verify', commit], cwd=directory).decode().strip()
-        config_data = check_output(['git', 'show', '{}:valohai.yaml'.format(commit)], cwd=directory).decode()
+            from .checkout import read_head_commit
+            return (
+                read_head_commit(directory) or
+                check_output(['git', 'rev-parse', 'HEAD'], cwd=directory).strip().decode()
+            )
+        return check_output(['git', 'rev-parse', '--verify', commit], cwd=directory).decode().strip()
+    if commit:
+        raise BadUsage('Can\'t use --commit when in Gitless mode')
+    return '(gitless)'
+
+
+def read_config(directory, has_git, commit):
+    if has_git:
+        return check_output(['git', 'show', '{}:valohai.yaml'.format(commit)], cwd=directory).decode()
+    with open(os.path.join(directory, 'valohai.yaml'), 'rb') as infp:
+        return infp.read().decode('utf-8')
+
+
+def get_step_table(directory, has_git, commit, config_cache=None):
+    """
+    Get the steps configured in `valohai.yaml`, from the config cache if they've been parsed before.
+    """
+    config_cache = (config_cache or ConfigCache())
+    if has_git:
+        key = config_cache.get_commit_key(commit)
     else:
-        if commit:
-            raise BadUsage('Can\'t use --commit when in Gitless mode')
-        with open(os.path.join(directory, 'valohai.yaml'), 'rb') as infp:
-            config_data = infp.read().decode('utf-8')
-        commit = '(gitless)'
-    return (commit, config_data)
+        key = config_cache.get_file_key(os.path.join(directory, 'valohai.yaml'))
+    return config_cache.get_step_table(key, lambda: read_config(directory, has_git, commit))
 
 
-def cli(argv=None):
-    ap = get_argument_parser()
-    args, rest_argv = ap.parse_known_args(argv)
+def resolve_config(ap, args, profiler=None):
+    """
+    Resolve the project directory and the commit from parsed arguments, and read the configuration.
+
+    :return: Tuple of (directory, has_git, step_table); `args.commit` is also updated.
+    """
+    profiler = (profiler or Profiler())
     directory = (args.directory or os.getcwd())
     if not os.path.isdir(directory):
         ap.error('Invalid --directory')
@@ -97,14 +198,32 @@ def cli(argv=None):
     try:
         if args.adhoc and args.commit:
             raise BadUsage('--adhoc and --commit are mutually exclusive')
-        args.commit, config_data = resolve_commit_and_config(directory, has_git, args.commit)
-        config = valohai_yaml.parse(StringIO(config_data))
-        step = config.steps[match_step(config, args.step)]
+        with profiler.phase('resolve_commit'):
+            args.commit = resolve_commit(directory, has_git, args.commit)
+        with profiler.phase('parse_config'):
+            step_table = get_step_table(directory, has_git, args.commit)
     except BadUsage as be:
         ap.error(be)
-        return
+    return (directory, has_git, step_table)
 
-    add_step_arguments(ap, step)
+
+def resolve_step(ap, args, profiler=None):
+    """
+    Resolve the project directory, the commit and the step to run from parsed arguments.
+
+    :return: Tuple of (directory, has_git, step); `args.commit` is also updated.
+    """
+    profiler = (profiler or Profiler())
+    directory, has_git, step_table = resolve_config(ap, args, profiler=profiler)
+    try:
+        with profiler.phase('parse_step'):
+            step = step_table.get_step(match_step(step_table, args.step))
+    except BadUsage as be:
+        ap.error(be)
+    return (directory, has_git, step)
+
+
+def parse_step_arguments(ap, argv):
     # We add the help argument only here so the step's arguments are also listed
     ap.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='show this help message and exit')
 
@@ -114,20 +233,263 @@ def cli(argv=None):
         if name.startswith(':'):
             _, dict_name, name = name.split(':', 2)
             dicts[dict_name][name] = value
+    return dicts
+
+
+def resolve_docker_client(ap, args):
+    from .dockerapi import get_docker_client
+    if args.remote:  # The remote host is driven with its docker command
+        return None
+    try:
+        return get_docker_client(args.docker_backend, args.docker_command, args.docker_add_args)
+    except BadUsage as be:
+        ap.error(be)
+
 
-    executor = LocalExecutor(
+def build_executor(args, directory, has_git, step, inputs, parameters, **kwargs):
+    from .executor import LocalExecutor
+    from .memo import MemoIndex
+    from .pool import ContainerPool
+    output_root = os.path.realpath(args.output_root)
+    if args.remote:
+        from .remote import RemoteExecutor, RemoteHost
+        kwargs.update(
+            remote_host=RemoteHost(args.remote, ssh_command=args.ssh_command, root=args.remote_root),
+            output_sync_interval=args.remote_sync_interval,
+        )
+    executor_class = (RemoteExecutor if args.remote else LocalExecutor)
+    return executor_class(
         command=args.command,
         commit=args.commit,
         directory=directory,
         image=args.image,
-        inputs=dicts['inputs'],
-        output_root=os.path.realpath(args.output_root),
-        parameters=dicts['parameters'],
+        inputs=inputs,
+        output_root=output_root,
+        parameters=parameters,
         project_id=args.project_id,
         step=step,
         docker_command=args.docker_command,
         docker_add_args=args.docker_add_args,
         gitless=(not has_git),
+        download_concurrency=args.download_concurrency,
+        revalidate_inputs=args.revalidate_inputs,
+        extract_inputs=args.extract_inputs,
+        lazy_inputs=args.lazy_inputs,
+        cpus=args.cpus,
+        memory=args.memory,
+        structured_logs=args.structured_logs,
+        collect_metrics=args.collect_metrics,
+        manifest=args.manifest,
+        pack_outputs=args.pack_outputs,
+        telemetry_interval=(args.telemetry_interval if args.telemetry else None),
+        container_pool=(
+            ContainerPool(docker_command=args.docker_command, idle_timeout=args.pool_idle_timeout)
+            if args.pool else None
+        ),
+        memo_index=(MemoIndex(output_root) if args.memoize else None),
+        **kwargs
+    )
+
+
+def cli(argv=None):
+    sys.exit(run_cli(argv))  # Exit with the container's exit code
+
+
+def run_cli(argv=None):
+    """
+    Run the command line, like `cli()`, but return the exit code instead of exiting.
+
+    Usage errors still exit, as `argparse` does.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in subcommands and not has_step(argv[0], argv[1:]):
+        return get_subcommand(argv[0])(argv[1:])
+
+    profiler = Profiler()
+    ap = get_argument_parser()
+    with profiler.phase('resolve_step'):
+        args, rest_argv = ap.parse_known_args(argv)
+        directory, has_git, step = resolve_step(ap, args, profiler=profiler)
+        add_step_arguments(ap, step)
+        dicts = parse_step_arguments(ap, argv)
+
+    executor = build_executor(
+        args, directory, has_git, step,
+        inputs=dicts['inputs'],
+        parameters=dicts['parameters'],
+        profiler=profiler,
+        docker_client=resolve_docker_client(ap, args),
     )
     ret = executor.execute(verbose=True, save_logs=args.save_logs)
-    sys.exit(ret)  # Exit with the container's exit code
+    if args.profile:
+        profiler.print_summary()
+    if args.profile_trace:
+        profiler.write_chrome_trace(args.profile_trace)
+    return ret
+
+
+def sweep_cli(argv):
+    from click import secho
+
+    from .checkout import CheckoutCache
+    from .download import download_urls
+    from .inputs import InputStore, expand_input_specs, extract_archive_inputs, is_url
+    from .sweep import expand_parameter_sets, parse_parameter_values, run_executions
+
+    ap = get_argument_parser(prog='valohai-local-run sweep')
+    ap.add_argument('--jobs', '-j', type=positive_int, default=None, metavar='N',
+        help='Number of executions to run at a time (default: number of CPUs divided by --cpus)')
+    ap.add_argument('--random', type=positive_int, default=None, metavar='N',
+        help='Run N randomly chosen parameter combinations instead of the full grid')
+    ap.add_argument('--seed', type=int, default=None, help='Random seed for --random')
+    args, rest_argv = ap.parse_known_args(argv)
+    directory, has_git, step = resolve_step(ap, args)
+    add_step_arguments(ap, step, sweep=True)
+    dicts = parse_step_arguments(ap, argv)
+
+    try:
+        parameter_sets = expand_parameter_sets(
+            {
+                name: parse_parameter_values(values, parameter_type_map.get(step.parameters[name].type))
+                for (name, values) in dicts['parameters'].items()
+            },
+            random_count=args.random,
+            seed=args.seed,
+        )
+    except BadUsage as be:
+        ap.error(be)
+
+    jobs = args.jobs
+    if not jobs:
+        jobs = max(1, int((os.cpu_count() or 1) / float(args.cpus or 1)))
+
+    # Fetch remote inputs once up front instead of in every execution
+    urls = [
+        filename
+        for values in dicts['inputs'].values()
+        for filename in expand_input_specs(values or ())
+        if is_url(filename)
+    ]
+    if args.extract_inputs:
+        extracted = extract_archive_inputs(
+            urls,
+            verbose=True,
+            download_concurrency=args.download_concurrency,
+            revalidate=args.revalidate_inputs,
+        )
+        urls = [url for url in urls if url not in extracted]
+    if not args.lazy_inputs:
+        download_urls(urls, concurrency=args.download_concurrency, revalidate=args.revalidate_inputs)
+    checkout_cache = CheckoutCache()
+    input_store = InputStore()
+    docker_client = resolve_docker_client(ap, args)
+    executors = [
+        build_executor(
+            args, directory, has_git, step,
+            inputs=dicts['inputs'],
+            parameters=parameters,
+            checkout_cache=checkout_cache,
+            input_store=input_store,
+            docker_client=docker_client,
+        )
+        for parameters in parameter_sets
+    ]
+    secho('=== Running {} executions of "{}", {} at a time ==='.format(len(executors), step.name, jobs), bold=True)
+    results = run_executions(executors, jobs=jobs, save_logs=args.save_logs)
+    return (0 if all(ret == 0 for ret in results) else 1)
+
+
+def pipeline_cli(argv):
+    from click import secho
+
+    from .checkout import CheckoutCache
+    from .inputs import InputStore
+    from .pipeline import apply_arguments, get_dependencies, get_pipeline_nodes, match_pipeline, run_pipeline
+
+    ap = get_argument_parser(prog='valohai-local-run pipeline', target='pipeline')
+    ap.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='show this help message and exit')
+    ap.add_argument('--jobs', '-j', type=positive_int, default=None, metavar='N',
+        help='Number of nodes to run at a time (default: number of CPUs divided by --cpus)')
+    ap.add_argument('--parameter', '-P', action='append', default=[], metavar='NODE.NAME=VALUE',
+        help='Set a parameter of a node (or a pipeline parameter, with NAME=VALUE)')
+    ap.add_argument('--input', '-i', action='append', default=[], metavar='NODE.NAME=URL',
+        help='Add a file to an input of a node')
+    args = ap.parse_args(argv)
+    directory, has_git, step_table = resolve_config(ap, args)
+    try:
+        pipeline = step_table.get_pipeline(match_pipeline(step_table, args.pipeline))
+        get_dependencies(pipeline)  # Validate the edges before running anything
+        nodes = get_pipeline_nodes(pipeline, step_table, parameter_types=parameter_type_map)
+        apply_arguments(pipeline, nodes, parameters=args.parameter, inputs=args.input)
+    except BadUsage as be:
+        ap.error(be)
+
+    jobs = args.jobs
+    if not jobs:
+        jobs = max(1, int((os.cpu_count() or 1) / float(args.cpus or 1)))
+
+    checkout_cache = CheckoutCache()
+    input_store = InputStore()
+    docker_client = resolve_docker_client(ap, args)
+
+    def build_node_executor(node, inputs, parameters):
+        node_args = argparse.Namespace(**dict(
+            vars(args),
+            command=(args.command or node.command),
+            image=(args.image or node.image),
+        ))
+        return build_executor(
+            node_args, directory, has_git, node.step,
+            inputs=inputs,
+            parameters=parameters,
+            checkout_cache=checkout_cache,
+            input_store=input_store,
+            docker_client=docker_client,
+        )
+
+    secho('=== Running pipeline {} ({} nodes, {} at a time) ==='.format(pipeline.name, len(nodes), jobs), bold=True)
+    results = run_pipeline(pipeline, nodes, build_node_executor, jobs=jobs, save_logs=args.save_logs)
+    return (0 if all(ret == 0 for ret in results.values()) else 1)
+
+
+def has_step(name, argv):
+    """
+    Check whether the project (as chosen by the arguments in `argv`) has a step called `name`.
+
+    Steps take precedence over subcommands of the same name, so they can still be run.
+    """
+    ap = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    ap.add_argument('--commit', '-c', default=None)
+    ap.add_argument('--directory', '-d', default=None)
+    ap.add_argument('--no-git', action='store_false', default=True, dest='use_git')
+    ap.add_argument('--adhoc', '-a', action='store_true')
+    args, rest_argv = ap.parse_known_args(argv)
+    directory = (args.directory or os.getcwd())
+    if not os.path.isfile(os.path.join(directory, 'valohai.yaml')):
+        return False
+    has_git = (args.use_git and not args.adhoc and os.path.isdir(os.path.join(directory, '.git')))
+    try:
+        step_table = get_step_table(directory, has_git, resolve_commit(directory, has_git, args.commit))
+    except Exception:  # e.g. an invalid configuration; the subcommand may still work
+        return False
+    return (name in step_table.steps)
+
+
+def get_subcommand(name):
+    module_name, function_name = subcommands[name].split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+subcommands = {
+    'cache': 'valohai_local_run.cache:cache_cli',
+    'complete': 'valohai_local_run.completion:complete_cli',
+    'completion': 'valohai_local_run.completion:completion_cli',
+    'history': 'valohai_local_run.history:history_cli',
+    'logs': 'valohai_local_run.logstore:logs_cli',
+    'outputs': 'valohai_local_run.outputs:outputs_cli',
+    'pipeline': 'valohai_local_run.cli:pipeline_cli',
+    'pool': 'valohai_local_run.pool:pool_cli',
+    'prefetch': 'valohai_local_run.prefetch:prefetch_cli',
+    'sweep': 'valohai_local_run.cli:sweep_cli',
+}
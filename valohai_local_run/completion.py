@@ -0,0 +1,193 @@
+import argparse
+import os
+import shlex
+import sys
+
+from .checkout import read_head_commit
+from .configcache import ConfigCache
+
+# Candidates are escaped by the shell function; with `-o default`, files are completed when there are none.
+BASH_SCRIPT = r'''
+_valohai_local_run_complete() {
+    local IFS=$'\n' candidate
+    COMPREPLY=()
+    for candidate in $("${COMP_WORDS[0]}" complete -- "${COMP_WORDS[@]:1:COMP_CWORD}" 2>/dev/null); do
+        COMPREPLY+=("$(printf '%q' "$candidate")")
+    done
+}
+complete -o default -F _valohai_local_run_complete valohai-local-run vh-local-run
+'''.lstrip()
+
+ZSH_SCRIPT = 'autoload -U +X bashcompinit && bashcompinit\n' + BASH_SCRIPT
+
+STEP_SUBCOMMANDS = ('sweep',)  # Subcommands that take a step and its arguments, like a regular run
+
+
+def unescape_word(word):
+    try:
+        return (' '.join(shlex.split(word)) if word.strip() else word)
+    except ValueError:  # e.g. an unterminated quote, as the user is still typing
+        return word.lstrip('\'"')
+
+
+def get_option_arities(ap):
+    # Number of values each option of the parser takes (using argparse internals; good enough for completion)
+    return {
+        option: (0 if action.nargs == 0 else 1)
+        for action in ap._actions
+        for option in action.option_strings
+    }
+
+
+def load_step_table(directory):
+    """
+    Get the step table for the project in `directory` without running git: for the checked out commit
+    if it's been cached, otherwise for the `valohai.yaml` in the working directory.
+    """
+    config_cache = ConfigCache()
+    commit = (read_head_commit(directory) if os.path.isdir(os.path.join(directory, '.git')) else None)
+    config_path = os.path.join(directory, 'valohai.yaml')
+    if commit:
+        step_table = config_cache.peek(config_cache.get_commit_key(commit))
+        if step_table:
+            return step_table
+    with open(config_path, 'rb') as infp:
+        config_data = infp.read().decode('utf-8')
+    return config_cache.get_step_table(config_cache.get_file_key(config_path), lambda: config_data)
+
+
+def try_load_step_table(directory):
+    try:
+        return load_step_table(directory)
+    except (IOError, ValueError):
+        return None
+
+
+def parse_words(words, arities):
+    """
+    Find the project directory and step name among the words of a command line.
+
+    :return: Tuple of (directory, step_name, expecting_value), where `expecting_value` tells whether
+             the last word is an option that takes a value.
+    """
+    directory = None
+    step_name = None
+    expecting_value = False
+    for i, word in enumerate(words):
+        if expecting_value:
+            expecting_value = False
+            if words[i - 1] in ('--directory', '-d'):
+                directory = word
+            continue
+        if word.startswith('-'):
+            expecting_value = (arities.get(word) == 1)
+        elif step_name is None:
+            step_name = word
+    return (directory, step_name, expecting_value)
+
+
+def complete(words):
+    """
+    Get completion candidates for a command line.
+
+    :param words: The arguments on the command line, up to and including the (possibly empty) word being completed
+    :return: List of candidates
+    """
+    from .cli import get_argument_parser, subcommands
+
+    words = [unescape_word(word) for word in (words or [''])]
+    current = words[-1]
+    previous = words[:-1]
+    if previous and previous[0] == 'pipeline':
+        return complete_pipeline(previous[1:], current, get_option_arities(get_argument_parser(target='pipeline')))
+    if previous and previous[0] in STEP_SUBCOMMANDS:
+        previous = previous[1:]
+    elif previous and previous[0] in subcommands:
+        return []
+
+    # Shells split `--option=value` into three words
+    if len(previous) >= 2 and previous[-1] == '=':
+        previous = previous[:-1]
+
+    arities = get_option_arities(get_argument_parser())
+    directory, step_name, expecting_value = parse_words(previous, arities)
+    step_table = try_load_step_table(directory or os.getcwd())
+
+    if step_name is None:
+        if current.startswith('-'):
+            return sorted(option for option in arities if option.startswith(current))
+        candidates = (step_table.index.find(current) if step_table else [])
+        if not previous:
+            candidates = sorted(
+                name for name in subcommands if name.startswith(current) and name != 'complete'
+            ) + candidates
+        return candidates
+
+    if not step_table or step_name not in step_table.steps:
+        matches = (step_table.index.find(step_name) if step_table else [])
+        if len(matches) != 1:
+            return []
+        step_name = matches[0]
+    last_option = (previous[-1] if expecting_value or previous[-1].startswith('-') else None)
+    return complete_step_arguments(step_table, step_name, current, last_option, arities)
+
+
+def complete_pipeline(previous, current, arities):
+    """
+    Complete the name of a pipeline (in the project of the `--directory` given, if any), or an option.
+    """
+    if len(previous) >= 2 and previous[-1] == '=':
+        previous = previous[:-1]
+    directory, pipeline_name, expecting_value = parse_words(previous, arities)
+    if expecting_value:
+        return []
+    if current.startswith('-'):
+        return sorted(option for option in arities if option.startswith(current))
+    if pipeline_name is not None:
+        return []
+    step_table = try_load_step_table(directory or os.getcwd())
+    return sorted(name for name in (step_table.pipelines if step_table else ()) if name.startswith(current))
+
+
+def complete_step_arguments(step_table, step_name, current, last_option, arities):
+    """
+    Complete the options of a step, or the value of `last_option` (the option before the current word, if any).
+    """
+    parameters = step_table.get_parameters(step_name)
+    inputs = step_table.get_inputs(step_name)
+    if last_option and (arities.get(last_option) == 1 or last_option in parameters or last_option in inputs):
+        parameter = parameters.get(last_option)
+        if not parameter:
+            return []  # Let the shell complete e.g. files for inputs
+        values = list(parameter.get('choices') or ())
+        if not values and parameter.get('default') is not None:
+            values = [parameter['default']]
+        return [str(value) for value in values if str(value).startswith(current)]
+
+    if current.startswith('-'):
+        options = set(arities) | set(parameters) | set(inputs)
+        return sorted(option for option in options if option.startswith(current))
+    return []
+
+
+def complete_cli(argv):
+    """
+    Print completion candidates for the words after `--`, one per line (used by the shell functions).
+    """
+    if argv and argv[0] == '--':
+        argv = argv[1:]
+    for candidate in complete(argv):
+        sys.stdout.write(candidate + '\n')
+    return 0
+
+
+def completion_cli(argv):
+    ap = argparse.ArgumentParser(
+        prog='valohai-local-run completion',
+        description='Print a shell completion script. Add e.g. `eval "$(valohai-local-run completion bash)"` '
+                    'to your shell startup file.',
+    )
+    ap.add_argument('shell', choices=('bash', 'zsh'))
+    args = ap.parse_args(argv)
+    sys.stdout.write(BASH_SCRIPT if args.shell == 'bash' else ZSH_SCRIPT)
+    return 0
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from io import StringIO
+
+from .consts import CONFIG_CACHE_DIR_ENV
+from .utils import PrefixIndex, sanitize_name
+
+CACHE_FORMAT_VERSION = 3
+
+
+class StepTable:
+    """
+    The steps and pipelines of a `valohai.yaml` configuration in serialized form; they're only parsed when asked for.
+
+    Has a `steps` mapping of step names like `valohai_yaml.objs.Config`, so it can be used with `match_step()`,
+    and a `PrefixIndex` of the step names as `index`.
+    """
+
+    def __init__(self, steps, index=None, pipelines=None):
+        self.steps = steps
+        self.index = (index or PrefixIndex(steps))
+        self.pipelines = (pipelines or {})
+
+    @classmethod
+    def from_yaml(cls, config_data):
+        import valohai_yaml
+        config = valohai_yaml.parse(StringIO(config_data))
+        return cls(
+            {name: step.serialize() for (name, step) in config.steps.items()},
+            pipelines={name: pipeline.serialize() for (name, pipeline) in config.pipelines.items()},
+        )
+
+    def get_step(self, name):
+        from valohai_yaml.objs import Step
+        return Step.parse(self.steps[name])
+
+    def get_pipeline(self, name):
+        from valohai_yaml.objs import Pipeline
+        return Pipeline.parse(self.pipelines[name])
+
+    def get_parameters(self, name):
+        """
+        Get the serialized parameters of a step, by their command line flags.
+        """
+        return {
+            '--' + sanitize_name(parameter['name']): parameter
+            for parameter in self.steps[name].get('parameters', ())
+        }
+
+    def get_inputs(self, name):
+        """
+        Get the serialized inputs of a step, by their command line flags.
+        """
+        return {'--' + sanitize_name(input['name']): input for input in self.steps[name].get('inputs', ())}
+
+
+class ConfigCache:
+    """
+    A cache of step tables parsed out of `valohai.yaml` files.
+
+    Entries are keyed by what determines the contents of the configuration file:
+    a commit, or the path, size and modification time of a file outside of version control.
+    """
+
+    def __init__(self, root=None):
+        self.root = (
+            root or
+            os.environ.get(CONFIG_CACHE_DIR_ENV) or
+            os.path.join(tempfile.gettempdir(), 'valohai-local-run-configs')
+        )
+
+    @staticmethod
+    def get_commit_key(commit):
+        return 'commit:{}'.format(commit)
+
+    @staticmethod
+    def get_file_key(path):
+        stat = os.stat(path)
+        return 'file:{}:{}:{}'.format(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+    def get_path(self, key):
+        return os.path.join(self.root, '{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    def peek(self, key):
+        """
+        Get the cached step table for `key`, if any.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'r') as infp:
+                data = json.load(infp)
+        except (IOError, ValueError):
+            return None
+        if data.get('version') != CACHE_FORMAT_VERSION or data.get('key') != key:
+            return None
+        os.utime(path)  # Mark used, for `prune()`
+        return StepTable(data['steps'], index=PrefixIndex(pairs=data['index']), pipelines=data['pipelines'])
+
+    def get_step_table(self, key, read_config):
+        """
+        Get the step table for `key`, reading (with `read_config()`) and parsing the configuration on a miss.
+        """
+        table = self.peek(key)
+        if not table:
+            table = StepTable.from_yaml(read_config())
+            self._write(self.get_path(key), {
+                'version': CACHE_FORMAT_VERSION,
+                'key': key,
+                'steps': table.steps,
+                'index': table.index.pairs,
+                'pipelines': table.pipelines,
+            })
+        return table
+
+    def _write(self, path, data):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.config-')
+            with os.fdopen(fd, 'w') as outf:
+                json.dump(data, outf, sort_keys=True)
+            os.rename(temp_path, path)
+        except OSError:  # Not being able to cache the configuration is no reason to fail
+            pass
+
+    def prune(self, max_age):
+        """
+        Remove entries that haven't been used in `max_age` seconds.
+
+        :return: Number of removed entries.
+        """
+        n_removed = 0
+        cutoff = time.time() - max_age
+        for name in (os.listdir(self.root) if os.path.isdir(self.root) else ()):
+            path = os.path.join(self.root, name)
+            if name.endswith('.json') and os.stat(path).st_mtime <= cutoff:
+                os.unlink(path)
+                n_removed += 1
+        return n_removed
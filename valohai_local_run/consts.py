@@ -7,3 +7,40 @@ DEFAULT_OUTPUT_ROOT = './valohai-local-outputs/'
 EXECUTION_METADATA_JSON_NAME = 'valohai-execution-metadata.json'
 STDERR_LOG_NAME = 'valohai-stderr.log'
 STDOUT_LOG_NAME = 'valohai-stdout.log'
+METRICS_DIR_NAME = 'valohai-metrics'
+STRUCTURED_LOG_NAME = 'valohai-logs.bin'
+STRUCTURED_LOG_INDEX_NAME = 'valohai-logs.idx'
+OUTPUTS_MANIFEST_NAME = 'valohai-outputs-manifest.json'
+OUTPUTS_ARCHIVE_NAME = 'valohai-outputs.tar.zst'
+TELEMETRY_CSV_NAME = 'valohai-telemetry.csv'
+MEMO_INDEX_NAME = '.valohai-memo.json'
+HISTORY_INDEX_NAME = '.valohai-history.sqlite3'
+# Files written into the output directory by the executor itself, rather than by the step
+RESERVED_OUTPUT_NAMES = {
+    EXECUTION_METADATA_JSON_NAME,
+    METRICS_DIR_NAME,
+    OUTPUTS_ARCHIVE_NAME,
+    OUTPUTS_MANIFEST_NAME,
+    STDERR_LOG_NAME,
+    STDOUT_LOG_NAME,
+    STRUCTURED_LOG_INDEX_NAME,
+    STRUCTURED_LOG_NAME,
+    TELEMETRY_CSV_NAME,
+}
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+DEFAULT_LAZY_BLOCK_SIZE = 4 * 1024 * 1024
+CACHE_DIR_ENV = 'VALOHAI_LOCAL_RUN_CACHE_DIR'
+CACHE_LIMIT_ENV = 'VALOHAI_LOCAL_RUN_CACHE_LIMIT'
+DEFAULT_CACHE_SIZE_LIMIT = '20G'
+CHECKOUT_DIR_ENV = 'VALOHAI_LOCAL_RUN_CHECKOUT_DIR'
+DEFAULT_CHECKOUT_MAX_AGE = 24 * 60 * 60
+INPUT_STORE_DIR_ENV = 'VALOHAI_LOCAL_RUN_INPUT_STORE_DIR'
+DEFAULT_INPUT_STORE_MAX_AGE = 24 * 60 * 60
+GC_INTERVAL = 60 * 60  # Caches are garbage collected at most this often after executions
+POOL_DIR_ENV = 'VALOHAI_LOCAL_RUN_POOL_DIR'
+DEFAULT_POOL_IDLE_TIMEOUT = 10 * 60
+CONFIG_CACHE_DIR_ENV = 'VALOHAI_LOCAL_RUN_CONFIG_CACHE_DIR'
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+DEFAULT_TELEMETRY_INTERVAL = 1.0
+DEFAULT_REMOTE_ROOT = '.valohai-local-run'  # On the remote host, relative to the home directory
+DEFAULT_OUTPUT_SYNC_INTERVAL = 10.0
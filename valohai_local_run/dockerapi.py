@@ -0,0 +1,370 @@
+import http.client
+import json
+import os
+import socket
+import struct
+import threading
+from urllib.parse import quote, urlencode
+
+from .consts import DEFAULT_DOCKER_SOCKET
+from .excs import BadUsage
+from .tee import Tee
+from .utils import parse_size
+
+API_VERSION = '1.25'  # The first version with `NanoCpus`; supported by Docker 1.13 and newer
+FRAME_HEADER = struct.Struct('>BxxxL')  # Stream type (0 stdin, 1 stdout, 2 stderr), size
+STREAM_NAMES = {1: 'stdout', 2: 'stderr'}
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__('Docker API error {}: {}'.format(status, message))
+        self.status = status
+        self.message = message
+
+
+class PullCancelled(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def get_docker_socket_path():
+    """
+    Get the path of the Docker daemon's Unix socket, as configured with `DOCKER_HOST`.
+
+    :return: Path, or None if the daemon is not reachable over a Unix socket
+    """
+    docker_host = os.environ.get('DOCKER_HOST')
+    if not docker_host:
+        return DEFAULT_DOCKER_SOCKET
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return None
+
+
+def get_docker_client(backend, docker_command='docker', docker_add_args=None):
+    """
+    Get a client for the Docker Engine API, if executions should be run with it.
+
+    :param backend: `api`, `cli`, or `auto` to use the API when the daemon's socket is available and
+                    the Docker command line isn't customized
+    :return: `DockerClient`, or None to use the `docker` command
+    """
+    if backend == 'cli':
+        return None
+    socket_path = get_docker_socket_path()
+    if backend == 'auto':
+        customized = (docker_command != 'docker' or docker_add_args)
+        if customized or not socket_path or not os.access(socket_path, os.R_OK | os.W_OK):
+            return None
+        return DockerClient(socket_path)
+    if docker_add_args or docker_command != 'docker':
+        raise BadUsage('--docker-command and --docker-add-args can\'t be used with the API backend')
+    if not socket_path:
+        raise BadUsage('The Docker daemon must be reachable over a Unix socket for the API backend')
+    return DockerClient(socket_path)
+
+
+class DockerClient:
+    """
+    A minimal client for the Docker Engine API over the daemon's Unix socket.
+
+    Connections are kept alive and reused (from any thread) for requests other than attaching,
+    which takes over a connection for the container's output streams.
+    """
+
+    def __init__(self, socket_path=DEFAULT_DOCKER_SOCKET, timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get_path(self, path, query=None):
+        path = '/v{}{}'.format(API_VERSION, path)
+        if query:
+            path += '?' + urlencode(query)
+        return path
+
+    def request(self, method, path, query=None, body=None, long_running=False):
+        """
+        Make a request and read its JSON response.
+
+        :param long_running: Whether to wait for the response indefinitely (e.g. when waiting on a container)
+        :raises DockerAPIError: on error responses
+        """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in (1, 2):
+            connection = self._get_connection()
+            try:
+                connection.sock.settimeout(None if long_running else self.timeout)
+                connection.request(method, self.get_path(path, query), body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                connection.close()
+                if attempt == 2:
+                    raise
+                continue  # The daemon closed the idle connection; retry with a new one
+            except BaseException:
+                connection.close()
+                raise
+            self._put_connection(connection, reusable=(not response.will_close))
+            return self._parse_response(response.status, data)
+
+    def _parse_response(self, status, data):
+        try:
+            value = (json.loads(data.decode('utf-8')) if data else None)
+        except ValueError:
+            value = data.decode('utf-8', 'replace')
+        if status >= 400:
+            raise DockerAPIError(status, (value.get('message') if isinstance(value, dict) else value))
+        return value
+
+    def _get_connection(self):
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+        connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        connection.connect()
+        return connection
+
+    def _put_connection(self, connection, reusable=True):
+        if not reusable:
+            connection.close()
+            return
+        connection.sock.settimeout(self.timeout)
+        with self.lock:
+            self.connections.append(connection)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+
+    def stream(self, method, path, query=None):
+        """
+        Make a request with a streamed (and possibly endless) response, on a connection of its own.
+
+        :return: `StreamedResponse`, to be closed once done
+        """
+        connection = UnixHTTPConnection(self.socket_path, timeout=None)
+        connection.request(method, self.get_path(path, query))
+        response = connection.getresponse()
+        if response.status >= 400:
+            data = response.read()
+            connection.close()
+            self._parse_response(response.status, data)
+        return StreamedResponse(connection, response)
+
+    def has_image(self, image):
+        try:
+            self.request('GET', '/images/{}/json'.format(quote(image, safe='/:@')))
+        except DockerAPIError as dae:
+            if dae.status != 404:
+                raise
+            return False
+        return True
+
+    def pull_image(self, image, cancel=None):
+        """
+        :param cancel: A `threading.Event` to stop pulling at (between progress messages), raising `PullCancelled`
+        """
+        name, tag = split_image_tag(image)
+        response = self.stream('POST', '/images/create', {'fromImage': name, 'tag': tag})
+        try:
+            for line in response:  # Progress messages, one JSON object per line
+                if cancel is not None and cancel.is_set():
+                    raise PullCancelled(image)
+                try:
+                    message = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                if message.get('error'):
+                    raise DockerAPIError(response.response.status, message['error'])
+        finally:
+            response.close()
+
+    def create_container(self, config, name=None):
+        """
+        Create a container, pulling its image first if it isn't available.
+
+        :return: ID of the container
+        """
+        query = ({'name': name} if name else None)
+        try:
+            return self.request('POST', '/containers/create', query=query, body=config)['Id']
+        except DockerAPIError as dae:
+            if dae.status != 404:
+                raise
+        self.pull_image(config['Image'])
+        return self.request('POST', '/containers/create', query=query, body=config)['Id']
+
+    def attach(self, container_id):
+        """
+        Attach to the output streams of a (not yet started) container.
+
+        :return: `StreamedResponse` of the multiplexed output; see `demux_stream()`
+        """
+        connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        query = {'stream': 1, 'stdout': 1, 'stderr': 1}
+        connection.request(
+            'POST',
+            self.get_path('/containers/{}/attach'.format(quote(container_id)), query),
+            headers={'Connection': 'Upgrade', 'Upgrade': 'tcp'},
+        )
+        response = connection.getresponse()
+        if response.status not in (101, 200):
+            data = response.read()
+            connection.close()
+            self._parse_response(response.status, data)
+        connection.sock.settimeout(None)  # Containers may well be quiet for a long while
+        # After the response headers, the connection carries the raw stream
+        return StreamedResponse(connection, response)
+
+    def start(self, container_id):
+        self.request('POST', '/containers/{}/start'.format(quote(container_id)))
+
+    def wait(self, container_id):
+        return self.request('POST', '/containers/{}/wait'.format(quote(container_id)), long_running=True)['StatusCode']
+
+    def remove(self, container_id):
+        self.request('DELETE', '/containers/{}'.format(quote(container_id)), query={'force': 1, 'v': 1})
+
+    def run_container(self, config, name, stdout_files, stderr_files):
+        """
+        Create and run a container, writing its output into the given files, and remove it once it's done.
+
+        :return: A `ContainerRun` with the exit code of the container in `returncode`, like `tee_spawn()`
+        """
+        tees = {1: Tee(stdout_files), 2: Tee(stderr_files)}
+        container_id = self.create_container(config, name=name)
+        try:
+            stream = self.attach(container_id)
+            try:
+                self.start(container_id)
+                demux_stream(stream, tees)
+            finally:
+                stream.close()
+            returncode = self.wait(container_id)
+        finally:
+            try:
+                self.remove(container_id)
+            except DockerAPIError:  # e.g. removed already
+                pass
+        return ContainerRun(returncode, tees)
+
+
+class StreamedResponse:
+    def __init__(self, connection, response):
+        self.connection = connection
+        self.response = response
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def read(self, size):
+        # Read the raw stream, as the connection of an attached container has been upgraded to one
+        return self.response.fp.read(size)
+
+    def close(self):
+        self.response.close()
+        self.connection.close()
+
+
+class ContainerRun:
+    def __init__(self, returncode, tees):
+        self.returncode = returncode
+        self.tee_errors = [error for tee in tees.values() for error in tee.errors]
+        self.tee_bytes = {STREAM_NAMES[stream_type]: tee.n_bytes for (stream_type, tee) in tees.items()}
+
+
+def demux_stream(stream, tees):
+    """
+    Copy the frames of a multiplexed container output stream into `Tee`s until the stream ends.
+
+    :param tees: Dict of stream type (1 for stdout, 2 for stderr) -> `Tee`
+    """
+    while True:
+        header = read_exactly(stream, FRAME_HEADER.size)
+        if not header:
+            return
+        stream_type, size = FRAME_HEADER.unpack(header)
+        data = read_exactly(stream, size)
+        tee = tees.get(stream_type)
+        if tee:
+            tee.write(data)
+        if len(data) < size:  # Truncated
+            return
+
+
+def read_exactly(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def split_image_tag(image):
+    """
+    Split an image reference into name and tag (or digest),
+    e.g. `localhost:5000/app:1.0` into `localhost:5000/app` and `1.0`.
+    """
+    if '@' in image:
+        return tuple(image.split('@', 1))
+    name, sep, tag = image.rpartition(':')
+    if not sep or '/' in tag:
+        return (image, 'latest')
+    return (name, tag)
+
+
+def build_container_config(image, command, env_vars, volumes, workdir, cpus=None, memory=None):
+    """
+    Build the configuration for creating a container, equivalent to the `docker run` command of `LocalExecutor`.
+
+    :param volumes: List of volume dicts (`source`, `destination`, `readonly`)
+    """
+    binds = []
+    for volume in volumes:
+        bind = '{}:{}'.format(os.path.realpath(volume['source']), volume['destination'])
+        if volume.get('readonly'):
+            bind += ':ro'
+        binds.append(bind)
+    host_config = {'Binds': binds}
+    if cpus:
+        host_config['NanoCpus'] = int(float(cpus) * 1e9)
+    if memory:
+        host_config['Memory'] = parse_size(memory)
+    return {
+        'Image': image,
+        'Entrypoint': [''],
+        'Cmd': ['/bin/sh', '-c', command],
+        'WorkingDir': workdir,
+        'Env': ['{}={}'.format(key, value) for (key, value) in sorted(env_vars.items())],
+        'AttachStdout': True,
+        'AttachStderr': True,
+        'Tty': False,
+        'HostConfig': host_config,
+    }
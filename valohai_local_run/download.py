@@ -1,44 +1,404 @@
+import fcntl
 import hashlib
+import json
 import os
-import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 
-from .utils import ensure_makedirs
+from .cache import DownloadCache, get_cache_key
+from .consts import DEFAULT_DOWNLOAD_CONCURRENCY
+from .profiling import Profiler
+from .s3 import S3Client, is_s3_url, parse_s3_url
+from .utils import hash_file, warn
 
 
-def download_url(url, with_progress=True):
-    cache_identifier = url
-    if '?' in cache_identifier:
-        cache_identifier = cache_identifier[:cache_identifier.index('?')]
+def download_url(url, with_progress=True, revalidate=False):
+    return download_urls([url], with_progress=with_progress, revalidate=revalidate)[url]
 
-    _, ext = os.path.splitext(cache_identifier)
-    cache_filename = 'download-%s%s' % (
-        hashlib.sha1(cache_identifier.encode('utf-8')).hexdigest(),
-        ext,
-    )
 
-    cache_path = os.path.join(tempfile.gettempdir(), 'valohai-local-run-cache')
-    ensure_makedirs(cache_path, 0o770)
-    cache_path = os.path.join(cache_path, cache_filename)
-    if not os.path.isfile(cache_path):
+def download_urls(
+    urls,
+    concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+    with_progress=True,
+    revalidate=False,
+    cache=None,
+    profiler=None,
+    cancel=None,
+):
+    """
+    Download the given URLs into the local cache, `concurrency` at a time.
+
+    Interrupted downloads are resumed with a HTTP Range request the next time around.
+    Large S3 objects are downloaded in parts, with parallel ranged GETs.
+
+    :param urls: Iterable of HTTP/HTTPS or `s3://` URLs
+    :param concurrency: Maximum number of simultaneous downloads
+    :param with_progress: Whether to show a (combined) progress bar
+    :param revalidate: Whether to revalidate cached files with a conditional request
+    :param cache: The `DownloadCache` to use; defaults to the standard one
+    :param profiler: A `Profiler` to record the download phase and the number of bytes downloaded in
+    :param cancel: A `threading.Event` that aborts the downloads (with `DownloadCancelled`) once set
+    :return: Dict of URL -> local cache path
+    """
+    cache = (cache or DownloadCache())
+    profiler = (profiler or Profiler())
+    urls = list(urls)
+    urls_by_key = {}
+    for url in urls:
+        urls_by_key.setdefault(get_cache_key(url), url)
+
+    paths = {}
+    pending = []
+    for key, url in urls_by_key.items():
+        entry = cache.lookup(key)
+        if entry and not revalidate:
+            paths[key] = cache.get_path(key)
+            profiler.count('download_cache_hits')
+        else:
+            pending.append((key, url, entry))
+
+    if pending:
+        paths.update(run_downloads(
+            'download', pending, cache, urls_by_key, concurrency, with_progress, profiler, cancel=cancel,
+        ))
+
+    return {url: paths[get_cache_key(url)] for url in urls}
+
+
+def extract_urls(
+    urls,
+    extraction_cache,
+    concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+    with_progress=True,
+    revalidate=False,
+    cache=None,
+    profiler=None,
+    cancel=None,
+):
+    """
+    Download tar archives, extracting them into an `ExtractionCache` as they stream in; the archives
+    themselves are not stored anywhere.
+
+    See `download_urls()` for the parameters.
+
+    :return: Dict of URL -> path of the extracted tree
+    """
+    cache = (cache or DownloadCache())
+    profiler = (profiler or Profiler())
+    urls = list(urls)
+    urls_by_key = {}
+    for url in urls:
+        urls_by_key.setdefault(get_cache_key(url), url)
+
+    paths = {}
+    pending = []
+    for key, url in urls_by_key.items():
+        path = extraction_cache.lookup(key)
+        if path and not revalidate:
+            paths[key] = path
+            profiler.count('download_cache_hits')
+        else:
+            pending.append((key, url, extraction_cache))
+
+    if pending:
+        paths.update(run_downloads(
+            'extract', pending, cache, urls_by_key, concurrency, with_progress, profiler, cancel=cancel,
+        ))
+
+    return {url: paths[get_cache_key(url)] for url in urls}
+
+
+def run_downloads(method, pending, cache, keep, concurrency, with_progress, profiler, cancel=None):
+    """
+    Call a method of a `Downloader` for each (key, URL, argument) tuple in `pending`, `concurrency` at a time.
+
+    :return: Dict of key -> return value
+    """
+    try:
+        import requests  # noqa
+    except ImportError:
+        raise RuntimeError(
+            'The `requests` module must be available for download support (attempting to download %s)' %
+            pending[0][1]
+        )
+
+    results = {}
+    label = (pending[0][1] if len(pending) == 1 else 'Downloading {} files'.format(len(pending)))
+    progress = DownloadProgress(label=label, visible=with_progress)
+    downloader = Downloader(cache=cache, progress=progress, keep=keep, profiler=profiler, cancel=cancel)
+    max_workers = max(1, min(concurrency, len(pending)))
+    with profiler.phase('download'), progress, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(getattr(downloader, method), key, url, argument): key
+            for (key, url, argument) in pending
+        }
         try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        except:  # noqa
+            downloader.cancel.set()
+            raise
+    return results
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+class Downloader:
+    """
+    Downloads files into a `DownloadCache`; `download()` may be called from multiple threads.
+    """
+
+    def __init__(self, cache, progress, keep=(), profiler=None, cancel=None):
+        self.cache = cache
+        self.progress = progress
+        self.profiler = (profiler or Profiler())
+        self.keep = set(keep)
+        self.cancel = (cancel or threading.Event())
+        self.local = threading.local()
+        self.s3_lock = threading.Lock()
+        self.s3_client = None
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
             import requests
-        except ImportError:
-            raise RuntimeError(
-                'The `requests` module must be available for download support (attempting to download %s)' % url
-            )
+            self.local.session = requests.Session()
+        return self.local.session
+
+    @property
+    def s3(self):
+        with self.s3_lock:
+            if not self.s3_client:
+                self.s3_client = S3Client.from_env()
+            return self.s3_client
 
-        r = requests.get(url, stream=True)
+    def download(self, key, url, entry=None):
+        # Only one thread or process may download a given file at a time
+        with open(self.cache.get_partial_path(key) + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self.cancel.is_set():  # e.g. while waiting for the lock
+                    raise DownloadCancelled(url)
+                if not entry:
+                    # Someone else may have finished downloading this file while we waited for the lock
+                    if self.cache.lookup(key):
+                        return self.cache.get_path(key)
+                    return self._download(key, url)
+                return self._revalidate(key, url, entry)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def extract(self, key, url, extraction_cache):
+        """
+        Download a tar archive, extracting it into `extraction_cache` as it streams in.
+        The archive is fetched with a conditional request if it has been extracted before.
+
+        :return: Path of the extracted tree
+        """
+        with open(self.cache.get_partial_path(key) + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self.cancel.is_set():
+                    raise DownloadCancelled(url)
+                validators = extraction_cache.get_validators(key)
+                headers = {}
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
+                r = self.session.get(url, stream=True, headers=headers)
+                if r.status_code == 304:
+                    r.close()
+                    path = extraction_cache.lookup(key)
+                    if path:
+                        return path
+                    r = self.session.get(url, stream=True)
+                r.raise_for_status()
+                if 'content-length' in r.headers:
+                    self.progress.add_length(int(r.headers['content-length']))
+                with r:
+                    return extraction_cache.extract_stream(key, self._iter_content(r, url), validators={
+                        'etag': r.headers.get('etag'),
+                        'last_modified': r.headers.get('last-modified'),
+                    })
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _iter_content(self, r, url):
+        for chunk in r.iter_content(chunk_size=1048576):
+            if self.cancel.is_set():
+                raise DownloadCancelled(url)
+            if chunk:  # pragma: no branch
+                self._received(len(chunk))
+                yield chunk
+
+    def _revalidate(self, key, url, entry):
+        if is_s3_url(url):
+            return self._revalidate_s3(key, url, entry)
+        import requests
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        if not headers:  # Nothing to revalidate with; trust what we have
+            return self.cache.get_path(key)
+        try:
+            r = self.session.get(url, stream=True, headers=headers)
+        except requests.RequestException as exc:
+            self.warn('Could not revalidate {} ({}); using cached copy'.format(url, exc))
+            return self.cache.get_path(key)
+        if r.status_code == 304:
+            r.close()
+            return self.cache.get_path(key)
+        if not r.ok:
+            r.close()
+            self.warn('Could not revalidate {} (HTTP {}); using cached copy'.format(url, r.status_code))
+            return self.cache.get_path(key)
+        return self._receive(key, url, r, offset=0)
+
+    def _revalidate_s3(self, key, url, entry):
+        import requests
+        try:
+            obj = self.s3.head_object(*parse_s3_url(url))
+        except requests.RequestException as exc:
+            self.warn('Could not revalidate {} ({}); using cached copy'.format(url, exc))
+            return self.cache.get_path(key)
+        if entry.get('etag') and obj.etag == entry['etag']:
+            return self.cache.get_path(key)
+        return self._download_s3(key, url, obj)
+
+    def _download(self, key, url):
+        if is_s3_url(url):
+            return self._download_s3(key, url)
+        partial_path = self.cache.get_partial_path(key)
+        validator = self._read_partial_validator(partial_path)
+        headers = {}
+        if validator and os.path.isfile(partial_path):
+            # Resume the partial download, if (and only if) the remote file hasn't changed since.
+            headers['Range'] = 'bytes=%d-' % os.path.getsize(partial_path)
+            headers['If-Range'] = validator
+        r = self.session.get(url, stream=True, headers=headers)
+        if headers and r.status_code == 416:  # Range Not Satisfiable; the partial file is bogus
+            r.close()
+            os.unlink(partial_path)
+            return self._download(key, url)
         r.raise_for_status()
-        total = (int(r.headers['content-length']) if 'content-length' in r.headers else None)
-        byte_iterator = r.iter_content(chunk_size=1048576)
+        return self._receive(key, url, r, offset=(
+            os.path.getsize(partial_path) if r.status_code == 206 else 0
+        ))
+
+    def _receive(self, key, url, r, offset):
+        partial_path = self.cache.get_partial_path(key)
+        etag = r.headers.get('etag')
+        last_modified = r.headers.get('last-modified')
+        hasher = hashlib.sha256()
+        if offset:
+            with open(partial_path, 'rb') as infp:
+                for chunk in iter(lambda: infp.read(1048576), b''):
+                    hasher.update(chunk)
+        else:
+            with open(partial_path + '.json', 'w') as outf:
+                json.dump({'etag': etag, 'last_modified': last_modified}, outf)
 
-        progress = click.progressbar(byte_iterator, length=total, label=url, width=0)
-        progress.is_hidden = (not with_progress)
+        expected_size = None
+        if 'content-length' in r.headers:
+            expected_size = offset + int(r.headers['content-length'])
+            self.progress.add_length(expected_size)
+        self.progress.update(offset)
 
-        with open(cache_path, 'wb') as f, progress:
-            for chunk in progress:
+        with r, open(partial_path, ('ab' if offset else 'wb')) as f:
+            for chunk in r.iter_content(chunk_size=1048576):
+                if self.cancel.is_set():
+                    raise DownloadCancelled(url)
                 if chunk:  # pragma: no branch
                     f.write(chunk)
-    return cache_path
+                    hasher.update(chunk)
+                    self.progress.update(len(chunk))
+                    self.profiler.count('download_bytes', len(chunk))
+
+        if expected_size is not None and os.path.getsize(partial_path) != expected_size:
+            raise IOError('Download of %s was truncated; it will be resumed on the next attempt' % url)
+        path = self.cache.store(
+            key,
+            partial_path,
+            url=url,
+            sha256=hasher.hexdigest(),
+            etag=etag,
+            last_modified=last_modified,
+            keep=self.keep,
+        )
+        os.unlink(partial_path + '.json')
+        return path
+
+    def _download_s3(self, key, url, obj=None):
+        # The parts are written out of order, so the file is hashed once it's complete (and not resumed if interrupted)
+        partial_path = self.cache.get_partial_path(key)
+        obj = (obj or self.s3.head_object(*parse_s3_url(url)))
+        self.progress.add_length(obj.size)
+        self.s3.download_object(obj, partial_path, on_data=self._received, cancel=self.cancel)
+        return self.cache.store(
+            key,
+            partial_path,
+            url=url,
+            sha256=hash_file(partial_path),
+            etag=obj.etag,
+            keep=self.keep,
+        )
+
+    def warn(self, message):
+        warn(message, verbose=self.progress.visible)
+
+    def _received(self, n):
+        self.progress.update(n)
+        self.profiler.count('download_bytes', n)
+
+    def _read_partial_validator(self, partial_path):
+        try:
+            with open(partial_path + '.json') as infp:
+                meta = json.load(infp)
+        except (IOError, ValueError):
+            return None
+        return (meta.get('etag') or meta.get('last_modified'))
+
+
+class DownloadProgress:
+    """
+    A single progress bar shared by a number of concurrent downloads.
+
+    The total length grows as the downloads learn their content lengths.
+    """
+
+    def __init__(self, label, visible=True):
+        self.lock = threading.Lock()
+        self.visible = visible
+        self.bar = None
+        if visible:  # Even a hidden click progress bar prints its label
+            self.bar = click.progressbar(length=1, label=label, width=0)
+            self.bar.length = 0
+
+    def add_length(self, n):
+        if not self.bar:
+            return
+        with self.lock:
+            self.bar.length += n
+            self.bar.finished = False
+
+    def update(self, n):
+        if not (n and self.bar):
+            return
+        with self.lock:
+            self.bar.update(n)
+
+    def __enter__(self):
+        if self.bar:
+            self.bar.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.bar:
+            return self.bar.__exit__(*args)
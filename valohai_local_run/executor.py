@@ -1,20 +1,34 @@
 import datetime
 import json
 import os
+import posixpath
+import sqlite3
 import subprocess
 import sys
-import tempfile
+import threading
 import time
-from itertools import chain
+from contextlib import ExitStack, contextmanager
 
 from click import echo, secho, style
 
 from .consts import EXECUTION_METADATA_JSON_NAME, STDERR_LOG_NAME, STDOUT_LOG_NAME
+from .archives import ExtractionCache
+from .checkout import CheckoutCache
 from .compat import text_type
-from .consts import volume_mount_targets
-from .inputs import prepare_inputs
-from .tee import tee_spawn
-from .utils import ensure_makedirs, get_random_string
+from .consts import DEFAULT_DOWNLOAD_CONCURRENCY, volume_mount_targets
+from .dockerapi import DockerAPIError, build_container_config
+from .history import HistoryIndex
+from .inputs import InputStore, prepare_inputs
+from .lazyfs import LazyMount
+from .logstore import StructuredLogWriter
+from .memo import get_fingerprint, link_outputs
+from .metrics import MetricsCollector, print_metrics_summary
+from .outputs import build_manifest, get_zstandard, read_manifest, walk_outputs, write_archive, write_manifest
+from .prefetch import ensure_image, run_concurrently
+from .profiling import Profiler
+from .telemetry import TelemetrySampler, get_source
+from .tee import READ_SIZE, tee_spawn, write_fully
+from .utils import ensure_makedirs, get_random_string, warn
 
 
 def build_volume_params(volumes):
@@ -50,6 +64,24 @@ class LocalExecutor:
         docker_command='docker',
         docker_add_args=None,
         gitless=False,
+        download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+        revalidate_inputs=False,
+        extract_inputs=False,
+        lazy_inputs=False,
+        checkout_cache=None,
+        cpus=None,
+        memory=None,
+        structured_logs=False,
+        collect_metrics=True,
+        input_store=None,
+        container_pool=None,
+        profiler=None,
+        memo_index=None,
+        docker_client=None,
+        manifest=True,
+        pack_outputs=False,
+        telemetry_interval=None,
+        history=True,
     ):
         self.project_id = project_id
         self.directory = directory
@@ -67,43 +99,280 @@ class LocalExecutor:
         self.docker_add_args = docker_add_args
         self.execution_id = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), get_random_string(5))
         self.gitless = gitless
+        self.download_concurrency = download_concurrency
+        self.revalidate_inputs = revalidate_inputs
+        self.extract_inputs = extract_inputs
+        self.lazy_inputs = lazy_inputs
+        self.lazy_mount = None  # Mounted in `mount_lazy_inputs()`
+        self.checkout_cache = checkout_cache
+        self.input_store = input_store
+        self.input_tree_id = None  # Set once the inputs have been staged in `stage_inputs()`
+        self.container_pool = container_pool
+        self.docker_client = docker_client  # Run with the Docker Engine API instead of the `docker` command, if set
+        self.pooled_container = None  # Acquired from the pool in `build_pool_command()`
+        self.profiler = (profiler or Profiler())
+        # The working directory may change between gitless executions, and lazily read inputs aren't hashed,
+        # so there's no telling whether such executions are identical
+        self.memo_index = (memo_index if not (gitless or lazy_inputs) else None)
+        self.memoized_from = None  # Output directory of an identical execution, found in `prepare()`
+        self.prepared_command = None
+        self.cpus = cpus
+        self.memory = memory
+        self.structured_logs = structured_logs
+        self.collect_metrics = collect_metrics
+        self.manifest = manifest
+        self.pack_outputs = pack_outputs
+        self.telemetry_interval = telemetry_interval  # Seconds between resource usage samples, if sampling at all
+        self.history_index = (HistoryIndex(output_root) if history else None)
+        self.time = datetime.datetime.now()
+        self.results = {}  # Recorded into the metadata file once the execution finishes
+        self.verbose = False  # Whether to print warnings (rather than only log them); set by `execute()`
         if self.gitless:
             self.repository_dir = self.directory
         else:
-            self.repository_dir = tempfile.mkdtemp(prefix='valohai-code-' + self.execution_id)
-        self.output_dir = os.path.join(output_root, self.execution_id)
-        ensure_makedirs(self.output_dir, 0o770)
+            self.repository_dir = None  # Acquired from the checkout cache in `checkout_repo()`
+        self.output_dir = os.path.join(output_root, self.execution_id)  # Created in `prepare()`
 
     def prepare(self, verbose):
-        input_volumes = list(prepare_inputs(self.inputs, verbose=verbose))
-        if not self.gitless:
-            self.clone_repo()
-        docker_command = self.build_docker_command(input_volumes)
-        self.write_metadata_file(docker_command)
+        if self.pack_outputs:
+            get_zstandard()  # Fail before running, rather than after
+        with self.profiler.phase('prepare'):
+            ensure_makedirs(self.output_dir, 0o770)
+            input_mounts = self.fetch(verbose)
+            if self.memo_index:
+                with self.profiler.phase('memo_lookup'):
+                    self.results['fingerprint'] = self.get_fingerprint(input_mounts)
+                    self.memoized_from = self.memo_index.get(self.results['fingerprint'])
+                if self.memoized_from:
+                    self.write_metadata_file()
+                    return None
+                with self.profiler.phase('pull_image'):
+                    self.pull_image()
+            with self.profiler.phase('stage_inputs'):
+                input_volumes = self.stage_inputs(self.mount_lazy_inputs(input_mounts))
+            docker_command = None
+            if self.container_pool:
+                with self.profiler.phase('acquire_container'):
+                    docker_command = self.build_pool_command(input_volumes)
+            if not docker_command and self.docker_client:
+                docker_command = self.build_container_config(input_volumes)
+            if not docker_command:
+                docker_command = self.build_docker_command(input_volumes)
+            self.prepared_command = docker_command
+            self.write_metadata_file(docker_command)
         return docker_command
 
-    def execute(self, verbose=False, save_logs=True):
+    def fetch(self, verbose):
+        """
+        Download the inputs, check out the repository and pull the image, all at the same time.
+
+        If one of them fails, the downloads and the pull are cancelled, and the error is raised
+        once the checkout (which can't be interrupted) has finished too.
+        When memoizing, the image is only pulled once there turns out to be no identical execution to reuse.
+
+        :return: List of input mounts (see `prepare_inputs()`)
+        """
+        cancel = threading.Event()
+        tasks = {
+            'prepare_inputs': lambda: list(prepare_inputs(
+                self.inputs,
+                verbose=verbose,
+                download_concurrency=self.download_concurrency,
+                revalidate=self.revalidate_inputs,
+                profiler=self.profiler,
+                extract_archives=self.extract_inputs,
+                cancel=cancel,
+                lazy=self.lazy_inputs,
+                lease_id=self.execution_id,
+            )),
+        }
+        if not self.memo_index:
+            tasks['pull_image'] = lambda: self.pull_image(cancel=cancel)
+        if not self.gitless:
+            tasks['checkout'] = self.checkout_repo
+        return run_concurrently(tasks, cancel, profiler=self.profiler)['prepare_inputs']
+
+    def pull_image(self, cancel=None):
+        try:
+            if self.ensure_image(cancel=cancel):
+                self.profiler.count('images_pulled')
+        except (RuntimeError, DockerAPIError) as exc:
+            # Not fatal as such; running the container will report the problem (with an exit code) all the same
+            warn('Could not pull image {}: {}'.format(self.image, exc), verbose=self.verbose)
+
+    def ensure_image(self, cancel=None):
+        """
+        :return: Whether the image had to be pulled
+        """
+        return ensure_image(self.image, self.docker_command, docker_client=self.docker_client, cancel=cancel)
+
+    def execute(self, verbose=False, save_logs=True, tee_output=True, output_files=None):
+        """
+        Prepare and run the execution.
+
+        :param verbose: Whether to print information about the execution
+        :param save_logs: Whether to save the output streams into the output directory
+        :param tee_output: Whether to pass the output streams through to our stdout and stderr
+        :param output_files: Dict of stream name (`stdout` or `stderr`) -> list of additional files to write it into
+        :return: Exit code of the container (or 0, when reusing the outputs of an identical execution)
+        """
+        self.verbose = verbose
+        try:
+            ret = self._execute(verbose=verbose, save_logs=save_logs, tee_output=tee_output, output_files=output_files)
+        finally:
+            with self.profiler.phase('cleanup'):
+                self.release_container()
+                self.release_repo()
+                self.release_inputs()
+        self.results['profile'] = self.profiler.as_dict()
+        self.write_metadata_file(self.prepared_command)
+        if ret == 0 and self.memo_index and not self.memoized_from:
+            self.memo_index.add(self.results['fingerprint'], self.execution_id)
+        return ret
+
+    def _execute(self, verbose, save_logs, tee_output, output_files):
         command = self.prepare(verbose=verbose)
         if verbose:
             self.print_report()
-        if save_logs:
-            stdout_path = os.path.join(self.output_dir, STDOUT_LOG_NAME)
-            stderr_path = os.path.join(self.output_dir, STDERR_LOG_NAME)
-            binary_stdout = getattr(sys.stdout, 'buffer', sys.stdout)
-            binary_stderr = getattr(sys.stderr, 'buffer', sys.stderr)
-            with open(stdout_path, 'wb') as stdout_file, open(stderr_path, 'wb') as stderr_file:
-                proc = tee_spawn(
-                    command,
-                    stdout_files=(binary_stdout, stdout_file),
-                    stderr_files=(binary_stderr, stderr_file),
-                )
-            ret = proc.returncode
+        if self.memoized_from:
+            ret = self.reuse_outputs(self.get_output_files(tee_output, output_files))
+        elif save_logs:
+            ret = self.run_with_logs(command, self.get_output_files(tee_output, output_files))
         else:
-            ret = subprocess.call(command)
+            with self.profiler.phase('run'):
+                ret = self.run_without_logs(command, tee_output=tee_output, output_files=output_files)
+        self.release_container()  # Before looking at the outputs, which it may have been holding
+        self.results['exit_code'] = ret
+        self.process_outputs()
         if verbose:
+            print_metrics_summary(self.results.get('metrics'))
             secho('=== Execution finished with code {} ==='.format(ret), bold=True, fg=('red' if ret else 'green'))
         return ret
 
+    def get_output_files(self, tee_output, output_files=None):
+        """
+        :return: Dict of stream name -> list of files to write the stream into (other than the logs)
+        """
+        output_files = (output_files or {})
+        return {
+            name: list(output_files.get(name, ())) + ([getattr(stream, 'buffer', stream)] if tee_output else [])
+            for (name, stream) in (('stdout', sys.stdout), ('stderr', sys.stderr))
+        }
+
+    def run_with_logs(self, command, output_files):
+        stdout_path = os.path.join(self.output_dir, STDOUT_LOG_NAME)
+        stderr_path = os.path.join(self.output_dir, STDERR_LOG_NAME)
+        with ExitStack() as stack:
+            stdout_files = [stack.enter_context(open(stdout_path, 'wb'))] + output_files['stdout']
+            stderr_files = [stack.enter_context(open(stderr_path, 'wb'))] + output_files['stderr']
+            if self.structured_logs:
+                log_writer = stack.enter_context(StructuredLogWriter(self.output_dir))
+                stdout_files.append(log_writer.stream('stdout'))
+                stderr_files.append(log_writer.stream('stderr'))
+            if self.collect_metrics:
+                metrics = stack.enter_context(MetricsCollector(self.output_dir))
+                stdout_files.append(metrics)
+            with self.profiler.phase('run'):  # Includes starting the container, unless it's pooled
+                proc = self.spawn(command, stdout_files=stdout_files, stderr_files=stderr_files)
+            with self.profiler.phase('flush_logs'):
+                stack.close()
+        for file, exc in proc.tee_errors:
+            warn('Could not write output to {}: {}'.format(getattr(file, 'name', file), exc), verbose=self.verbose,
+                fg='red')
+        for name, n_bytes in proc.tee_bytes.items():
+            self.profiler.count('{}_bytes'.format(name), n_bytes)
+        if self.collect_metrics:
+            self.results['metrics'] = metrics.summary()
+        return proc.returncode
+
+    def process_outputs(self):
+        """
+        Write the manifest of the output files (see `outputs.build_manifest()`), and pack them if requested.
+        """
+        output_files = None
+        if self.manifest:
+            with self.profiler.phase('manifest'):
+                # The outputs of a memoized execution are links to the same files, so they needn't be hashed again
+                previous = (read_manifest(self.memoized_from) if self.memoized_from else None)
+                entries, n_hashed = build_manifest(self.output_dir, previous=previous)
+                write_manifest(self.output_dir, entries)
+            output_files = [entry['path'] for entry in entries]
+            self.results['outputs'] = {
+                'files': len(entries),
+                'size': sum(entry['size'] for entry in entries),
+                'hashed': n_hashed,
+            }
+        if self.pack_outputs:
+            with self.profiler.phase('pack_outputs'):
+                if output_files is None:
+                    output_files = [relative_path for (path, relative_path) in walk_outputs(self.output_dir)]
+                write_archive(self.output_dir, output_files)
+
+    def run_without_logs(self, command, tee_output, output_files=None):
+        if isinstance(command, dict) or output_files:
+            output_files = self.get_output_files(tee_output, output_files)
+            proc = self.spawn(command, stdout_files=output_files['stdout'], stderr_files=output_files['stderr'])
+            return proc.returncode
+        with self.sample_telemetry():
+            if tee_output:
+                return subprocess.call(command)
+            return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def spawn(self, command, stdout_files, stderr_files):
+        """
+        Run the prepared command (or container configuration), writing its output into the given files.
+
+        :return: Object with the exit code as `returncode`, and `tee_errors` and `tee_bytes` (see `tee_spawn()`)
+        """
+        with self.sample_telemetry():
+            if isinstance(command, dict):  # Configuration for the Docker Engine API; see `build_container_config()`
+                return self.docker_client.run_container(
+                    command,
+                    name=self.get_container_name(),
+                    stdout_files=stdout_files,
+                    stderr_files=stderr_files,
+                )
+            return tee_spawn(command, stdout_files=stdout_files, stderr_files=stderr_files)
+
+    @contextmanager
+    def sample_telemetry(self):
+        if not self.telemetry_interval:
+            yield
+            return
+        container_name = (self.pooled_container.name if self.pooled_container else self.get_container_name())
+        sampler = TelemetrySampler(
+            self.output_dir,
+            get_source=lambda: get_source(
+                container_name,
+                docker_command=self.docker_command,
+                docker_client=self.docker_client,
+            ),
+            interval=self.telemetry_interval,
+        )
+        with sampler:
+            yield
+        self.results['telemetry'] = sampler.summary()
+
+    def reuse_outputs(self, output_files):
+        with self.profiler.phase('link_outputs'):
+            link_outputs(self.memoized_from, self.output_dir)
+        with open(os.path.join(self.memoized_from, EXECUTION_METADATA_JSON_NAME), 'r') as infp:
+            metadata = json.load(infp)
+        if 'metrics' in metadata:
+            self.results['metrics'] = metadata['metrics']
+        self.results['memoized_from'] = os.path.basename(self.memoized_from)
+        for name, log_name in (('stdout', STDOUT_LOG_NAME), ('stderr', STDERR_LOG_NAME)):  # Replay the output
+            path = os.path.join(self.output_dir, log_name)
+            if output_files[name] and os.path.isfile(path):
+                with open(path, 'rb') as infp:
+                    for chunk in iter(lambda: infp.read(READ_SIZE), b''):
+                        for file in output_files[name]:
+                            write_fully(file, chunk)
+                for file in output_files[name]:
+                    if hasattr(file, 'flush'):
+                        file.flush()
+        return 0
+
     def print_report(self):
         echo('-> Using commit {}, step "{}"'.format(
             style(self.commit, bold=True),
@@ -112,14 +381,26 @@ class LocalExecutor:
         echo('-> Using image {}'.format(style(self.image, bold=True)))
         echo('-> Using command {}'.format(style(text_type(self.command), bold=True)))
         echo('=> Outputs will be written to {}'.format(style(self.output_dir, bold=True)))
+        if self.memoized_from:
+            secho('=== Reusing the outputs of identical execution {} ==='.format(
+                os.path.basename(self.memoized_from),
+            ), bold=True, fg='green')
+            return
         secho('=== Starting execution! ===', bold=True, fg='green')
 
     def write_metadata_file(self, docker_command=None):
-        with open(os.path.join(self.output_dir, EXECUTION_METADATA_JSON_NAME), 'w') as outf:
-            json.dump(self.get_metadata_blob(docker_command), outf, indent=2, sort_keys=True, ensure_ascii=True)
+        path = os.path.join(self.output_dir, EXECUTION_METADATA_JSON_NAME)
+        metadata = self.get_metadata_blob(docker_command)
+        with open(path, 'w') as outf:
+            json.dump(metadata, outf, indent=2, sort_keys=True, ensure_ascii=True)
+        if self.history_index:
+            try:
+                self.history_index.update(self.execution_id, metadata, os.stat(path).st_mtime_ns)
+            except sqlite3.Error as exc:  # The index can be backfilled later; no reason to fail the execution
+                warn('Could not update the execution history index: {}'.format(exc), verbose=self.verbose)
 
     def get_metadata_blob(self, docker_command=None):
-        return {
+        blob = {
             'command': self.command,
             'commit': self.commit,
             'image': self.image,
@@ -128,30 +409,90 @@ class LocalExecutor:
             'parameters': self.parameters,
             'project': self.project_id,
             'step': self.step.name,
-            'time': datetime.datetime.now().isoformat(),
+            'time': self.time.isoformat(),
             'docker_command': docker_command,
         }
+        blob.update(self.results)
+        return blob
 
-    def clone_repo(self):
-        assert not self.gitless, 'clone_repo() must not be called in  gitless mode'
-        # Clone the desired commit into a temporary directory.
-        source_git_dir = self.directory
-        assert os.path.isdir(source_git_dir)
-        dest_git_dir = self.repository_dir
-        subprocess.check_call(
-            ['git', 'clone', '--shared', '--no-checkout', '--', source_git_dir, dest_git_dir],
-            stderr=subprocess.DEVNULL,
-        )
-        subprocess.check_call(
-            ['git', 'checkout', self.commit],
-            cwd=dest_git_dir,
-            stderr=subprocess.DEVNULL,
-        )
-        subprocess.check_call(
-            ['git', 'submodule', 'update', '--init'],
-            cwd=dest_git_dir,
+    def get_fingerprint(self, input_mounts):
+        paths = {}  # Path in the container -> local path of every input file
+        for mount in input_mounts:
+            if not os.path.isdir(mount['source']):
+                paths[mount['destination']] = mount['source']
+                continue
+            for dirpath, dirnames, filenames in os.walk(mount['source']):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    relative_path = os.path.relpath(path, mount['source']).replace(os.sep, '/')
+                    paths[posixpath.join(mount['destination'], relative_path)] = path
+        if not self.input_store:
+            self.input_store = InputStore()
+        digests = self.input_store.get_digests(paths.values())
+        return get_fingerprint(
+            commit=self.commit,
+            image=self.image,
+            interpolated_command=self.interpolated_command,
+            parameters=self.parameters,
+            input_digests={destination: digests[path] for (destination, path) in paths.items()},
+            docker_add_args=self.docker_add_args,
         )
 
+    def checkout_repo(self):
+        assert not self.gitless, 'checkout_repo() must not be called in gitless mode'
+        # Get a (shared, read-only) checkout of the desired commit.
+        assert os.path.isdir(self.directory)
+        if not self.checkout_cache:
+            self.checkout_cache = CheckoutCache()
+        self.repository_dir = self.checkout_cache.acquire(self.directory, self.commit, lease_id=self.execution_id)
+
+    def release_repo(self):
+        if self.gitless or not self.repository_dir:
+            return
+        self.checkout_cache.release(self.commit, lease_id=self.execution_id)
+        self.repository_dir = None
+
+    def stage_inputs(self, input_mounts):
+        # Link the inputs into a single tree in the input store, so they can be mounted with one volume
+        input_mounts = list(input_mounts)
+        if not input_mounts:
+            return []
+        if not self.input_store:
+            self.input_store = InputStore()
+        self.input_tree_id = self.execution_id
+        return self.input_store.build_tree(self.input_tree_id, input_mounts)
+
+    def release_inputs(self):
+        if self.lazy_mount:
+            self.lazy_mount.stop()
+            self.lazy_mount = None
+        if self.extract_inputs:
+            ExtractionCache().release(self.execution_id)
+        if not self.input_tree_id:
+            return
+        self.input_store.release_tree(self.input_tree_id)
+        self.input_tree_id = None
+
+    def mount_lazy_inputs(self, input_mounts):
+        """
+        Mount the inputs to be read lazily (see `prepare_inputs()`) with a FUSE filesystem, and point their volumes
+        at it.  Being on a filesystem of their own, they're mounted into the container separately.
+        """
+        def get_relative_path(mount):
+            return posixpath.relpath(mount['destination'], volume_mount_targets['inputs'])
+
+        readers = {get_relative_path(mount): mount['reader'] for mount in input_mounts if mount.get('reader')}
+        if not readers:
+            return input_mounts
+        self.lazy_mount = LazyMount(readers, verbose=self.verbose).start()
+        mounts = []
+        for mount in input_mounts:
+            if mount.get('reader'):
+                mount = dict(mount, source=self.lazy_mount.get_path(get_relative_path(mount)))
+                del mount['reader']
+            mounts.append(mount)
+        return mounts
+
     def build_docker_command(self, input_volumes=()):
         command = ' && '.join(self.interpolated_command)
 
@@ -164,17 +505,11 @@ class LocalExecutor:
             '-a', 'stdout',
             '-a', 'stderr',
             '-i',
-            '--name', 'valohai-local-%s' % self.execution_id,
+            '--rm',
+            '--name', self.get_container_name(),
         ]
-        if self.docker_add_args:
-            docker_command.extend(self.docker_add_args.split())
-        env_vars = {
-            'PYTHONUNBUFFERED': '1',
-            'VH_REPOSITORY_DIR': volume_mount_targets['repository'],
-            'VH_INPUTS_DIR': volume_mount_targets['inputs'],
-            'VH_OUTPUTS_DIR': volume_mount_targets['outputs'],
-        }
-        docker_command.extend(build_env_params(env_vars))
+        docker_command.extend(self.get_run_args())
+        docker_command.extend(build_env_params(self.get_env_vars()))
         docker_command.extend(self.build_volume_params(input_volumes))
         docker_command.extend([
             self.image,
@@ -184,9 +519,84 @@ class LocalExecutor:
         ])
         return docker_command
 
-    def build_volume_params(self, input_volumes):
+    def build_container_config(self, input_volumes=()):
+        return build_container_config(
+            image=self.image,
+            command=' && '.join(self.interpolated_command),
+            env_vars=self.get_env_vars(),
+            volumes=self.get_volumes(input_volumes),
+            workdir=volume_mount_targets['repository'],
+            cpus=self.cpus,
+            memory=self.memory,
+        )
+
+    def get_container_name(self):
+        return 'valohai-local-%s' % self.execution_id
+
+    def build_pool_command(self, input_volumes=()):
+        """
+        Acquire a warm container from the pool and build the command to run the execution in it.
+
+        :return: Command, or None if the execution can't be run in a pooled container.
+        """
+        input_volumes = list(input_volumes)
+        if len(input_volumes) > 1:
+            return None  # Inputs mounted separately (see `InputStore.build_tree()`) need a container of their own
+        # Only this execution's output directory is writable; see `ContainerPool.lend_output_dir()`
+        roots = [(self.repository_dir if self.gitless else self.checkout_cache.root, not self.gitless)]
+        if input_volumes:
+            roots.append((self.input_store.trees_dir, True))
+        self.pooled_container = self.container_pool.acquire(
+            self.image,
+            roots,
+            run_args=self.get_run_args(),
+            lease_id=self.execution_id,
+            output_root=self.output_root,
+        )
+        self.container_pool.lend_output_dir(self.pooled_container, self.output_dir)
+        return self.container_pool.build_exec_command(
+            self.pooled_container,
+            volumes=self.get_volumes(input_volumes),
+            env_vars=self.get_env_vars(),
+            command=' && '.join(self.interpolated_command),
+            workdir=volume_mount_targets['repository'],
+        )
+
+    def release_container(self):
+        if not self.pooled_container:
+            return
+        self.container_pool.return_output_dir(self.pooled_container, self.output_dir)
+        self.container_pool.release(self.pooled_container)
+        self.pooled_container = None
+
+    def get_run_args(self):
+        run_args = []
+        if self.cpus:
+            run_args.append('--cpus=%s' % self.cpus)
+        if self.memory:
+            run_args.append('--memory=%s' % self.memory)
+        if self.docker_add_args:
+            run_args.extend(self.docker_add_args.split())
+        return run_args
+
+    def get_env_vars(self):
+        return {
+            'PYTHONUNBUFFERED': '1',
+            'VH_REPOSITORY_DIR': volume_mount_targets['repository'],
+            'VH_INPUTS_DIR': volume_mount_targets['inputs'],
+            'VH_OUTPUTS_DIR': volume_mount_targets['outputs'],
+        }
+
+    def get_volumes(self, input_volumes):
         volumes = [
-            {'source': self.repository_dir, 'destination': volume_mount_targets['repository']},
+            {
+                'source': self.repository_dir,
+                'destination': volume_mount_targets['repository'],
+                'readonly': (not self.gitless),  # Checkouts are shared between executions
+            },
             {'source': self.output_dir, 'destination': volume_mount_targets['outputs']},
         ]
-        return build_volume_params(chain(volumes, input_volumes))
+        return volumes + list(input_volumes)
+
+    def build_volume_params(self, input_volumes):
+        return build_volume_params(self.get_volumes(input_volumes))
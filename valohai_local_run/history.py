@@ -0,0 +1,399 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+
+from click import echo, secho, style
+
+from .consts import DEFAULT_OUTPUT_ROOT, EXECUTION_METADATA_JSON_NAME, HISTORY_INDEX_NAME
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS executions (
+    execution_id TEXT PRIMARY KEY,
+    time TEXT,
+    step TEXT,
+    commit_sha TEXT,
+    image TEXT,
+    exit_code INTEGER,
+    duration REAL,
+    memoized_from TEXT,
+    metadata_mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS executions_by_time ON executions (time);
+CREATE INDEX IF NOT EXISTS executions_by_step ON executions (step, time);
+CREATE TABLE IF NOT EXISTS parameters (
+    execution_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (execution_id, name)
+);
+CREATE INDEX IF NOT EXISTS parameters_by_value ON parameters (name, value);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value
+);
+'''
+SORT_COLUMNS = ('time', 'duration', 'exit_code', 'step')
+
+
+def parse_value(value):
+    """
+    Parse a parameter value given on the command line, e.g. `0.01` or `adam`.
+
+    :return: List of the values to match: the string itself, and the number or boolean it spells, if any
+    """
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        return [value]
+    if isinstance(parsed, (bool, int, float)):
+        return [value, parsed]
+    return [value]
+
+
+class HistoryIndex:
+    """
+    An SQLite index of the executions in an output root, for finding executions by step, commit, parameters,
+    exit code and duration without reading the metadata file of every one of them.
+
+    The index is kept in `.valohai-history.sqlite3` in the output root.  Executions update their entry
+    whenever they write their metadata file; `backfill()` indexes the executions that are missing or out
+    of date (e.g. ones run before the index existed) by scanning the output root, and records that it has
+    been run, so `is_backfilled()` tells whether the index can be missing such executions.
+    """
+
+    def __init__(self, output_root):
+        self.output_root = output_root
+        self.path = os.path.join(output_root, HISTORY_INDEX_NAME)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.executescript(SCHEMA)
+        return connection
+
+    def is_backfilled(self):
+        if not os.path.isfile(self.path):
+            return False
+        connection = self.connect()
+        try:
+            return bool(connection.execute('SELECT 1 FROM state WHERE key = \'backfilled\'').fetchone())
+        finally:
+            connection.close()
+
+    def update(self, execution_id, metadata, metadata_mtime):
+        """
+        Add or update the entry of an execution.
+
+        :param metadata: Contents of the metadata file of the execution
+        :param metadata_mtime: Modification time of the metadata file (in nanoseconds), to tell whether it's changed
+        """
+        connection = self.connect()
+        try:
+            with connection:
+                self._update(connection, execution_id, metadata, metadata_mtime)
+        finally:
+            connection.close()
+
+    def backfill(self, full=False):
+        """
+        Index the executions whose metadata files have changed since they were last indexed (or all of them,
+        with `full`), and forget the executions that have been removed.
+
+        :return: Tuple of (number of executions indexed, number of executions forgotten)
+        """
+        connection = self.connect()
+        try:
+            indexed = {
+                row['execution_id']: row['metadata_mtime']
+                for row in connection.execute('SELECT execution_id, metadata_mtime FROM executions')
+            }
+            n_updated = 0
+            with connection:
+                for execution_id, path in self._walk():
+                    try:
+                        mtime = os.stat(path).st_mtime_ns
+                        if not full and indexed.get(execution_id) == mtime:
+                            continue
+                        with open(path, 'r') as infp:
+                            metadata = json.load(infp)
+                    except (IOError, ValueError):  # e.g. removed or being written in the meanwhile
+                        continue
+                    self._update(connection, execution_id, metadata, mtime)
+                    n_updated += 1
+                removed = [
+                    execution_id for execution_id in indexed
+                    if not os.path.isdir(os.path.join(self.output_root, execution_id))
+                ]
+                self._delete(connection, removed)
+                connection.execute(
+                    'INSERT OR REPLACE INTO state VALUES (\'backfilled\', ?)', (datetime.datetime.now().isoformat(),),
+                )
+            return (n_updated, len(removed))
+        finally:
+            connection.close()
+
+    def query(
+        self,
+        step=None,
+        commit=None,
+        parameters=None,
+        exit_code=None,
+        failed=None,
+        min_duration=None,
+        max_duration=None,
+        since=None,
+        until=None,
+        sort='time',
+        descending=True,
+        limit=None,
+    ):
+        """
+        Find executions.
+
+        :param commit: Commit SHA, or a prefix of one
+        :param parameters: Dict of parameter name -> value, as given on the command line (see `parse_value()`)
+        :param failed: True to only find failed executions, False to only find successful ones
+        :param since: ISO 8601 date or time the executions must have started at or after
+        :param until: ISO 8601 date or time the executions must have started before
+        :param sort: Column to sort by; one of `SORT_COLUMNS`
+        :return: List of dicts, with the parameters of each execution in `parameters`
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError('Can not sort by {}'.format(sort))
+        conditions, values = self._build_conditions(
+            step=step,
+            commit=commit,
+            exit_code=exit_code,
+            failed=failed,
+            min_duration=min_duration,
+            max_duration=max_duration,
+            since=since,
+            until=until,
+        )
+        for name, value in (parameters or {}).items():
+            candidates = parse_value(value)
+            conditions.append(
+                'execution_id IN (SELECT execution_id FROM parameters WHERE name = ? AND value IN ({}))'.format(
+                    ', '.join('?' * len(candidates))
+                )
+            )
+            values.extend([name] + candidates)
+        sql = 'SELECT * FROM executions{where} ORDER BY {sort} IS NULL, {sort} {order}, execution_id {order}'.format(
+            where=(' WHERE ' + ' AND '.join(conditions) if conditions else ''),
+            sort=sort,
+            order=('DESC' if descending else 'ASC'),
+        )
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        connection = self.connect()
+        try:
+            executions = [dict(row, parameters={}) for row in connection.execute(sql, values)]
+            by_id = {execution['execution_id']: execution for execution in executions}
+            for row in connection.execute(
+                'SELECT * FROM parameters WHERE execution_id IN (SELECT execution_id FROM ({})) ORDER BY name'.format(
+                    sql,
+                ),
+                values,
+            ):
+                by_id[row['execution_id']]['parameters'][row['name']] = row['value']
+            return executions
+        finally:
+            connection.close()
+
+    def prune(self, older_than=None, keep=None, failed_only=False, dry_run=False):
+        """
+        Remove the output directories (and index entries) of old executions.
+
+        :param older_than: Remove executions started more than this many days ago
+        :param keep: Keep (at least) this many of the most recent executions
+        :param failed_only: Only remove failed executions
+        :return: List of the IDs of the removed executions
+        """
+        conditions = ['exit_code IS NOT NULL']  # Executions still running haven't recorded their exit code yet
+        values = []
+        if older_than is not None:
+            conditions.append('time < ?')
+            values.append((datetime.datetime.now() - datetime.timedelta(days=older_than)).isoformat())
+        if failed_only:
+            conditions.append('exit_code != 0')
+        if keep:
+            conditions.append('execution_id NOT IN (SELECT execution_id FROM executions ORDER BY time DESC LIMIT ?)')
+            values.append(keep)
+        connection = self.connect()
+        try:
+            removed = [
+                row['execution_id'] for row in connection.execute(
+                    'SELECT execution_id FROM executions WHERE {} ORDER BY time'.format(' AND '.join(conditions)),
+                    values,
+                )
+            ]
+            if dry_run:
+                return removed
+            for execution_id in removed:
+                shutil.rmtree(os.path.join(self.output_root, execution_id), ignore_errors=True)
+            with connection:
+                self._delete(connection, removed)
+            return removed
+        finally:
+            connection.close()
+
+    def _walk(self):
+        try:
+            names = sorted(os.listdir(self.output_root))
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.output_root, name, EXECUTION_METADATA_JSON_NAME)
+            if not name.startswith('.') and os.path.isfile(path):
+                yield (name, path)
+
+    def _update(self, connection, execution_id, metadata, metadata_mtime):
+        connection.execute(
+            'INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                execution_id,
+                metadata.get('time'),
+                metadata.get('step'),
+                metadata.get('commit'),
+                metadata.get('image'),
+                metadata.get('exit_code'),
+                (metadata.get('profile') or {}).get('total'),
+                metadata.get('memoized_from'),
+                metadata_mtime,
+            ),
+        )
+        connection.execute('DELETE FROM parameters WHERE execution_id = ?', (execution_id,))
+        connection.executemany('INSERT INTO parameters VALUES (?, ?, ?)', [
+            (execution_id, name, (json.dumps(value) if isinstance(value, (list, dict)) else value))
+            for (name, value) in (metadata.get('parameters') or {}).items()
+        ])
+
+    def _delete(self, connection, execution_ids):
+        for execution_id in execution_ids:
+            connection.execute('DELETE FROM executions WHERE execution_id = ?', (execution_id,))
+            connection.execute('DELETE FROM parameters WHERE execution_id = ?', (execution_id,))
+
+    def _build_conditions(self, step, commit, exit_code, failed, min_duration, max_duration, since, until):
+        conditions = []
+        values = []
+        for condition, value in (
+            ('step = ?', step),
+            ('commit_sha LIKE ? || \'%\'', commit),
+            ('exit_code = ?', exit_code),
+            ('duration >= ?', min_duration),
+            ('duration <= ?', max_duration),
+            ('time >= ?', since),
+            ('time < ?', until),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        if failed is not None:
+            conditions.append('exit_code != 0' if failed else 'exit_code = 0')
+        return (conditions, values)
+
+
+def parse_parameter_filter(value):
+    name, sep, value = value.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError('expected NAME=VALUE, not {}'.format(value))
+    return (name, value)
+
+
+def format_duration(duration):
+    return ('{:.1f}s'.format(duration) if duration is not None else '-')
+
+
+def history_cli(argv):
+    ap = argparse.ArgumentParser(
+        prog='valohai-local-run history',
+        description='Find executions in an output root, or prune old ones.',
+    )
+    ap.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT, help='Output root')
+    subparsers = ap.add_subparsers(dest='action', metavar='action')
+    query_ap = subparsers.add_parser('query', help='List executions, most recent first')
+    query_ap.add_argument('--step', default=None, help='Only list executions of this step')
+    query_ap.add_argument('--commit', default=None, help='Only list executions of this commit (or a prefix of one)')
+    query_ap.add_argument('--param', '-p', type=parse_parameter_filter, action='append', default=[],
+        metavar='NAME=VALUE', dest='parameters', help='Only list executions with this parameter value (repeatable)')
+    status_group = query_ap.add_mutually_exclusive_group()
+    status_group.add_argument('--exit-code', type=int, default=None, help='Only list executions with this exit code')
+    status_group.add_argument('--failed', action='store_const', const=True, default=None,
+        help='Only list failed executions')
+    status_group.add_argument('--succeeded', action='store_const', const=False, dest='failed',
+        help='Only list successful executions')
+    query_ap.add_argument('--min-duration', type=float, default=None, metavar='SECONDS')
+    query_ap.add_argument('--max-duration', type=float, default=None, metavar='SECONDS')
+    query_ap.add_argument('--since', default=None, metavar='DATE', help='e.g. 2019-01-31 or 2019-01-31T12:00')
+    query_ap.add_argument('--until', default=None, metavar='DATE')
+    query_ap.add_argument('--sort', choices=SORT_COLUMNS, default='time')
+    query_ap.add_argument('--reverse', '-r', action='store_true', default=False, help='Sort in ascending order')
+    query_ap.add_argument('--limit', '-n', type=int, default=None, metavar='N', help='List at most N executions')
+    query_ap.add_argument('--json', action='store_true', default=False, help='Output JSON lines')
+    backfill_ap = subparsers.add_parser('backfill', help='Index executions missing from the index')
+    backfill_ap.add_argument('--full', action='store_true', default=False,
+        help='Reindex all executions, instead of only those whose metadata has changed')
+    prune_ap = subparsers.add_parser('prune', help='Remove the output directories of old executions')
+    prune_ap.add_argument('--older-than', type=float, default=None, metavar='DAYS',
+        help='Remove executions started more than DAYS days ago')
+    prune_ap.add_argument('--keep', type=int, default=None, metavar='N', help='Keep the N most recent executions')
+    prune_ap.add_argument('--failed', action='store_true', default=False, help='Only remove failed executions')
+    prune_ap.add_argument('--dry-run', action='store_true', default=False, help='Only list what would be removed')
+    args = ap.parse_args(argv)
+    index = HistoryIndex(args.output_root)
+
+    if args.action == 'backfill':
+        n_updated, n_removed = index.backfill(full=args.full)
+        secho('{} executions indexed, {} removed executions forgotten.'.format(n_updated, n_removed), bold=True)
+        return 0
+    if not index.is_backfilled():  # There may be executions run before the index existed
+        index.backfill()
+    if args.action == 'prune':
+        if args.older_than is None and args.keep is None:
+            ap.error('prune requires --older-than and/or --keep')
+        removed = index.prune(older_than=args.older_than, keep=args.keep, failed_only=args.failed,
+            dry_run=args.dry_run)
+        for execution_id in removed:
+            echo(('Would remove {}' if args.dry_run else 'Removed {}').format(style(execution_id, bold=True)))
+        secho('{} executions {}.'.format(len(removed), ('to remove' if args.dry_run else 'removed')), bold=True)
+        return 0
+    if not args.action:
+        args = query_ap.parse_args([], namespace=args)
+    print_executions(index.query(
+        step=args.step,
+        commit=args.commit,
+        parameters=dict(args.parameters),
+        exit_code=args.exit_code,
+        failed=args.failed,
+        min_duration=args.min_duration,
+        max_duration=args.max_duration,
+        since=args.since,
+        until=args.until,
+        sort=args.sort,
+        descending=(not args.reverse),
+        limit=args.limit,
+    ), as_json=args.json)
+    return 0
+
+
+def print_executions(executions, as_json=False):
+    for execution in executions:
+        if as_json:
+            echo(json.dumps(execution, sort_keys=True))
+            continue
+        exit_code = execution['exit_code']
+        echo('{id}  {time}  {step}  {commit}  {exit_code}  {duration:>8}  {parameters}'.format(
+            id=style(execution['execution_id'], bold=True),
+            time=(execution['time'] or '')[:19],
+            step=style(execution['step'] or '', fg='blue'),
+            commit=(execution['commit_sha'] or '-')[:8],
+            exit_code=style(
+                ('-' if exit_code is None else str(exit_code)).rjust(3),
+                fg=(None if exit_code is None else ('red' if exit_code else 'green')),
+            ),
+            duration=format_duration(execution['duration']),
+            parameters=' '.join('{}={}'.format(name, value) for (name, value) in execution['parameters'].items()),
+        ))
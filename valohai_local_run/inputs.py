@@ -1,20 +1,135 @@
+import contextlib
+import fcntl
+import json
 import os
 import posixpath
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from stat import S_ISDIR, S_ISREG
 
 from click import echo, style
 from valohai_yaml.utils import listify
 
-from .consts import volume_mount_targets
-from .download import download_url
+from .archives import ExtractionCache, get_archive_stem, get_archive_type
+from .cache import DownloadCache, get_cache_key
+from .checkout import is_process_alive
+from .consts import (
+    DEFAULT_DOWNLOAD_CONCURRENCY,
+    DEFAULT_INPUT_STORE_MAX_AGE,
+    GC_INTERVAL,
+    INPUT_STORE_DIR_ENV,
+    volume_mount_targets,
+)
+from .download import download_urls, extract_urls
+from .lazyfs import open_readers
+from .profiling import Profiler
+from .s3 import S3Client, is_s3_url
+from .utils import claim_periodic_run, ensure_makedirs, get_random_string, hash_file
 
+FICLONE = 0x40049409  # Linux ioctl for reflinking (copy-on-write cloning) a file
+MAX_DIGEST_ENTRIES = 100000  # Entries kept in the digest index of the input store
+
+
+def is_url(filename):
+    return (filename.startswith('http://') or filename.startswith('https://') or is_s3_url(filename))
+
+
+def expand_input_specs(input_specs, s3_client=None):
+    """
+    Expand `s3://` prefixes (ending with a slash) and glob patterns into the objects they match.
+
+    :return: List of input specs
+    """
+    expanded = []
+    for filename in input_specs:
+        if is_s3_url(filename):
+            s3_client = (s3_client or S3Client.from_env())
+            expanded.extend(s3_client.expand_url(filename))
+        else:
+            expanded.append(filename)
+    return expanded
+
+
+def prepare_inputs(
+    input_dict,
+    verbose=False,
+    download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+    revalidate=False,
+    profiler=None,
+    extract_archives=False,
+    cancel=None,
+    lazy=False,
+    lease_id=None,
+):
+    """
+    Download the inputs and work out how to mount them.
+
+    :param extract_archives: Whether to extract tar and zip archives, and mount their contents instead
+    :param cancel: A `threading.Event` that aborts the downloads once set
+    :param lazy: Whether to read HTTP/HTTPS inputs lazily instead of downloading them; the volume dicts of
+                 such inputs have a `RangeReader` as `reader` and no `source` (see `lazyfs.LazyMount`)
+    :param lease_id: ID to lease the extracted trees with (see `ExtractionCache`), so they're kept while in use
+    :return: Iterable of volume dicts
+    """
+    input_dict = {
+        input_name: expand_input_specs(listify(input_specs))
+        for (input_name, input_specs) in input_dict.items()
+    }
+    extracted = {}
+    if extract_archives:
+        extracted = extract_archive_inputs(
+            [filename for input_specs in input_dict.values() for filename in input_specs],
+            verbose=verbose,
+            download_concurrency=download_concurrency,
+            revalidate=revalidate,
+            profiler=profiler,
+            cancel=cancel,
+            lease_id=lease_id,
+        )
+
+    readers = {}
+    if lazy:  # Files in the download cache already are mounted as they are
+        cache = DownloadCache()
+        readers = open_readers(
+            [
+                filename
+                for input_specs in input_dict.values()
+                for filename in input_specs
+                if is_url(filename) and not is_s3_url(filename) and filename not in extracted and
+                not cache.lookup(get_cache_key(filename))
+            ],
+            concurrency=download_concurrency,
+            revalidate=revalidate,
+            profiler=profiler,
+        )
+
+    # Fetch all remote inputs up front, in parallel
+    downloaded = download_urls(
+        (
+            filename
+            for input_specs in input_dict.values()
+            for filename in input_specs
+            if is_url(filename) and filename not in extracted and filename not in readers
+        ),
+        concurrency=download_concurrency,
+        with_progress=verbose,
+        revalidate=revalidate,
+        profiler=profiler,
+        cancel=cancel,
+    )
 
-def prepare_inputs(input_dict, verbose=False):
     for input_name, input_specs in input_dict.items():
-        input_specs = listify(input_specs)
         multiple_specs = (len(input_specs) > 1)
         for filename in input_specs:
-            obj = _prepare_single_input(input_name, filename, multiple_specs)
+            if filename in extracted:
+                obj = _prepare_extracted_input(input_name, filename, multiple_specs, extracted[filename])
+            elif filename in readers:
+                obj = _prepare_lazy_input(input_name, filename, readers[filename])
+            else:
+                obj = _prepare_single_input(input_name, filename, multiple_specs, downloaded.get(filename, filename))
             if verbose:
                 echo('Input {name}: {source} -> {target}'.format(
                     name=style(input_name, bold=True, fg='blue'),
@@ -24,14 +139,75 @@ def prepare_inputs(input_dict, verbose=False):
             yield obj
 
 
-def _prepare_single_input(input_name, filename, multiple_specs):
-    dest_filename = os.path.basename(filename)
-    if filename.startswith('s3:'):
-        raise NotImplementedError('S3 inputs are not supported for local runs')
+def extract_archive_inputs(filenames, verbose=False, download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+        revalidate=False, profiler=None, cancel=None, lease_id=None):
+    """
+    Extract the archives among input files and URLs into the extraction cache (unless they've been extracted before).
+
+    Tar archives served over HTTP/HTTPS are extracted as they're downloaded, without storing the archive;
+    zip archives need random access, so they (and archives from S3) are downloaded into the download cache first.
+
+    :return: Dict of filename or URL -> path of the extracted tree
+    """
+    profiler = (profiler or Profiler())
+    archives = {
+        filename: get_archive_type(filename)
+        for filename in filenames
+        if get_archive_type(filename) and (is_url(filename) or os.path.isfile(filename))
+    }
+    if not archives:
+        return {}
+    extraction_cache = ExtractionCache(lease_id=lease_id)
+    download_kwargs = dict(
+        concurrency=download_concurrency,
+        with_progress=verbose,
+        revalidate=revalidate,
+        profiler=profiler,
+        cancel=cancel,
+    )
+    extracted = extract_urls(
+        [
+            filename for (filename, archive_type) in archives.items()
+            if archive_type == 'tar' and is_url(filename) and not is_s3_url(filename)
+        ],
+        extraction_cache,
+        **download_kwargs
+    )
+    downloaded = download_urls(
+        [filename for filename in archives if is_url(filename) and filename not in extracted],
+        **download_kwargs
+    )
+    with profiler.phase('extract_inputs'):
+        for filename, archive_type in archives.items():
+            if filename not in extracted:
+                extracted[filename] = extraction_cache.extract_file(
+                    downloaded.get(filename, filename),
+                    archive_type=archive_type,
+                    source=(get_cache_key(filename) if is_url(filename) else None),
+                )
+    return extracted
+
+
+def _prepare_extracted_input(input_name, filename, multiple_specs, tree_path):
+    # With other files alongside, the contents of the archive go in a directory named after it
+    destination = posixpath.join(volume_mount_targets['inputs'], input_name)
+    if multiple_specs:
+        destination = posixpath.join(destination, get_archive_stem(filename))
+    return {'source': tree_path, 'destination': destination, 'readonly': True}
+
+
+def _prepare_lazy_input(input_name, url, reader):
+    return {
+        'source': None,
+        'destination': posixpath.join(volume_mount_targets['inputs'], input_name, os.path.basename(url)),
+        'readonly': True,
+        'reader': reader,
+    }
 
-    if filename.startswith('http://') or filename.startswith('https://'):
-        filename = download_url(filename, with_progress=True)
 
+def _prepare_single_input(input_name, filename, multiple_specs, local_path):
+    dest_filename = os.path.basename(filename)
+    filename = local_path
     fstat = os.stat(filename)
 
     if S_ISDIR(fstat.st_mode):  # Bind entire directory
@@ -67,3 +243,267 @@ def _prepare_single_input(input_name, filename, multiple_specs):
             filename=filename,
         )
     )
+
+
+def link_file(source, dest):
+    """
+    Create `dest` as a reflink (a copy-on-write clone) of `source` if the filesystem supports it,
+    or as a hardlink otherwise.  File data is never copied.
+
+    :raises OSError: if neither is possible (e.g. the files are on different filesystems)
+    """
+    try:
+        with open(source, 'rb') as infp, open(dest, 'wb') as outfp:
+            fcntl.ioctl(outfp.fileno(), FICLONE, infp.fileno())
+        return
+    except OSError:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dest)
+    os.link(source, dest)
+
+
+class InputStore:
+    """
+    A content-addressed store of input files, from which per-execution input trees are built.
+
+    Layout of the store directory:
+
+    * `objects/<xx>/<sha256>`: input files, named by their SHA256 digest
+    * `digests.json`: digests of files by path, size, mtime and inode, so unchanged files aren't rehashed;
+      the least recently hashed entries are dropped once there are more than `MAX_DIGEST_ENTRIES`
+    * `trees/<tree id>/`: the inputs of an execution, laid out as in `/valohai/inputs`, hardlinked from `objects/`
+    * `trees/<tree id>.pid`: the PID of the process using the tree
+    * `store.lock`: lock file guarding garbage collection against trees being built
+
+    Files are added to the store as reflinks or hardlinks, so building a tree never copies file data,
+    and identical files share the same storage however many executions use them.  Directory inputs are
+    bind-mounted as they are, so large local datasets needn't be hashed before the execution can start.
+    Objects no longer linked from anywhere are garbage collected once they've been unused for `max_age` seconds
+    (by `gc()`, which releasing a tree runs at most once per `GC_INTERVAL`).
+    """
+
+    def __init__(self, root=None, max_age=DEFAULT_INPUT_STORE_MAX_AGE):
+        self.root = (
+            root or
+            os.environ.get(INPUT_STORE_DIR_ENV) or
+            os.path.join(tempfile.gettempdir(), 'valohai-local-run-inputs')
+        )
+        self.max_age = max_age
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.trees_dir = os.path.join(self.root, 'trees')
+        ensure_makedirs(self.objects_dir, 0o770)
+        ensure_makedirs(self.trees_dir, 0o770)
+
+    def get_object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def get_tree_path(self, tree_id):
+        return os.path.join(self.trees_dir, tree_id)
+
+    def build_tree(self, tree_id, mounts):
+        """
+        Build an input tree out of the per-file and per-directory volumes returned by `prepare_inputs()`.
+
+        Inputs that can't be linked into the store (e.g. because they're on a different filesystem)
+        are mounted separately on top of placeholders in the tree, like they would be without the store.
+
+        :return: List of volumes to mount: the tree itself, then any inputs left out of it.
+        """
+        tree_path = self.get_tree_path(tree_id)
+        store_device = os.stat(self.root).st_dev
+        separate_mounts = []
+        with self._locked(fcntl.LOCK_SH):
+            os.makedirs(tree_path)
+            with open(tree_path + '.pid', 'w') as outf:
+                outf.write(str(os.getpid()))
+
+            files = []  # (source path, destination path within the tree, volume mount)
+            for mount in mounts:
+                dest = os.path.join(tree_path, posixpath.relpath(mount['destination'], volume_mount_targets['inputs']))
+                if os.path.isdir(mount['source']) or os.stat(mount['source']).st_dev != store_device:
+                    self._make_placeholder(mount['source'], dest)
+                    separate_mounts.append(mount)
+                else:
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    files.append((mount['source'], dest, mount))
+
+            stored_digests = self._read_digests()
+            digests = self._update_digests(OrderedDict(stored_digests), [path for (path, dest, mount) in files])
+            for path, dest, mount in files:
+                try:
+                    object_path = self._add_object(path, digests)
+                except OSError:  # Can't be linked (e.g. a file of another user); mount it as-is
+                    self._make_placeholder(path, dest)
+                    separate_mounts.append(mount)
+                    continue
+                if os.path.lexists(dest):  # Later inputs replace earlier ones of the same name
+                    os.unlink(dest)
+                os.link(object_path, dest)
+            self._merge_digests(digests, stored_digests)
+
+        tree_volume = {'source': tree_path, 'destination': volume_mount_targets['inputs'], 'readonly': True}
+        return [tree_volume] + separate_mounts
+
+    def get_digests(self, paths):
+        """
+        Get the SHA256 digests of files, only hashing the files that have changed since they were last hashed.
+
+        :return: Dict of path -> digest
+        """
+        paths = list(paths)
+        stored_digests = self._read_digests()
+        digests = self._update_digests(OrderedDict(stored_digests), paths)
+        self._merge_digests(digests, stored_digests)
+        return {path: digests[path][3] for path in paths}
+
+    def release_tree(self, tree_id):
+        tree_path = self.get_tree_path(tree_id)
+        shutil.rmtree(tree_path, ignore_errors=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tree_path + '.pid')
+        if claim_periodic_run(os.path.join(self.root, '.last-gc'), GC_INTERVAL):  # A full scan of the store
+            self.gc()
+
+    def gc(self, max_age=None):
+        """
+        Remove trees of dead processes, and objects that are linked from nowhere else
+        and have not been used in `max_age` seconds.
+
+        :return: List of digests of the removed objects.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        removed = []
+        with self._locked(fcntl.LOCK_EX):
+            for name in os.listdir(self.trees_dir):
+                if name.endswith('.pid') or self._is_tree_in_use(name):
+                    continue
+                shutil.rmtree(os.path.join(self.trees_dir, name), ignore_errors=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(os.path.join(self.trees_dir, name + '.pid'))
+            for dirpath, dirnames, filenames in os.walk(self.objects_dir):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    # Linking and unlinking update the ctime, so it's the last time the object was used
+                    if stat.st_nlink == 1 and time.time() - stat.st_ctime >= max_age:
+                        os.unlink(path)
+                        removed.append(filename)
+            with self._locked_digests() as digests:
+                for path in [path for (path, entry) in digests.items() if not self._is_digest_current(path, entry)]:
+                    del digests[path]
+        return removed
+
+    def list_objects(self):
+        return [
+            filename
+            for (dirpath, dirnames, filenames) in os.walk(self.objects_dir)
+            for filename in filenames
+        ]
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        with open(os.path.join(self.root, 'store.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _is_tree_in_use(self, tree_id):
+        try:
+            with open(self.get_tree_path(tree_id) + '.pid') as infp:
+                return is_process_alive(int(infp.read().strip()))
+        except (IOError, ValueError):
+            return False
+
+    def _make_placeholder(self, source, dest):
+        # Give separately mounted inputs a mount point within the (read-only) tree
+        if os.path.isdir(source):
+            os.makedirs(dest, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if not os.path.lexists(dest):
+                open(dest, 'w').close()
+
+    def _update_digests(self, digests, paths):
+        """
+        Bring the digests of the given files up to date, rehashing only the files that have changed.
+
+        :param digests: Dict of path -> [size, mtime (ns), inode, digest], updated in place
+        """
+        stale = []
+        for path in paths:
+            stat = os.stat(path)
+            key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            entry = digests.get(path)
+            if not entry or entry[:3] != key:
+                digests[path] = key + [None]
+                stale.append(path)
+        if stale:  # Hashing mostly waits for I/O (and releases the GIL), so it's worth doing in parallel
+            with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1)) as pool:
+                for path, digest in zip(stale, pool.map(hash_file, stale)):
+                    digests[path][3] = digest
+        return digests
+
+    def _is_digest_current(self, path, entry):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (entry[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino])
+
+    def _merge_digests(self, digests, stored_digests):
+        """
+        Write the entries of `digests` that differ from `stored_digests` (as read earlier) into the digest index,
+        keeping entries written by others in the meanwhile.
+        """
+        changed = [(path, entry) for (path, entry) in digests.items() if stored_digests.get(path) != entry]
+        if not changed:
+            return
+        with self._locked_digests() as index:
+            for path, entry in changed:
+                index.pop(path, None)  # Keep the entries in the order they were hashed in
+                index[path] = entry
+
+    def _add_object(self, path, digests):
+        digest = digests[path][3]
+        object_path = self.get_object_path(digest)
+        if os.path.isfile(object_path):
+            # Objects may share their inode with the original file, which could have been modified in place since
+            if self._update_digests(digests, [object_path])[object_path][3] == digest:
+                return object_path
+            os.unlink(object_path)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(object_path, get_random_string(8))
+        link_file(path, temp_path)
+        os.rename(temp_path, object_path)
+        stat = os.stat(object_path)
+        digests[object_path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+        return object_path
+
+    @contextlib.contextmanager
+    def _locked_digests(self):
+        with open(os.path.join(self.root, 'digests.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                digests = self._read_digests()
+                yield digests
+                while len(digests) > MAX_DIGEST_ENTRIES:
+                    digests.popitem(last=False)
+                self._write_digests(digests)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_digests(self):
+        try:
+            with open(os.path.join(self.root, 'digests.json'), 'r') as infp:
+                return json.load(infp, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return OrderedDict()
+
+    def _write_digests(self, digests):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.digests-')
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(digests, outf)
+        os.rename(temp_path, os.path.join(self.root, 'digests.json'))
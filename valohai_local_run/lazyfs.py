@@ -0,0 +1,439 @@
+"""
+Lazily read inputs: remote files exposed through a read-only FUSE filesystem, fetched a block at a time
+(with HTTP range requests) as the execution reads them.
+
+Blocks are kept in a `BlockCache` in the download cache directory, so later executions only fetch
+the parts of a file that haven't been read before.  Mounting needs the `fusepy` module and libfuse, and
+`user_allow_other` in `/etc/fuse.conf` (unless running as root), so that Docker can reach the mount.
+"""
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import DownloadCache, get_cache_key
+from .consts import DEFAULT_CHECKOUT_MAX_AGE, DEFAULT_LAZY_BLOCK_SIZE
+from .profiling import Profiler
+from .utils import ensure_makedirs, get_random_string, warn
+
+
+def get_fuse():
+    try:
+        import fuse
+    except (ImportError, OSError):  # fusepy raises an `OSError` when libfuse can't be found
+        raise RuntimeError(
+            'The `fusepy` module and libfuse must be available for lazy inputs '
+            '(install `valohai-local-run[lazy]`)'
+        )
+    return fuse
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class BlockCache:
+    """
+    A cache of blocks of remote files, for reading them lazily.
+
+    Layout of the cache directory (`blocks` in the download cache directory by default):
+
+    * `<sha1 of cache key>/meta.json`: the size and ETag of the file
+    * `<sha1 of cache key>/<index>`: the blocks of the file, `block_size` bytes each (but the last one)
+
+    Blocks are written atomically, so a cache may be shared by concurrent processes.
+    The blocks of files that haven't been opened in `max_age` seconds are garbage collected.
+    """
+
+    def __init__(self, root=None, block_size=DEFAULT_LAZY_BLOCK_SIZE, max_age=DEFAULT_CHECKOUT_MAX_AGE):
+        self.root = (root or os.path.join(DownloadCache().root, 'blocks'))
+        self.block_size = block_size
+        self.max_age = max_age
+        ensure_makedirs(self.root, 0o770)
+
+    def get_dir(self, key):
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def read_meta(self, key):
+        """
+        :return: The metadata of a file (marking it used), or None
+        """
+        meta = self._load_meta(key)
+        if not meta or meta.get('block_size') != self.block_size:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(os.path.join(self.get_dir(key), 'meta.json'))
+        return meta
+
+    def write_meta(self, key, meta):
+        """
+        Record the metadata of a file, dropping its blocks if it has changed.
+        """
+        meta = dict(meta, block_size=self.block_size)
+        if self._load_meta(key) != meta:
+            shutil.rmtree(self.get_dir(key), ignore_errors=True)
+        self._write(key, 'meta.json', json.dumps(meta).encode())
+
+    def get_block(self, key, index, offset=0, size=-1):
+        """
+        Read a block, or `size` bytes of it from `offset` on.
+
+        :return: The data read, or None if the block is not in the cache
+        """
+        try:
+            with open(os.path.join(self.get_dir(key), str(index)), 'rb') as infp:
+                if offset:
+                    infp.seek(offset)
+                return infp.read(size)
+        except FileNotFoundError:
+            return None
+
+    def put_block(self, key, index, data):
+        self._write(key, str(index), data)
+
+    def gc(self, max_age=None):
+        """
+        Remove the blocks of files that have not been opened in `max_age` seconds.
+
+        :return: List of the names of the removed directories.
+        """
+        max_age = (self.max_age if max_age is None else max_age)
+        removed = []
+        for name in self.list_files():
+            path = os.path.join(self.root, name)
+            try:
+                last_used = os.stat(os.path.join(path, 'meta.json')).st_mtime
+            except FileNotFoundError:
+                last_used = os.stat(path).st_mtime
+            if time.time() - last_used >= max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(name)
+        return removed
+
+    def list_files(self):
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith('.') and os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def get_size(self):
+        return sum(
+            os.path.getsize(os.path.join(dirpath, filename))
+            for (dirpath, dirnames, filenames) in os.walk(self.root)
+            for filename in filenames
+        )
+
+    def _load_meta(self, key):
+        try:
+            with open(os.path.join(self.get_dir(key), 'meta.json'), 'r') as infp:
+                return json.load(infp)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, key, name, data):
+        directory = self.get_dir(key)
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, '.{}.{}'.format(name, get_random_string(8)))
+        with open(temp_path, 'wb') as outf:
+            outf.write(data)
+        os.rename(temp_path, os.path.join(directory, name))
+
+
+class RangeReader:
+    """
+    Reads parts of a remote file over HTTP/HTTPS, a block at a time, through a `BlockCache`.
+
+    The file must not change while it's being read; reads fail with `EIO` if it does.
+    `read()` may be called from multiple threads; a block missing from the cache is fetched only once,
+    however many threads are reading it.
+    """
+
+    def __init__(self, url, block_cache, profiler=None):
+        self.url = url
+        self.key = get_cache_key(url)
+        self.block_cache = block_cache
+        self.block_size = block_cache.block_size
+        self.profiler = (profiler or Profiler())
+        self.size = None  # Set in `open()`
+        self.etag = None
+        self.local = threading.local()
+        self.fetch_lock = threading.Lock()
+        self.fetching = {}  # Block index -> `threading.Event` set once the fetch of the block has finished
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            import requests
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def open(self, revalidate=False):
+        """
+        Find out the size of the file, from the cache unless revalidating; the first block is fetched otherwise.
+
+        :raises RangesNotSupported: if the server doesn't support range requests
+        """
+        meta = (None if revalidate else self.block_cache.read_meta(self.key))
+        if not meta:
+            r = self.session.get(self.url, headers={'Range': 'bytes=0-{}'.format(self.block_size - 1)}, stream=True)
+            with r:
+                if r.status_code == 416:  # An empty file has no ranges to speak of
+                    raise RangesNotSupported(self.url)
+                r.raise_for_status()
+                content_range = r.headers.get('content-range', '')
+                if r.status_code != 206 or '/' not in content_range or content_range.endswith('/*'):
+                    raise RangesNotSupported(self.url)
+                meta = {'size': int(content_range.rpartition('/')[2]), 'etag': r.headers.get('etag')}
+                data = self._read_body(r, min(self.block_size, meta['size']))
+            self.block_cache.write_meta(self.key, meta)
+            self.block_cache.put_block(self.key, 0, data)
+        self.size = meta['size']
+        self.etag = meta['etag']
+        return self
+
+    def read(self, offset, size):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+        first, last = offset // self.block_size, (end - 1) // self.block_size
+        ranges = {  # Block index -> (start, end) of the part of the block to read
+            index: (max(offset - index * self.block_size, 0), min(end - index * self.block_size, self.block_size))
+            for index in range(first, last + 1)
+        }
+        parts = {}
+        missing = []
+        for index, (part_start, part_end) in ranges.items():
+            parts[index] = self.block_cache.get_block(self.key, index, part_start, part_end - part_start)
+            if parts[index] is None:
+                missing.append(index)
+        for index, block in self._fetch_missing(missing).items():
+            part_start, part_end = ranges[index]
+            parts[index] = block[part_start:part_end]
+        return b''.join(parts[index] for index in range(first, last + 1))
+
+    def _fetch_missing(self, indices):
+        """
+        Fetch blocks missing from the cache, waiting for the ones other threads are fetching already.
+
+        :return: Dict of index -> block
+        """
+        event = threading.Event()
+        with self.fetch_lock:
+            own = [index for index in indices if index not in self.fetching]
+            others = {index: self.fetching[index] for index in indices if index in self.fetching}
+            for index in own:
+                self.fetching[index] = event
+        blocks = {}
+        try:
+            for start, stop in group_runs(own):  # Consecutive missing blocks are fetched with a single request
+                blocks.update(self._fetch(start, stop))
+        finally:
+            with self.fetch_lock:
+                for index in own:
+                    del self.fetching[index]
+            event.set()
+        for index, other_event in others.items():
+            other_event.wait()
+            block = self.block_cache.get_block(self.key, index)
+            if block is None:  # The other fetch failed; try again
+                block = self._fetch(index, index)[index]
+            blocks[index] = block
+        return blocks
+
+    def _fetch(self, start, stop):
+        """
+        Fetch blocks `start` to `stop` (inclusive), adding them to the cache.
+
+        :return: Dict of index -> block
+        """
+        range_start = start * self.block_size
+        range_end = min((stop + 1) * self.block_size, self.size)
+        headers = {'Range': 'bytes={}-{}'.format(range_start, range_end - 1)}
+        if self.etag:
+            headers['If-Range'] = self.etag
+        r = self.session.get(self.url, headers=headers, stream=True)
+        with r:
+            r.raise_for_status()
+            if r.status_code != 206:  # The whole file was sent instead, so it has changed
+                raise IOError(errno.EIO, '{} has changed since it was opened'.format(self.url))
+            data = self._read_body(r, range_end - range_start)
+        self.profiler.count('lazy_input_bytes', len(data))
+        blocks = {}
+        for index in range(start, stop + 1):
+            offset = (index - start) * self.block_size
+            blocks[index] = data[offset:offset + self.block_size]
+            self.block_cache.put_block(self.key, index, blocks[index])
+        return blocks
+
+    def _read_body(self, r, length):
+        data = bytearray()
+        for chunk in r.iter_content(chunk_size=1048576):
+            data += chunk
+            if len(data) >= length:
+                break
+        if len(data) < length:
+            raise IOError(errno.EIO, 'Short read from {}'.format(self.url))
+        return bytes(data[:length])
+
+
+def group_runs(indices):
+    """
+    Group sorted integers into runs of consecutive ones.
+
+    :return: List of (first, last) tuples
+    """
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
+
+
+def open_readers(urls, concurrency, revalidate=False, block_cache=None, profiler=None):
+    """
+    Open `RangeReader`s for the given URLs, `concurrency` at a time.
+
+    URLs whose servers don't support range requests are left out; they need to be downloaded as usual.
+
+    :return: Dict of URL -> `RangeReader`
+    """
+    urls = list(urls)
+    if not urls:
+        return {}
+    block_cache = (block_cache or BlockCache())
+
+    def open_reader(url):
+        try:
+            return RangeReader(url, block_cache, profiler=profiler).open(revalidate=revalidate)
+        except RangesNotSupported:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(urls)))) as pool:
+        readers = dict(zip(urls, pool.map(open_reader, urls)))
+    return {url: reader for (url, reader) in readers.items() if reader}
+
+
+class LazyInputFS:
+    """
+    FUSE operations (for `fusepy`) of a read-only filesystem of lazily read files.
+
+    :param files: Dict of relative path (with forward slashes) -> `RangeReader`
+    :param verbose: Whether to print read errors (rather than only log them)
+    """
+
+    use_ns = True
+
+    def __init__(self, files, verbose=True):
+        self.files = {'/' + path: reader for (path, reader) in files.items()}
+        self.dirs = {'/': set()}
+        for path in self.files:
+            child = path
+            while child != '/':
+                parent = posixpath.dirname(child)
+                self.dirs.setdefault(parent, set()).add(posixpath.basename(child))
+                child = parent
+        self.time = int(time.time() * 1e9)
+        self.verbose = verbose
+        self.errors_reported = set()
+
+    def __call__(self, op, *args):
+        return getattr(self, op)(*args)
+
+    def getattr(self, path, fh=None):
+        attrs = {
+            'st_uid': os.getuid(),
+            'st_gid': os.getgid(),
+            'st_atime': self.time,
+            'st_mtime': self.time,
+            'st_ctime': self.time,
+        }
+        if path in self.dirs:
+            return dict(attrs, st_mode=(stat.S_IFDIR | 0o555), st_nlink=2, st_size=0)
+        if path in self.files:
+            return dict(attrs, st_mode=(stat.S_IFREG | 0o444), st_nlink=1, st_size=self.files[path].size)
+        raise OSError(errno.ENOENT, path)
+
+    def readdir(self, path, fh):
+        if path not in self.dirs:
+            raise OSError(errno.ENOTDIR, path)
+        return ['.', '..'] + sorted(self.dirs[path])
+
+    def open(self, path, flags):
+        if path not in self.files:
+            raise OSError(errno.ENOENT, path)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(errno.EROFS, path)
+        return 0
+
+    def read(self, path, size, offset, fh):
+        reader = self.files[path]
+        try:
+            return reader.read(offset, size)
+        except Exception as exc:
+            if reader.url not in self.errors_reported:  # The execution only sees EIO; tell the user why, once
+                self.errors_reported.add(reader.url)
+                warn('Could not read {}: {}'.format(reader.url, exc), verbose=self.verbose, fg='red')
+            raise OSError(errno.EIO, str(exc))
+
+    def statfs(self, path):
+        return {'f_bsize': 4096, 'f_namemax': 255}
+
+
+class LazyMount:
+    """
+    A `LazyInputFS` mounted (in a background thread) at a temporary directory.
+    """
+
+    def __init__(self, files, verbose=True):
+        self.files = files
+        self.verbose = verbose
+        self.mountpoint = None
+        self.thread = None
+        self.error = None
+
+    def start(self, timeout=10):
+        fuse = get_fuse()
+        self.mountpoint = tempfile.mkdtemp(prefix='valohai-lazy-inputs-')
+        self.thread = threading.Thread(target=self._run, args=(fuse,), name='lazy-inputs', daemon=True)
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not os.path.ismount(self.mountpoint):
+            if not self.thread.is_alive() or time.time() > deadline:
+                self.stop()
+                raise RuntimeError('Could not mount lazy inputs: {}'.format(
+                    self.error or 'timed out (is `user_allow_other` set in /etc/fuse.conf?)',
+                ))
+            time.sleep(0.01)
+        return self
+
+    def get_path(self, relative_path):
+        return os.path.join(self.mountpoint, *relative_path.split('/'))
+
+    def stop(self):
+        if not self.mountpoint:
+            return
+        if os.path.ismount(self.mountpoint):
+            # Lazily, so a straggling process (e.g. a container still being removed) doesn't keep it mounted
+            subprocess.call(['fusermount', '-u', '-z', self.mountpoint], stderr=subprocess.DEVNULL)
+        self.thread.join(timeout=10)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.mountpoint)
+        self.mountpoint = None
+
+    def _run(self, fuse):
+        try:
+            operations = LazyInputFS(self.files, verbose=self.verbose)
+            fuse.FUSE(operations, self.mountpoint, foreground=True, ro=True, allow_other=True)
+        except Exception as exc:
+            self.error = exc
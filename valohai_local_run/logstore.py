@@ -0,0 +1,267 @@
+import argparse
+import bisect
+import datetime
+import itertools
+import os
+import struct
+import sys
+import time
+
+from click import echo, style
+
+from .consts import DEFAULT_OUTPUT_ROOT, STRUCTURED_LOG_INDEX_NAME, STRUCTURED_LOG_NAME
+from .excs import BadUsage
+
+# The structured log is a header followed by line records:
+#
+#   header: MAGIC, start time (float, seconds since the epoch)
+#   record: time since start (float, monotonic), stream ID, offset of the line within its stream, length, data
+#
+# The sidecar index has an entry (line number, time since start, file offset) for every `INDEX_INTERVAL`th record,
+# so reads can start close to a given line or time without scanning the whole log.
+MAGIC = b'VHLOG\x01'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<dBQI')
+INDEX_ENTRY = struct.Struct('<QdQ')
+INDEX_INTERVAL = 256
+MAX_LINE_LENGTH = 65536  # Longer lines are split into multiple records
+STREAMS = ('stdout', 'stderr')
+END_STREAM_ID = 255
+
+
+class StructuredLogWriter:
+    """
+    Writes a structured log; `stream(name)` returns file-like objects suitable for `tee_spawn`.
+    """
+
+    def __init__(self, directory):
+        self.start_time = time.time()
+        self.start_monotonic = time.monotonic()
+        self.file = open(os.path.join(directory, STRUCTURED_LOG_NAME), 'wb')
+        self.index_file = open(os.path.join(directory, STRUCTURED_LOG_INDEX_NAME), 'wb')
+        self.file.write(MAGIC + HEADER.pack(self.start_time))
+        self.position = self.file.tell()
+        self.n_records = 0
+        self.streams = {}
+
+    def stream(self, name):
+        if name not in self.streams:
+            self.streams[name] = StructuredLogStream(self, STREAMS.index(name))
+        return self.streams[name]
+
+    def write_records(self, stream_id, offset, lines):
+        timestamp = time.monotonic() - self.start_monotonic
+        parts = []
+        index_entries = []
+        for line in lines:
+            if self.n_records % INDEX_INTERVAL == 0:
+                index_entries.append(INDEX_ENTRY.pack(self.n_records, timestamp, self.position))
+            parts.append(RECORD.pack(timestamp, stream_id, offset, len(line)))
+            parts.append(line)
+            offset += len(line)
+            self.position += RECORD.size + len(line)
+            self.n_records += 1
+        # Flush eagerly (and the log before the index) so the log can be followed while the execution runs
+        self.file.write(b''.join(parts))
+        self.file.flush()
+        if index_entries:
+            self.index_file.write(b''.join(index_entries))
+            self.index_file.flush()
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.flush()
+        self.write_records(END_STREAM_ID, 0, [b''])
+        self.file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StructuredLogStream:
+    def __init__(self, writer, stream_id):
+        self.writer = writer
+        self.stream_id = stream_id
+        self.offset = 0
+        self.partial = b''
+
+    def write(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        lines = [line + b'\n' for line in lines]
+        while len(self.partial) > MAX_LINE_LENGTH:
+            lines.append(self.partial[:MAX_LINE_LENGTH])
+            self.partial = self.partial[MAX_LINE_LENGTH:]
+        self._write_lines(lines)
+        return len(data)
+
+    def flush(self):
+        if self.partial:
+            self._write_lines([self.partial])
+            self.partial = b''
+
+    def _write_lines(self, lines):
+        if lines:
+            self.writer.write_records(self.stream_id, self.offset, lines)
+            self.offset += sum(len(line) for line in lines)
+
+
+class LogRecord:
+    __slots__ = ('line', 'time', 'stream', 'offset', 'data')
+
+    def __init__(self, line, time, stream, offset, data):
+        self.line = line
+        self.time = time
+        self.stream = stream
+        self.offset = offset
+        self.data = data
+
+
+class StructuredLogReader:
+    def __init__(self, directory):
+        self.path = os.path.join(directory, STRUCTURED_LOG_NAME)
+        self.index_path = os.path.join(directory, STRUCTURED_LOG_INDEX_NAME)
+        with open(self.path, 'rb') as infp:
+            header = infp.read(len(MAGIC) + HEADER.size)
+        if not header.startswith(MAGIC):
+            raise ValueError('%s is not a structured log' % self.path)
+        self.start_time = HEADER.unpack(header[len(MAGIC):])[0]
+
+    def read_index(self):
+        with open(self.index_path, 'rb') as infp:
+            data = infp.read()
+        n_entries = len(data) // INDEX_ENTRY.size
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in range(n_entries)]
+
+    def find_start(self, line=None, since=None):
+        """
+        Find the index entry to start scanning from to find the given line or time.
+
+        :return: Tuple of (line number, file offset)
+        """
+        index = self.read_index()
+        if not index:
+            return (0, len(MAGIC) + HEADER.size)
+        if line is not None:
+            position = bisect.bisect_right([entry[0] for entry in index], line) - 1
+        elif since is not None:
+            # Start from the last entry stamped before `since`; the lines before it can't be any later
+            position = bisect.bisect_left([entry[1] for entry in index], since) - 1
+        else:
+            position = 0
+        entry = index[max(0, position)]
+        return (entry[0], entry[2])
+
+    def read(self, line=None, since=None, until=None, follow=False, poll_interval=0.25):
+        """
+        Iterate over the records of the log, starting at the given line number or time (seconds since start).
+
+        :param follow: Keep waiting for new records until the end of the log is written
+        """
+        line_number, position = self.find_start(line=line, since=since)
+        with open(self.path, 'rb') as infp:
+            infp.seek(position)
+            while True:
+                header = infp.read(RECORD.size)
+                if len(header) == RECORD.size:
+                    timestamp, stream_id, offset, length = RECORD.unpack(header)
+                    data = infp.read(length)
+                    if len(data) == length:
+                        if stream_id == END_STREAM_ID:
+                            return
+                        if until is not None and timestamp > until:
+                            return
+                        if (line is None or line_number >= line) and (since is None or timestamp >= since):
+                            yield LogRecord(line_number, timestamp, STREAMS[stream_id], offset, data)
+                        line_number += 1
+                        position = infp.tell()
+                        continue
+                # Incomplete record; the log is still being written
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+                infp.seek(position)
+
+
+def find_execution_dir(output_root, execution, marker=STRUCTURED_LOG_NAME):
+    """
+    Find the output directory of an execution by its ID (or a prefix of one), or the latest execution.
+
+    :param marker: Only consider output directories that contain this file
+    """
+    if execution and os.path.isdir(execution):
+        if not os.path.isfile(os.path.join(execution, marker)):
+            raise BadUsage('No {} found in {}'.format(marker, execution))
+        return execution
+    try:
+        candidates = sorted(
+            name for name in os.listdir(output_root)
+            if os.path.isfile(os.path.join(output_root, name, marker)) and
+            name.startswith(execution or '')
+        )
+    except FileNotFoundError:
+        candidates = []
+    if not candidates:
+        raise BadUsage('No executions with {} found in {}'.format(marker, output_root))
+    if execution and len(candidates) > 1:
+        raise BadUsage('"{}" is ambiguous; it matches {}'.format(execution, ', '.join(candidates)))
+    return os.path.join(output_root, candidates[-1])  # Execution IDs sort chronologically
+
+
+def logs_cli(argv):
+    ap = argparse.ArgumentParser(
+        prog='valohai-local-run logs',
+        description='Show the structured log of an execution (run with --structured-logs).',
+    )
+    ap.add_argument('execution', nargs='?', default=None,
+        help='Execution ID (or a prefix of one) or output directory; defaults to the latest execution')
+    ap.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT, help='Output root')
+    ap.add_argument('--line', type=int, default=None, metavar='N', help='Start from line N (0-based)')
+    ap.add_argument('--count', '-n', type=int, default=None, metavar='N', help='Show at most N lines')
+    ap.add_argument('--since', type=float, default=None, metavar='SECONDS',
+        help='Show lines logged at least this many seconds after the start of the execution')
+    ap.add_argument('--until', type=float, default=None, metavar='SECONDS',
+        help='Show lines logged at most this many seconds after the start of the execution')
+    ap.add_argument('--stream', choices=STREAMS, default=None, help='Only show one stream')
+    ap.add_argument('--timestamps', '-t', action='store_true', help='Prefix lines with their time and stream')
+    ap.add_argument('--follow', '-f', action='store_true', help='Keep showing new lines until the execution ends')
+    args = ap.parse_args(argv)
+
+    try:
+        directory = find_execution_dir(args.output_root, args.execution)
+    except BadUsage as be:
+        ap.error('{} (was the execution run with --structured-logs?)'.format(be))
+    try:
+        reader = StructuredLogReader(directory)
+    except (IOError, ValueError) as exc:  # e.g. removed in the meanwhile, or not a structured log after all
+        ap.error(exc)
+    if args.timestamps:
+        echo('Execution started at {}'.format(
+            style(datetime.datetime.fromtimestamp(reader.start_time).isoformat(), bold=True),
+        ), err=True)
+    records = reader.read(line=args.line, since=args.since, until=args.until, follow=args.follow)
+    if args.stream:
+        records = (record for record in records if record.stream == args.stream)
+    if args.count is not None:
+        records = itertools.islice(records, args.count)
+    try:
+        write_records(records, getattr(sys.stdout, 'buffer', sys.stdout), timestamps=args.timestamps, flush=args.follow)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def write_records(records, output, timestamps=False, flush=False):
+    try:
+        for record in records:
+            if timestamps:
+                output.write('[{:>10.3f} {}] '.format(record.time, record.stream[3:]).encode())
+            output.write(record.data)
+            if flush:
+                output.flush()
+    finally:
+        output.flush()
@@ -0,0 +1,115 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from .consts import EXECUTION_METADATA_JSON_NAME, MEMO_INDEX_NAME
+from .inputs import link_file
+
+
+def get_fingerprint(commit, image, interpolated_command, parameters, input_digests, docker_add_args=None):
+    """
+    Fingerprint an execution by everything that determines its outputs.
+
+    :param input_digests: Dict of input file path in the container -> SHA256 digest
+    :param docker_add_args: Additional Docker arguments, which may e.g. set environment variables
+    """
+    data = {
+        'commit': commit,
+        'image': image,
+        'interpolated_command': interpolated_command,
+        'parameters': parameters,
+        'inputs': input_digests,
+        'docker_add_args': docker_add_args,
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def link_outputs(source_dir, dest_dir):
+    """
+    Recreate the output directory of an earlier execution (including its logs) in `dest_dir`,
+    as reflinks or hardlinks of the files where possible.
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        relative_dir = os.path.relpath(dirpath, source_dir)
+        dest_dirpath = os.path.normpath(os.path.join(dest_dir, relative_dir))
+        os.makedirs(dest_dirpath, exist_ok=True)
+        for name in filenames + dirnames:
+            path = os.path.join(dirpath, name)
+            dest = os.path.join(dest_dirpath, name)
+            if relative_dir == '.' and name == EXECUTION_METADATA_JSON_NAME:
+                continue
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), dest)
+            elif os.path.isfile(path):
+                try:
+                    link_file(path, dest)
+                except OSError:
+                    shutil.copy2(path, dest)
+
+
+class MemoIndex:
+    """
+    An index of the successful executions in an output root, by their fingerprint (see `get_fingerprint()`),
+    so identical executions can reuse the outputs of earlier ones instead of running again.
+
+    The index is kept in `.valohai-memo.json` in the output root.
+    """
+
+    def __init__(self, output_root):
+        self.output_root = output_root
+        self.path = os.path.join(output_root, MEMO_INDEX_NAME)
+
+    def get(self, fingerprint):
+        """
+        Find an earlier execution with the given fingerprint whose outputs still exist.
+
+        :return: Output directory of the execution, or None
+        """
+        entry = self._read_index().get(fingerprint)
+        if not entry:
+            return None
+        output_dir = os.path.join(self.output_root, entry['execution_id'])
+        try:
+            with open(os.path.join(output_dir, EXECUTION_METADATA_JSON_NAME), 'r') as infp:
+                metadata = json.load(infp)
+        except (IOError, ValueError):
+            return None
+        if metadata.get('fingerprint') != fingerprint or metadata.get('exit_code') != 0:
+            return None
+        return output_dir
+
+    def add(self, fingerprint, execution_id):
+        with self._locked_index() as index:
+            for key, entry in list(index.items()):  # Forget executions that have been removed
+                if not os.path.isdir(os.path.join(self.output_root, entry['execution_id'])):
+                    del index[key]
+            index[fingerprint] = {'execution_id': execution_id, 'time': time.time()}
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                self._write_index(index)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.path, 'r') as infp:
+                return json.load(infp)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, temp_path = tempfile.mkstemp(dir=self.output_root, prefix='.valohai-memo-')
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(index, outf, sort_keys=True)
+        os.rename(temp_path, self.path)
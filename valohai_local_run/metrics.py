@@ -0,0 +1,169 @@
+import csv
+import hashlib
+import json
+import numbers
+import os
+import re
+import time
+from collections import OrderedDict
+
+from click import echo, style
+
+from .consts import METRICS_DIR_NAME
+
+MAX_LINE_LENGTH = 1048576  # Longer lines can't be metadata; don't buffer them
+MAX_OPEN_WRITERS = 64  # CSV files kept open at a time; the least recently written ones are closed
+
+
+def sanitize_metric_name(name):
+    return (re.sub(r'[^\w.-]+', '_', name).strip('.') or '_')
+
+
+class MetricSummary:
+    def __init__(self):
+        self.count = 0
+        self.numeric_count = 0
+        self.last = None
+        self.min = None
+        self.max = None
+        self.total = 0
+
+    def add(self, value):
+        self.count += 1
+        self.last = value
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            self.numeric_count += 1
+            self.total += value
+            self.min = (value if self.min is None else min(self.min, value))
+            self.max = (value if self.max is None else max(self.max, value))
+
+    def as_dict(self):
+        data = {'count': self.count, 'last': self.last}
+        if self.numeric_count:
+            data.update(min=self.min, max=self.max, mean=(self.total / self.numeric_count))
+        return data
+
+
+class MetricsCollector:
+    """
+    Picks up Valohai metadata (lines of JSON objects) from a stream as it is being written.
+
+    Each key is appended to a CSV file of its own, `<key>.csv`, in the `valohai-metrics` directory,
+    with the columns `index` (the number of the metadata line), `time` (seconds since the collector
+    was created) and `value`.  Keys that sanitize into the same file name as an earlier key get a
+    hash suffix (`<key>-<hash>.csv`).  Running summaries of each key are available from `summary()`.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, METRICS_DIR_NAME)
+        self.start_time = time.monotonic()
+        self.partial = b''
+        self.skipping = False
+        self.n_rows = 0
+        self.filenames = {}  # Key -> CSV file name
+        self.writers = OrderedDict()  # Key -> (file, csv writer), least recently used first
+        self.summaries = {}
+
+    def write(self, data):
+        newline_pos = data.rfind(b'\n')
+        if newline_pos == -1:
+            self._buffer(data)
+            return len(data)
+        complete = self.partial + data[:newline_pos]
+        if self.skipping:  # Drop the rest of an overlong line
+            complete = complete[(complete.find(b'\n') + 1 or len(complete)):]
+            self.skipping = False
+        self.partial = b''
+        self._buffer(data[newline_pos + 1:])
+        if b'{' in complete:
+            self._process(complete.split(b'\n'))
+        return len(data)
+
+    def _buffer(self, data):
+        if self.skipping:
+            return
+        self.partial += data
+        if len(self.partial) > MAX_LINE_LENGTH:
+            self.partial = b''
+            self.skipping = True
+
+    def _process(self, lines):
+        for line in lines:
+            line = line.strip()
+            if not (line.startswith(b'{') and line.endswith(b'}')):
+                continue
+            try:
+                values = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(values, dict) and values:
+                self._record(values)
+        for writer_file, writer in self.writers.values():
+            writer_file.flush()
+
+    def _record(self, values):
+        timestamp = round(time.monotonic() - self.start_time, 3)
+        for key, value in values.items():
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, sort_keys=True)
+            self._get_writer(key).writerow((self.n_rows, timestamp, value))
+            self.summaries[key].add(value)
+        self.n_rows += 1
+
+    def _get_writer(self, key):
+        if key in self.writers:
+            self.writers.move_to_end(key)
+            return self.writers[key][1]
+        is_new = (key not in self.filenames)
+        if is_new:
+            if not self.filenames:
+                os.makedirs(self.directory, exist_ok=True)
+            filename = sanitize_metric_name(key) + '.csv'
+            if filename in self.filenames.values():
+                filename = '{}-{}.csv'.format(filename[:-4], hashlib.sha1(key.encode('utf-8')).hexdigest()[:8])
+            self.filenames[key] = filename
+            self.summaries[key] = MetricSummary()
+        if len(self.writers) >= MAX_OPEN_WRITERS:
+            self.writers.popitem(last=False)[1][0].close()
+        writer_file = open(os.path.join(self.directory, self.filenames[key]), 'a', newline='')
+        writer = csv.writer(writer_file)
+        if is_new:
+            writer.writerow(('index', 'time', 'value'))
+        self.writers[key] = (writer_file, writer)
+        return writer
+
+    def close(self):
+        if self.partial and not self.skipping:
+            self._process([self.partial])
+        self.partial = b''
+        for writer_file, writer in self.writers.values():
+            writer_file.close()
+        self.writers.clear()
+
+    def summary(self):
+        return {key: summary.as_dict() for (key, summary) in sorted(self.summaries.items())}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def print_metrics_summary(summary):
+    if not summary:
+        return
+    width = max(len(key) for key in summary)
+    echo(style('{key:<{width}}  {count:>7}  {last:>12}  {min:>12}  {mean:>12}  {max:>12}'.format(
+        key='metric', width=width, count='count', last='last', min='min', mean='mean', max='max',
+    ), bold=True))
+    for key, data in summary.items():
+        echo('{key:<{width}}  {count:>7}  {last:>12}  {min:>12}  {mean:>12}  {max:>12}'.format(
+            key=key,
+            width=width,
+            count=data['count'],
+            **{
+                name: ('%.6g' % data[name] if isinstance(data.get(name), float) else str(data.get(name, '-'))[:12])
+                for name in ('last', 'min', 'mean', 'max')
+            }
+        ))
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from click import echo, secho, style
+
+from .consts import (
+    DEFAULT_OUTPUT_ROOT, EXECUTION_METADATA_JSON_NAME, OUTPUTS_ARCHIVE_NAME, OUTPUTS_MANIFEST_NAME,
+    RESERVED_OUTPUT_NAMES,
+)
+from .excs import BadUsage
+from .utils import format_size, hash_file
+
+
+def walk_outputs(output_dir):
+    """
+    Find the output files of an execution, leaving out the files written by the executor itself.
+
+    :return: Sorted list of (path, path relative to the output directory, with forward slashes)
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        relative_dir = os.path.relpath(dirpath, output_dir)
+        if relative_dir == '.':
+            dirnames[:] = [name for name in dirnames if name not in RESERVED_OUTPUT_NAMES]
+            filenames = [name for name in filenames if name not in RESERVED_OUTPUT_NAMES]
+        for filename in filenames:
+            relative_path = os.path.normpath(os.path.join(relative_dir, filename))
+            files.append((os.path.join(dirpath, filename), relative_path.replace(os.sep, '/')))
+    return sorted(files, key=lambda file: file[1])
+
+
+def build_manifest(output_dir, previous=None):
+    """
+    List the output files of an execution with their size, SHA256 digest and modification time.
+
+    Files are hashed in parallel.
+
+    :param previous: Earlier manifest of the same files (see `read_manifest()`); the digests of files
+                     whose size and modification time haven't changed since are reused instead of rehashing
+    :return: Tuple of (list of manifest entries, number of files hashed)
+    """
+    known = {entry['path']: entry for entry in (previous or ())}
+    entries = []
+    stale = []
+    for path, relative_path in walk_outputs(output_dir):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:  # A dangling symlink
+            continue
+        entry = {'path': relative_path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': None}
+        old_entry = known.get(relative_path)
+        if old_entry and (old_entry['size'], old_entry['mtime']) == (entry['size'], entry['mtime']):
+            entry['sha256'] = old_entry['sha256']
+        else:
+            stale.append((path, entry))
+        entries.append(entry)
+    if stale:  # Hashing mostly waits for I/O (and releases the GIL), so it's worth doing in parallel
+        with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1)) as pool:
+            for (path, entry), digest in zip(stale, pool.map(hash_file, [path for (path, entry) in stale])):
+                entry['sha256'] = digest
+    return (entries, len(stale))
+
+
+def read_manifest(output_dir):
+    """
+    Read the outputs manifest of an execution.
+
+    :return: List of manifest entries, or None if the execution has no (readable) manifest
+    """
+    try:
+        with open(os.path.join(output_dir, OUTPUTS_MANIFEST_NAME), 'r') as infp:
+            return json.load(infp)['files']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_manifest(output_dir, entries):
+    # Replace the manifest atomically; it may also be a link to the manifest of a memoized execution
+    fd, temp_path = tempfile.mkstemp(dir=output_dir, prefix='.valohai-outputs-')
+    with os.fdopen(fd, 'w') as outf:
+        json.dump({'files': entries}, outf, indent=2, sort_keys=True)
+    os.rename(temp_path, os.path.join(output_dir, OUTPUTS_MANIFEST_NAME))
+
+
+def get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            'The `zstandard` module must be available for packing outputs '
+            '(install `valohai-local-run[zstd]`)'
+        )
+    return zstandard
+
+
+def write_archive(output_dir, relative_paths, level=3):
+    """
+    Pack the given output files into a zstd-compressed tarball in the output directory.
+
+    The tar stream is compressed on a pool of threads as it's written.
+
+    :return: Path of the archive
+    """
+    zstandard = get_zstandard()
+    archive_path = os.path.join(output_dir, OUTPUTS_ARCHIVE_NAME)
+    compressor = zstandard.ZstdCompressor(level=level, threads=(os.cpu_count() or 1))
+    fd, temp_path = tempfile.mkstemp(dir=output_dir, prefix='.valohai-outputs-')
+    try:
+        with os.fdopen(fd, 'wb') as outf, compressor.stream_writer(outf, closefd=False) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for relative_path in relative_paths:
+                    tar.add(os.path.join(output_dir, relative_path), arcname=relative_path, recursive=False)
+        os.rename(temp_path, archive_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return archive_path
+
+
+def outputs_cli(argv):
+    from .logstore import find_execution_dir
+    ap = argparse.ArgumentParser(
+        prog='valohai-local-run outputs',
+        description='Update the outputs manifest of an execution, or pack its outputs.',
+    )
+    ap.add_argument('action', choices=('manifest', 'pack'))
+    ap.add_argument('execution', nargs='?', default=None,
+        help='Execution ID (or a prefix of one) or output directory; defaults to the latest execution')
+    ap.add_argument('--output-root', default=DEFAULT_OUTPUT_ROOT, help='Output root')
+    ap.add_argument('--full', action='store_true', default=False,
+        help='Rehash all files, instead of only those whose size or modification time has changed')
+    args = ap.parse_args(argv)
+
+    try:
+        directory = find_execution_dir(args.output_root, args.execution, marker=EXECUTION_METADATA_JSON_NAME)
+    except BadUsage as be:
+        ap.error(be)
+    if args.action == 'manifest':
+        entries, n_hashed = build_manifest(directory, previous=(None if args.full else read_manifest(directory)))
+        write_manifest(directory, entries)
+        secho('{} files ({}), {} hashed.'.format(
+            len(entries),
+            format_size(sum(entry['size'] for entry in entries)),
+            n_hashed,
+        ), bold=True)
+    else:
+        archive_path = write_archive(directory, [relative_path for (path, relative_path) in walk_outputs(directory)])
+        echo('Outputs packed into {} ({})'.format(
+            style(archive_path, bold=True),
+            format_size(os.stat(archive_path).st_size),
+        ))
+    return 0
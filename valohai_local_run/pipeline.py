@@ -0,0 +1,359 @@
+import fnmatch
+import os
+import posixpath
+import threading
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from click import echo, secho, style
+from valohai_yaml.objs import ExecutionNode
+from valohai_yaml.objs.pipelines.edge_merge_mode import EdgeMergeMode
+from valohai_yaml.objs.pipelines.node import ErrorAction
+from valohai_yaml.objs.pipelines.override import Override
+from valohai_yaml.utils import listify
+from valohai_yaml.utils.node_socket_utils import split_socket_str
+
+from .excs import BadUsage
+from .outputs import walk_outputs
+from .utils import match_prefix
+
+# (source type, target type) of the edges that can be followed locally
+SUPPORTED_EDGE_TYPES = {
+    ('output', 'input'),
+    ('parameter', 'parameter'),
+    ('metadata', 'parameter'),  # The last value of a metric printed by the upstream execution
+}
+
+
+def match_pipeline(step_table, name):
+    if name in step_table.pipelines:
+        return name
+    matches = match_prefix(step_table.pipelines, name)
+    if len(matches) != 1:
+        raise BadUsage('"{name}" is {problem} (known pipelines are {pipelines})'.format(
+            name=name,
+            problem=('ambiguous' if matches else 'not a known pipeline'),
+            pipelines=(', '.join(sorted(step_table.pipelines)) or 'none'),
+        ))
+    return matches[0]
+
+
+class PipelineNode:
+    """
+    An execution node of a pipeline, with the step it runs and its parameters and inputs
+    (before anything is passed to it along the pipeline's edges).
+    """
+
+    def __init__(self, node, step, parameter_types=None):
+        self.node = node
+        self.name = node.name
+        self.step = step
+        override = Override.merge_with_step(node.override, step)
+        self.image = override.image
+        self.command = override.command
+        self.parameters = {name: parameter.default for (name, parameter) in override.parameters.items()}
+        self.inputs = {name: listify(input.default) for (name, input) in override.inputs.items()}
+        self.parameter_types = (parameter_types or {})
+        self.given_inputs = set()  # Inputs given on the command line, replacing the defaults
+
+    def set_parameter(self, name, value):
+        if name not in self.parameters:
+            raise BadUsage('Node {} has no parameter {}'.format(self.name, name))
+        step_parameter = self.step.parameters.get(name)
+        value_type = self.parameter_types.get(step_parameter.type if step_parameter else None)
+        if value_type and isinstance(value, str):
+            try:
+                value = value_type(value)
+            except ValueError:
+                raise BadUsage('Invalid value {!r} for parameter {} of node {}'.format(value, name, self.name))
+        self.parameters[name] = value
+
+    def add_input(self, name, value):
+        if name not in self.inputs:
+            raise BadUsage('Node {} has no input {}'.format(self.name, name))
+        if name not in self.given_inputs:
+            self.given_inputs.add(name)
+            self.inputs[name] = []
+        self.inputs[name].append(value)
+
+    def get_arguments(self, edge_inputs, edge_parameters):
+        """
+        Merge the values passed along the edges into the node's own inputs and parameters.
+
+        :return: Tuple of (inputs, parameters)
+        """
+        inputs = dict(self.inputs)
+        for name, values in edge_inputs.items():
+            if self.node.edge_merge_mode == EdgeMergeMode.APPEND:
+                values = inputs.get(name, []) + values
+            inputs[name] = values
+        return (inputs, dict(self.parameters, **edge_parameters))
+
+
+def get_pipeline_nodes(pipeline, step_table, parameter_types=None):
+    """
+    Get the nodes of a pipeline, with the pipeline's parameters applied.
+
+    :param parameter_types: Dict of parameter type name -> type callable for values given as strings
+    :return: Dict of node name -> PipelineNode
+    """
+    nodes = {}
+    for node in pipeline.nodes:
+        if not isinstance(node, ExecutionNode):
+            raise BadUsage('Node {} is a {} node; only execution nodes can be run locally'.format(node.name, node.type))
+        if node.commit:
+            raise BadUsage('Node {} uses commit {}; nodes can only run the pipeline\'s own commit locally'.format(
+                node.name,
+                node.commit,
+            ))
+        if node.step not in step_table.steps:
+            raise BadUsage('Node {} refers to unknown step {}'.format(node.name, node.step))
+        nodes[node.name] = PipelineNode(node, step_table.get_step(node.step), parameter_types=parameter_types)
+    for parameter in pipeline.parameters:
+        if parameter.default is not None:
+            set_pipeline_parameter(pipeline, nodes, parameter.name, parameter.default)
+    return nodes
+
+
+def set_pipeline_parameter(pipeline, nodes, name, value):
+    parameter = next((parameter for parameter in pipeline.parameters if parameter.name == name), None)
+    if not parameter:
+        raise BadUsage('Pipeline {} has no parameter {}'.format(pipeline.name, name))
+    for target in parameter.targets:
+        node_name, socket_type, parameter_name = split_socket_str(target)
+        nodes[node_name].set_parameter(parameter_name, value)
+
+
+def apply_arguments(pipeline, nodes, parameters=(), inputs=()):
+    """
+    Apply `NODE.NAME=VALUE` parameter and `NODE.NAME=URL` input arguments (or `NAME=VALUE` for pipeline parameters).
+    """
+    arguments = [(argument, False) for argument in parameters] + [(argument, True) for argument in inputs]
+    for argument, is_input in arguments:
+        target, sep, value = argument.partition('=')
+        if not sep:
+            raise BadUsage('Expected NODE.NAME=VALUE, not {!r}'.format(argument))
+        node_name, dot, name = target.partition('.')
+        if not dot and not is_input:
+            set_pipeline_parameter(pipeline, nodes, target, value)
+            continue
+        if node_name not in nodes:
+            raise BadUsage('Pipeline {} has no node {}'.format(pipeline.name, node_name))
+        if is_input:
+            nodes[node_name].add_input(name, value)
+        else:
+            nodes[node_name].set_parameter(name, value)
+
+
+def get_dependencies(pipeline):
+    """
+    Get the upstream nodes of each node of a pipeline.
+
+    :return: Dict of node name -> set of names of the nodes it depends on
+    """
+    dependencies = {node.name: set() for node in pipeline.nodes}
+    for edge in pipeline.edges:
+        for name in (edge.source_node, edge.target_node):
+            if name not in dependencies:
+                raise BadUsage('Pipeline {} has an edge ({} -> {}) with unknown node {}'.format(
+                    pipeline.name, edge.source, edge.target, name,
+                ))
+        if (edge.source_type, edge.target_type) not in SUPPORTED_EDGE_TYPES:
+            raise BadUsage('Edges from {} to {} ({} -> {}) are not supported in local runs'.format(
+                edge.source_type, edge.target_type, edge.source, edge.target,
+            ))
+        dependencies[edge.target_node].add(edge.source_node)
+    sort_nodes(dependencies)  # Check for cycles
+    return dependencies
+
+
+def sort_nodes(dependencies):
+    """
+    Sort nodes so that every node comes after the nodes it depends on.
+
+    :param dependencies: Dict of node name -> set of names of the nodes it depends on
+    :return: List of node names
+    """
+    remaining = {name: set(upstream) for (name, upstream) in dependencies.items()}
+    order = []
+    while remaining:
+        ready = sorted(name for (name, upstream) in remaining.items() if not upstream)
+        if not ready:
+            raise BadUsage('Pipeline has a cycle among nodes {}'.format(', '.join(sorted(remaining))))
+        for name in ready:
+            del remaining[name]
+        for upstream in remaining.values():
+            upstream.difference_update(ready)
+        order.extend(ready)
+    return order
+
+
+def get_descendants(dependencies, name):
+    descendants = set()
+    frontier = {name}
+    while frontier:
+        frontier = {
+            downstream for (downstream, upstream) in dependencies.items()
+            if upstream & frontier and downstream not in descendants
+        }
+        descendants |= frontier
+    return descendants
+
+
+def find_outputs(output_dir, pattern):
+    """
+    Find the output files of an execution that match the pattern of an edge (e.g. `model.pkl` or `*.csv`).
+
+    Patterns are matched against both the path of the file relative to the output directory, and its name.
+    """
+    return [
+        path for (path, relative_path) in walk_outputs(output_dir)
+        if any(fnmatch.fnmatchcase(name, pattern) for name in (relative_path, posixpath.basename(relative_path)))
+    ]
+
+
+def get_edge_values(pipeline, node_name, executors):
+    """
+    Get the values passed to a node along the pipeline's edges from the (finished) upstream executions.
+
+    Output files are passed as paths within the upstream output directories; they are then mounted
+    read-only like any other local input, without copying.
+
+    :return: Tuple of (inputs, parameters)
+    """
+    inputs = defaultdict(list)
+    parameters = {}
+    for edge in pipeline.edges:
+        upstream = executors.get(edge.source_node)
+        if edge.target_node != node_name or not upstream:
+            continue
+        if edge.source_type == 'output':
+            inputs[edge.target_key].extend(find_outputs(upstream.output_dir, edge.source_key))
+        elif edge.source_type == 'parameter':
+            parameters[edge.target_key] = upstream.parameters.get(edge.source_key)
+        elif edge.source_type == 'metadata':
+            metric = (upstream.results.get('metrics') or {}).get(edge.source_key)
+            if metric:
+                parameters[edge.target_key] = metric['last']
+    return (dict(inputs), parameters)
+
+
+class PipelineRunner:
+    """
+    Runs the nodes of a pipeline, each once the nodes upstream of it have finished, at most `jobs` at a time.
+
+    Output of the executions is not passed through; it is saved in each execution's output directory.
+    """
+
+    def __init__(self, pipeline, nodes, build_executor, jobs, save_logs=True):
+        """
+        :param nodes: Dict of node name -> PipelineNode
+        :param build_executor: Function of (PipelineNode, inputs, parameters) returning an executor
+        """
+        self.pipeline = pipeline
+        self.nodes = nodes
+        self.build_executor = build_executor
+        self.jobs = max(1, jobs)
+        self.save_logs = save_logs
+        self.dependencies = get_dependencies(pipeline)
+        self.order = sort_nodes(self.dependencies)
+        self.lock = threading.Lock()
+        self.executors = {}
+        self.results = {}
+        self.pending = set(self.order)
+        self.finished = set()
+        self.stopped = False
+
+    def run(self):
+        """
+        :return: Dict of node name -> exit code (None for nodes that were not run or failed to start)
+        """
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while True:
+                for name in self.get_ready(self.jobs - len(running)):
+                    self.pending.discard(name)
+                    self.executors[name] = self.build_node_executor(name)
+                    running[pool.submit(self.run_node, name, self.executors[name])] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.set_result(running.pop(future), future.result())
+        self.print_summary()
+        return {name: self.results.get(name) for name in self.order}
+
+    def get_ready(self, limit):
+        # Only start as many nodes as can run right away, so e.g. a failure can still stop the rest
+        if self.stopped or limit <= 0:
+            return []
+        ready = [name for name in self.order if name in self.pending and self.dependencies[name] <= self.finished]
+        return ready[:limit]
+
+    def build_node_executor(self, name):
+        node = self.nodes[name]
+        inputs, parameters = node.get_arguments(*get_edge_values(self.pipeline, name, self.executors))
+        for input_name, filenames in sorted(inputs.items()):
+            basenames = [os.path.basename(filename) for filename in filenames]
+            if len(set(basenames)) < len(basenames):
+                with self.lock:
+                    secho('Warning: files with the same name in input {} of node {} overwrite each other'.format(
+                        input_name,
+                        name,
+                    ), fg='yellow')
+        return self.build_executor(node, inputs, parameters)
+
+    def run_node(self, name, executor):
+        with self.lock:
+            echo('{} Starting node {} (step "{}")'.format(
+                style(executor.execution_id, bold=True),
+                style(name, bold=True),
+                executor.step.name,
+            ))
+        try:
+            ret = executor.execute(verbose=False, save_logs=self.save_logs, tee_output=False)
+        except Exception as exc:
+            ret = None
+            with self.lock:
+                secho('{} Failed to run: {}'.format(executor.execution_id, exc), fg='red')
+        with self.lock:
+            secho('{} Node {} finished with code {}'.format(
+                style(executor.execution_id, bold=True),
+                name,
+                ret,
+            ), fg=('green' if ret == 0 else 'red'))
+        return ret
+
+    def set_result(self, name, ret):
+        self.results[name] = ret
+        self.finished.add(name)
+        if ret == 0:
+            return
+        on_error = self.nodes[name].node.on_error
+        if on_error == ErrorAction.STOP_NEXT:
+            self.pending -= get_descendants(self.dependencies, name)
+        elif on_error != ErrorAction.CONTINUE:
+            self.stopped = True
+
+    def print_summary(self):
+        secho('=== Pipeline {} finished: {} of {} nodes succeeded ==='.format(
+            self.pipeline.name,
+            sum(1 for ret in self.results.values() if ret == 0),
+            len(self.order),
+        ), bold=True)
+        for name in self.order:
+            ret = self.results.get(name)
+            secho('{code:>4}  {name}  {output_dir}'.format(
+                code=('-' if ret is None else ret),
+                name=name,
+                output_dir=(self.executors[name].output_dir if name in self.executors else '(not run)'),
+            ), fg=('green' if ret == 0 else 'red'))
+
+
+def run_pipeline(pipeline, nodes, build_executor, jobs, save_logs=True):
+    """
+    Run the nodes of a pipeline; see `PipelineRunner`.
+
+    :return: Dict of node name -> exit code (None for nodes that were not run or failed to start)
+    """
+    return PipelineRunner(pipeline, nodes, build_executor, jobs=jobs, save_logs=save_logs).run()
@@ -0,0 +1,295 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import subprocess
+import tempfile
+import time
+
+from click import echo, secho, style
+
+from .checkout import is_process_alive
+from .consts import DEFAULT_POOL_IDLE_TIMEOUT, POOL_DIR_ENV
+from .utils import ensure_makedirs, get_random_string
+
+POOL_LABEL = 'valohai-local-run.pool'
+POOL_MOUNT_ROOT = '/valohai-pool'
+POOL_SLOTS_DIR_NAME = '.valohai-pool'  # Directory of the containers' output slots in the output root
+
+# PID 1 of pooled containers; `wait` also reaps the processes orphaned by executions.
+KEEPALIVE_SCRIPT = 'trap "exit 0" TERM INT; while :; do sleep 1 & wait; done'
+
+# Run before every execution: kill anything left behind by the previous one (`kill -1` spares PID 1
+# and the shell itself) and clear out its files.
+RESET_SCRIPT = 'kill -9 -1 2>/dev/null; rm -rf /valohai /tmp/* /tmp/.[!.]* 2>/dev/null; mkdir -p /valohai'
+
+
+class PooledContainer:
+    def __init__(self, name, roots, slot=None):
+        self.name = name
+        self.slot = slot  # Directory of this container only, for the output directory of the current execution
+        self.roots = roots  # List of (host path, readonly) pairs, mounted in this order under `POOL_MOUNT_ROOT`
+        if slot:
+            self.roots = roots + [(slot, False)]
+
+    def get_container_path(self, path):
+        for i, (root, readonly) in enumerate(self.roots):
+            if path == root or path.startswith(root.rstrip('/') + '/'):
+                relative_path = os.path.relpath(path, root)
+                return posixpath.join(POOL_MOUNT_ROOT, str(i), ('' if relative_path == '.' else relative_path))
+        raise ValueError('{} is not within the roots mounted in {}'.format(path, self.name))
+
+
+class ContainerPool:
+    """
+    A pool of long-lived containers that executions are dispatched into with `docker exec`,
+    instead of starting a new container for each execution.
+
+    A container's mounts can't be changed once it has started, so each container mounts a set of read-only
+    *roots* (e.g. the checkout cache) under `/valohai-pool/`, and `/valohai/*` is set up as symlinks into them
+    at the start of each execution.  The output root is not mounted; instead, each container gets a *slot*
+    directory of its own in it, and the output directory of the execution it runs is moved into the slot
+    for the duration of the execution (see `lend_output_dir()`), so executions can't touch each other's
+    outputs.  Containers are only shared between executions with the same image, roots, output root and
+    resource settings.
+
+    Each container runs one execution at a time.  The state of the pool (which containers exist,
+    which execution is using them and when they were last used) is kept in `pool.json` in the pool
+    directory, guarded by an advisory lock; containers idle for longer than `idle_timeout` seconds
+    are removed.
+    """
+
+    def __init__(self, root=None, docker_command='docker', idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.root = (
+            root or
+            os.environ.get(POOL_DIR_ENV) or
+            os.path.join(tempfile.gettempdir(), 'valohai-local-run-pool')
+        )
+        self.docker_command = docker_command
+        self.idle_timeout = idle_timeout
+        ensure_makedirs(self.root, 0o770)
+
+    def get_key(self, image, roots, run_args, output_root=None):
+        blob = json.dumps([image, roots, run_args] + ([output_root] if output_root else []), sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def acquire(self, image, roots, run_args=(), lease_id=None, output_root=None):
+        """
+        Get an idle container for `image` with the given roots mounted, starting one if necessary.
+
+        :param roots: List of (host path, readonly) pairs
+        :param run_args: Additional arguments for `docker run` (e.g. resource limits)
+        :param output_root: Output root to give the container a slot in (see `lend_output_dir()`)
+        :return: `PooledContainer`, to be given back with `release()`
+        """
+        roots = [(os.path.realpath(path), bool(readonly)) for (path, readonly) in roots]
+        run_args = list(run_args)
+        if output_root:
+            output_root = os.path.realpath(output_root)
+        key = self.get_key(image, roots, run_args, output_root)
+
+        def get_slot(name):
+            return (os.path.join(output_root, POOL_SLOTS_DIR_NAME, name) if output_root else None)
+
+        self.gc()
+        while True:
+            with self.locked_state() as state:
+                idle_names = [
+                    name for (name, entry) in sorted(state.items())
+                    if entry['key'] == key and not self._is_busy(entry)
+                ]
+                name = (idle_names[0] if idle_names else None)
+                if name:
+                    state[name].update(pid=os.getpid(), lease=lease_id)
+            if not name:
+                break
+            if self._is_running(name):
+                container = PooledContainer(name, roots, slot=get_slot(name))
+                self._return_leftovers(container)
+                return container
+            self._remove(name)  # Unhealthy; try the next one
+
+        name = 'valohai-pool-{}'.format(get_random_string(10).lower())
+        container = PooledContainer(name, roots, slot=get_slot(name))
+        if container.slot:
+            ensure_makedirs(container.slot, 0o700)
+        self._docker([
+            'run',
+            '--detach',
+            '--entrypoint=',
+            '--name', name,
+            '--label', '{}={}'.format(POOL_LABEL, key),
+        ] + run_args + [
+            arg
+            for (i, (path, readonly)) in enumerate(container.roots)
+            for arg in ('-v', '{}:{}/{}{}'.format(path, POOL_MOUNT_ROOT, i, (':ro' if readonly else '')))
+        ] + [image, '/bin/sh', '-c', KEEPALIVE_SCRIPT])
+        with self.locked_state() as state:
+            state[name] = {
+                'key': key,
+                'image': image,
+                'created': time.time(),
+                'last_used': time.time(),
+                'runs': 0,
+                'pid': os.getpid(),
+                'lease': lease_id,
+                'slot': container.slot,
+            }
+        return container
+
+    def release(self, container):
+        with self.locked_state() as state:
+            entry = state.get(container.name)
+            if entry:
+                entry.update(pid=None, lease=None, last_used=time.time(), runs=(entry['runs'] + 1))
+
+    def lend_output_dir(self, container, output_dir):
+        """
+        Move an output directory into the slot of `container` for the duration of an execution, leaving
+        a symlink in its place; the directory is moved back by `return_output_dir()`.
+        """
+        slot_path = os.path.join(container.slot, os.path.basename(output_dir))
+        os.rename(output_dir, slot_path)
+        os.symlink(slot_path, output_dir)
+
+    def return_output_dir(self, container, output_dir):
+        if not os.path.islink(output_dir):
+            return
+        slot_path = os.readlink(output_dir)
+        os.unlink(output_dir)
+        os.rename(slot_path, output_dir)
+
+    def build_exec_command(self, container, volumes, env_vars, command, workdir):
+        """
+        Build the `docker exec` command line to run `command` in `container`.
+
+        :param volumes: Volumes (as for `docker run`) whose sources are within the container's roots
+        """
+        setup = [RESET_SCRIPT]
+        for volume in volumes:
+            setup.append('ln -s {} {}'.format(
+                shlex.quote(container.get_container_path(os.path.realpath(volume['source']))),
+                shlex.quote(volume['destination']),
+            ))
+        setup.append('cd {}'.format(shlex.quote(workdir)))
+        docker_command = ['/usr/bin/env', self.docker_command, 'exec', '-i']
+        for key, value in sorted(env_vars.items()):
+            docker_command.extend(['-e', '%s=%s' % (key, value)])
+        docker_command.extend([container.name, '/bin/sh', '-c', ' && '.join(setup + [command])])
+        return docker_command
+
+    def gc(self, idle_timeout=None, remove_all=False):
+        """
+        Remove containers that have been idle for longer than `idle_timeout` seconds
+        (or all idle containers, with `remove_all`).
+
+        :return: List of names of the removed containers.
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        with self.locked_state() as state:
+            names = [
+                name for (name, entry) in state.items()
+                if not self._is_busy(entry) and (remove_all or time.time() - entry['last_used'] > idle_timeout)
+            ]
+        for name in names:
+            self._remove(name)
+        return names
+
+    def entries(self):
+        with self.locked_state() as state:
+            return [(name, dict(entry, busy=self._is_busy(entry))) for (name, entry) in sorted(state.items())]
+
+    @contextlib.contextmanager
+    def locked_state(self):
+        with open(os.path.join(self.root, 'pool.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._read_state()
+                yield state
+                self._write_state(state)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_state(self):
+        try:
+            with open(os.path.join(self.root, 'pool.json'), 'r') as infp:
+                return json.load(infp)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_state(self, state):
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.pool-')
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(state, outf, sort_keys=True)
+        os.rename(temp_path, os.path.join(self.root, 'pool.json'))
+
+    def _is_busy(self, entry):
+        return bool(entry.get('pid') and is_process_alive(entry['pid']))
+
+    def _is_running(self, name):
+        try:
+            output = self._docker(['inspect', '--format', '{{.State.Running}}', name], stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return False
+        return output.strip() == 'true'
+
+    def _remove(self, name):
+        with self.locked_state() as state:
+            entry = state.pop(name, None)
+        with contextlib.suppress(subprocess.CalledProcessError):
+            self._docker(['rm', '--force', name], stderr=subprocess.DEVNULL)
+        if entry and entry.get('slot'):
+            container = PooledContainer(name, [], slot=entry['slot'])
+            self._return_leftovers(container)
+            with contextlib.suppress(OSError):
+                os.rmdir(container.slot)
+
+    def _return_leftovers(self, container):
+        """
+        Move back output directories left in the slot of `container` by executions that were interrupted.
+        """
+        if not (container.slot and os.path.isdir(container.slot)):
+            return
+        output_root = os.path.dirname(os.path.dirname(container.slot))
+        for name in os.listdir(container.slot):
+            output_dir = os.path.join(output_root, name)
+            if os.path.islink(output_dir):
+                self.return_output_dir(container, output_dir)
+            elif not os.path.lexists(output_dir):
+                os.rename(os.path.join(container.slot, name), output_dir)
+
+    def _docker(self, args, **kwargs):
+        return subprocess.check_output(['/usr/bin/env', self.docker_command] + args, **kwargs).decode()
+
+
+def pool_cli(argv):
+    ap = argparse.ArgumentParser(prog='valohai-local-run pool', description='Manage the warm container pool.')
+    ap.add_argument('--docker-command', default='docker', help='Docker executable')
+    subparsers = ap.add_subparsers(dest='action', metavar='action')
+    subparsers.add_parser('list', help='List pooled containers')
+    stop_ap = subparsers.add_parser('stop', help='Remove idle pooled containers')
+    stop_ap.add_argument('--idle-timeout', type=float, default=None, metavar='SECONDS',
+        help='Only remove containers idle for longer than this (default: remove all idle containers)')
+    args = ap.parse_args(argv)
+    pool = ContainerPool(docker_command=args.docker_command)
+
+    if args.action == 'stop':
+        removed = pool.gc(idle_timeout=args.idle_timeout, remove_all=(args.idle_timeout is None))
+        for name in removed:
+            echo('Removed {}'.format(style(name, bold=True)))
+        secho('{} containers removed.'.format(len(removed)), bold=True)
+    else:
+        for name, entry in pool.entries():
+            echo('{name}  {state:<5}  {runs:>5} runs  idle {idle:>6.0f}s  {image}'.format(
+                name=style(name, bold=True),
+                state=('busy' if entry['busy'] else 'idle'),
+                runs=entry['runs'],
+                idle=(0 if entry['busy'] else time.time() - entry['last_used']),
+                image=entry['image'],
+            ))
+    return 0
@@ -0,0 +1,202 @@
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event
+
+from click import echo, secho, style
+from valohai_yaml.utils import listify
+
+from .checkout import CheckoutCache
+from .consts import DEFAULT_DOWNLOAD_CONCURRENCY
+from .dockerapi import PullCancelled, get_docker_client
+from .download import download_urls
+from .excs import BadUsage
+from .inputs import expand_input_specs, extract_archive_inputs, is_url
+from .profiling import Profiler
+from .utils import get_random_string, match_step
+
+
+def run_concurrently(tasks, cancel, profiler=None):
+    """
+    Run functions in threads of their own, each as a phase of the profile.
+
+    Once one of them fails, `cancel` is set so the others can stop early (those that can't are waited for),
+    and the first error is raised.
+
+    :param tasks: Dict of phase name -> function
+    :param cancel: `threading.Event` the functions should watch
+    :return: Dict of phase name -> return value
+    """
+    profiler = (profiler or Profiler())
+
+    def run(name, function):
+        with profiler.phase(name):
+            return function()
+
+    results = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as pool:
+        futures = {pool.submit(profiler.wrap(run), name, function): name for (name, function) in tasks.items()}
+        try:
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    results[futures[future]] = future.result()
+                elif error is None:  # Errors after the first are most likely due to the cancellation
+                    error = future.exception()
+                    cancel.set()
+        except BaseException:  # e.g. KeyboardInterrupt
+            cancel.set()
+            raise
+    if error is not None:
+        raise error
+    return results
+
+
+def ensure_image(image, docker_command='docker', docker_client=None, cancel=None):
+    """
+    Pull `image` unless it's available already.
+
+    :param docker_client: `DockerClient` to use instead of the `docker` command
+    :param cancel: `threading.Event` to stop pulling at, raising `PullCancelled`
+    :return: Whether the image was pulled
+    """
+    if docker_client:
+        if docker_client.has_image(image):
+            return False
+        docker_client.pull_image(image, cancel=cancel)
+        return True
+    docker = ['/usr/bin/env', docker_command]
+    if not subprocess.call(docker + ['image', 'inspect', image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL):
+        return False
+    if cancel is not None and cancel.is_set():
+        raise PullCancelled(image)
+    proc = subprocess.Popen(docker + ['pull', '--quiet', image], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    while True:
+        try:
+            stdout, stderr = proc.communicate(timeout=0.1)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.is_set():
+                proc.terminate()
+                proc.communicate()
+                raise PullCancelled(image)
+    if proc.returncode:
+        raise RuntimeError('{} pull failed (exit code {}): {}'.format(
+            docker_command,
+            proc.returncode,
+            stderr.decode('utf-8', 'replace').strip(),
+        ))
+    return True
+
+
+def get_default_inputs(step):
+    """
+    :return: List of the default input files and URLs of a step
+    """
+    return [filename for input in step.inputs.values() for filename in listify(input.default or ())]
+
+
+def prefetch_inputs(filenames, download_concurrency, revalidate, extract_archives, profiler=None, cancel=None):
+    """
+    Download (and optionally extract) the URLs among the given inputs into the cache.
+
+    :return: Number of URLs cached
+    """
+    urls = [filename for filename in expand_input_specs(filenames) if is_url(filename)]
+    extracted = {}
+    if extract_archives:
+        extracted = extract_archive_inputs(
+            urls,
+            verbose=True,
+            download_concurrency=download_concurrency,
+            revalidate=revalidate,
+            profiler=profiler,
+            cancel=cancel,
+        )
+    download_urls(
+        [url for url in urls if url not in extracted],
+        concurrency=download_concurrency,
+        revalidate=revalidate,
+        profiler=profiler,
+        cancel=cancel,
+    )
+    return len(urls)
+
+
+def prefetch_checkout(directory, commit):
+    checkout_cache = CheckoutCache()
+    lease_id = 'prefetch-{}'.format(get_random_string(8))
+    checkout_cache.acquire(directory, commit, lease_id=lease_id)
+    checkout_cache.release(commit, lease_id=lease_id)  # It's kept around until it's been unused for a while
+
+
+def prefetch_cli(argv):
+    from .cli import resolve_config
+
+    ap = argparse.ArgumentParser(
+        prog='valohai-local-run prefetch',
+        description='Get ready to run steps: pull their images, download their default inputs and check out '
+                    'the commit, all at once.',
+    )
+    ap.add_argument('steps', nargs='*', metavar='step', help='Steps to prefetch for (default: all of them)')
+    ap.add_argument('--commit', '-c', default=None, metavar='SHA',
+        help='The commit to use. Defaults to the current HEAD.')
+    ap.add_argument('--directory', '-d', help='Project directory (defaults to current working directory)')
+    ap.add_argument('--no-git', action='store_false', default=True, dest='use_git', help='Use Git?')
+    ap.add_argument('--input', '-i', action='append', default=[], metavar='URL',
+        help='Also download this input (repeatable)')
+    ap.add_argument('--no-images', action='store_false', default=True, dest='images', help='Skip pulling images')
+    ap.add_argument('--docker-command', default='docker', help='Docker executable')
+    ap.add_argument('--docker-backend', choices=('auto', 'api', 'cli'), default='auto',
+        help='Pull images with the Docker Engine API or with the docker command')
+    ap.add_argument('--download-concurrency', type=int, default=DEFAULT_DOWNLOAD_CONCURRENCY, metavar='N',
+        help='Number of inputs to download simultaneously')
+    ap.add_argument('--revalidate-inputs', action='store_true', default=False,
+        help='Check cached input downloads for changes with a conditional request')
+    ap.add_argument('--extract-inputs', action='store_true', default=False,
+        help='Also extract tar and zip archive inputs into the cache, for `--extract-inputs` runs')
+    ap.add_argument('--profile', action='store_true', default=False,
+        help='Print how long each phase took')
+    ap.set_defaults(adhoc=False)
+    args = ap.parse_args(argv)
+    profiler = Profiler()
+    directory, has_git, step_table = resolve_config(ap, args, profiler=profiler)
+    try:
+        steps = [step_table.get_step(match_step(step_table, name)) for name in (args.steps or sorted(step_table.steps))]
+        docker_client = (get_docker_client(args.docker_backend, args.docker_command) if args.images else None)
+    except BadUsage as be:
+        ap.error(be)
+
+    cancel = Event()
+    images = (sorted({step.image for step in steps if step.image}) if args.images else [])
+    tasks = {
+        'pull_image {}'.format(image): (
+            lambda image=image: ensure_image(image, args.docker_command, docker_client=docker_client, cancel=cancel)
+        )
+        for image in images
+    }
+    tasks['prefetch_inputs'] = lambda: prefetch_inputs(
+        [filename for step in steps for filename in get_default_inputs(step)] + args.input,
+        download_concurrency=args.download_concurrency,
+        revalidate=args.revalidate_inputs,
+        extract_archives=args.extract_inputs,
+        profiler=profiler,
+        cancel=cancel,
+    )
+    if has_git:
+        tasks['checkout'] = lambda: prefetch_checkout(directory, args.commit)
+    results = run_concurrently(tasks, cancel, profiler=profiler)
+
+    for image in images:
+        pulled = results['pull_image {}'.format(image)]
+        echo('Image {}: {}'.format(style(image, bold=True), ('pulled' if pulled else 'available')))
+    if has_git:
+        echo('Checked out {}'.format(style(args.commit, bold=True)))
+    secho('{} images and {} inputs ready for {} steps.'.format(
+        len(images),
+        results['prefetch_inputs'],
+        len(steps),
+    ), bold=True)
+    if args.profile:
+        profiler.print_summary()
+    return 0
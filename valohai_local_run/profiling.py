@@ -0,0 +1,126 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from .utils import format_size
+
+
+class Profiler:
+    """
+    Records how long the phases of a run take, and counters (e.g. bytes downloaded) along the way.
+
+    Phases may be nested, and may be recorded (and counters updated) from multiple threads.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.phases = []
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.local.depth = depth
+            with self.lock:
+                self.phases.append({
+                    'name': name,
+                    'start': start - self.start,
+                    'duration': end - start,
+                    'depth': depth,
+                    'thread': threading.get_ident(),
+                })
+
+    def wrap(self, function):
+        """
+        Wrap a function to be called in another thread, so the phases it records nest under the current one.
+        """
+        depth = getattr(self.local, 'depth', 0)
+
+        def wrapper(*args, **kwargs):
+            self.local.depth = depth
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def get_phases(self):
+        with self.lock:
+            # Parents are recorded after their children; list them in the order they started
+            return sorted(self.phases, key=lambda phase: (phase['start'], phase['depth']))
+
+    def as_dict(self):
+        return {
+            'start_time': self.start_time,
+            'total': time.perf_counter() - self.start,
+            'phases': [
+                {key: phase[key] for key in ('name', 'start', 'duration', 'depth')}
+                for phase in self.get_phases()
+            ],
+            'counters': dict(self.counters),
+        }
+
+    def print_summary(self):
+        from click import echo, style
+        total = time.perf_counter() - self.start
+        phases = self.get_phases()
+        width = max([len('phase')] + [len(phase['name']) + 2 * phase['depth'] for phase in phases])
+        echo(style('{name:<{width}}  {duration:>10}  {percentage:>6}'.format(
+            name='phase', width=width, duration='seconds', percentage='%',
+        ), bold=True), err=True)
+        for phase in phases:
+            echo('{name:<{width}}  {duration:>10.3f}  {percentage:>6.1f}'.format(
+                name=('  ' * phase['depth'] + phase['name']),
+                width=width,
+                duration=phase['duration'],
+                percentage=(100.0 * phase['duration'] / total if total else 0),
+            ), err=True)
+        echo(style('{name:<{width}}  {duration:>10.3f}'.format(name='total', width=width, duration=total), bold=True),
+            err=True)
+        for name, value in sorted(self.counters.items()):
+            echo('{name}: {value}'.format(
+                name=name,
+                value=(format_size(value) if name.endswith('_bytes') else value),
+            ), err=True)
+
+    def write_chrome_trace(self, path):
+        """
+        Write the phases as a trace file for the Chrome trace viewer (chrome://tracing) or Perfetto.
+        """
+        pid = os.getpid()
+        events = [
+            {
+                'name': phase['name'],
+                'cat': 'valohai-local-run',
+                'ph': 'X',
+                'ts': phase['start'] * 1e6,
+                'dur': phase['duration'] * 1e6,
+                'pid': pid,
+                'tid': phase['thread'],
+            }
+            for phase in self.get_phases()
+        ]
+        if self.counters:
+            events.append({
+                'name': 'counters',
+                'ph': 'C',
+                'ts': (time.perf_counter() - self.start) * 1e6,
+                'pid': pid,
+                'args': dict(self.counters),
+            })
+        with open(path, 'w') as outf:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, outf)
@@ -0,0 +1,455 @@
+"""
+Running executions on a remote Docker host over SSH.
+
+The repository and the inputs are synced into a content-addressed store on the remote host
+(`objects/<xx>/<sha256>` in the remote root), so only files the host hasn't seen before are transferred;
+each execution gets a tree of hardlinks to the store, and objects no tree links to are garbage collected
+once they've been unused for a day.  The output streams come back over SSH (and through
+the usual logs and metrics), and output files are pulled back while the execution runs, transferring
+only the files that have changed since the last pull.
+
+Only `sh`, `tar`, `find`, `stat`, `touch` and `xargs` are needed on the remote host, besides Docker.
+"""
+import os
+import posixpath
+import shlex
+import subprocess
+import tarfile
+import threading
+import time
+from shlex import quote
+
+from .archives import extract_tar
+from .cache import DownloadCache
+from .consts import (
+    DEFAULT_INPUT_STORE_MAX_AGE,
+    DEFAULT_OUTPUT_SYNC_INTERVAL,
+    DEFAULT_REMOTE_ROOT,
+    RESERVED_OUTPUT_NAMES,
+    volume_mount_targets,
+)
+from .executor import LocalExecutor
+from .inputs import InputStore
+from .utils import warn
+
+# Reads object keys from stdin, and prints the ones not in the store (in the working directory);
+# the ones that are get touched, so they're not garbage collected before they've been linked to
+FIND_MISSING_SCRIPT = (
+    '{ while IFS= read -r key; do p="${key%"${key#??}"}/$key"; '
+    'if [ -f "$p" ]; then echo "$p" >&3; else echo "$key"; fi; '
+    'done 3>&1 >&4 | xargs -r touch -c; } 4>&1'
+)
+
+
+class RemoteHost:
+    """
+    A host to run commands on over SSH.
+
+    :param ssh_command: Command to run SSH with, e.g. `ssh -p 2222 -o ControlMaster=auto`
+    :param root: Directory to keep files in on the remote host; relative to the home directory unless absolute
+    :param max_age: Seconds after which objects in the remote store that no execution uses are removed
+    """
+
+    def __init__(self, host, ssh_command='ssh', root=DEFAULT_REMOTE_ROOT, max_age=DEFAULT_INPUT_STORE_MAX_AGE):
+        self.host = host
+        self.ssh_command = shlex.split(ssh_command)
+        self.root_arg = root
+        self.max_age = max_age
+        self._root = None
+
+    def get_command(self, script):
+        return self.ssh_command + [self.host, script]
+
+    def wrap_command(self, command):
+        """
+        :return: Command running `command` (a list of arguments) on the remote host
+        """
+        return self.get_command('exec ' + ' '.join(quote(arg) for arg in command))
+
+    def run(self, script, input=b''):
+        """
+        Run a shell script on the remote host.
+
+        :return: Standard output of the script
+        :raises RuntimeError: if the script fails
+        """
+        proc = subprocess.run(self.get_command(script), input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode:
+            raise RuntimeError('Command failed on {} (exit code {}): {}'.format(
+                self.host,
+                proc.returncode,
+                proc.stderr.decode('utf-8', 'replace').strip(),
+            ))
+        return proc.stdout
+
+    @property
+    def root(self):
+        """
+        Absolute path of the remote root directory (created if need be).
+        """
+        if not self._root:
+            self._root = self.run('mkdir -p {0} && cd {0} && pwd'.format(quote(self.root_arg))).decode().strip()
+        return self._root
+
+    def find_missing_objects(self, keys):
+        """
+        :return: Set of the keys of the objects missing from the store
+        """
+        if not keys:
+            return set()
+        objects_dir = posixpath.join(self.root, 'objects')
+        output = self.run(
+            'mkdir -p {0} && cd {0} && {1}'.format(quote(objects_dir), FIND_MISSING_SCRIPT),
+            input=''.join('{}\n'.format(key) for key in sorted(keys)).encode(),
+        )
+        return set(output.decode().split())
+
+    def send(self, members):
+        """
+        Send files into the remote root as a tar stream.
+
+        :param members: Iterable of (`TarInfo`, local path or None) tuples
+        :return: Number of bytes of file data sent
+        """
+        proc = subprocess.Popen(
+            self.get_command('tar -x -f - -C {}'.format(quote(self.root))),
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        n_bytes = 0
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for info, path in members:
+                    if path:
+                        with open(path, 'rb') as infp:
+                            tar.addfile(info, infp)
+                        n_bytes += info.size
+                    else:
+                        tar.addfile(info)
+        finally:
+            proc.stdin.close()
+            stderr = proc.stderr.read()
+            proc.wait()
+        if proc.returncode:
+            raise RuntimeError('Sending files to {} failed: {}'.format(self.host, stderr.decode('utf-8', 'replace')))
+        return n_bytes
+
+    def list_files(self, directory):
+        """
+        :return: Dict of path relative to `directory` -> (size, modification time in whole seconds)
+        """
+        output = self.run("cd {} 2>/dev/null || exit 0; find . -type f -exec stat -c '%s %Y %n' {{}} +".format(
+            quote(directory),
+        ))
+        files = {}
+        for line in output.decode('utf-8', 'surrogateescape').splitlines():
+            size, mtime, name = line.split(' ', 2)
+            files[posixpath.normpath(name)] = (int(size), int(mtime))
+        return files
+
+    def fetch_files(self, directory, names, dest):
+        """
+        Fetch files from a directory on the remote host into the local directory `dest`.
+        """
+        proc = subprocess.Popen(
+            self.get_command('cd {} && tar -c -f - -T -'.format(quote(directory))),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+        def write_names():  # On a thread of its own, since tar may start writing before it has read all the names
+            try:
+                proc.stdin.write(''.join('{}\n'.format(name) for name in names).encode('utf-8', 'surrogateescape'))
+            finally:
+                proc.stdin.close()
+
+        writer = threading.Thread(target=write_names, daemon=True)
+        writer.start()
+        try:
+            extract_tar(proc.stdout, dest)
+        finally:
+            writer.join()
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode:
+            raise RuntimeError('Fetching files from {} failed (exit code {})'.format(self.host, proc.returncode))
+
+    def remove(self, path):
+        self.run('rm -rf {}'.format(quote(path)))
+
+    def remove_container(self, name, docker_command='docker'):
+        self.run('{} rm --force {} >/dev/null 2>&1; true'.format(quote(docker_command), quote(name)))
+
+    def gc_objects(self, max_age=None):
+        """
+        Remove the objects in the store that no execution directory links to, and that have not been used
+        in `max_age` seconds.
+        """
+        max_age = (self.max_age if max_age is None else max_age)
+        self.run('cd {} 2>/dev/null || exit 0; find . -type f -links 1 -mmin +{:d} -exec rm -f {{}} +'.format(
+            quote(posixpath.join(self.root, 'objects')),
+            int(max_age // 60),
+        ))
+
+
+def make_tarinfo(name, type=tarfile.REGTYPE, mode=0o644, size=0, linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.size = size
+    info.linkname = linkname
+    info.mtime = time.time()  # Objects are garbage collected by age
+    return info
+
+
+def walk_files(source, prefix, exclude=()):
+    """
+    Walk a local file or directory to be recreated at `prefix` on the remote host.
+
+    :param exclude: Paths of files and directories within `source` to leave out
+    :return: Tuple of lists of directories, symlinks (as (path, target) tuples) and files
+             (as (path, local path) tuples)
+    """
+    if not os.path.isdir(source):
+        return ([], [], [(prefix, source)])
+    source = os.path.realpath(source)
+    exclude = {os.path.realpath(path) for path in exclude}
+    dirs, symlinks, files = [prefix], [], []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = [name for name in dirnames if os.path.join(dirpath, name) not in exclude]
+        filenames = [name for name in filenames if os.path.join(dirpath, name) not in exclude]
+        relative_dir = os.path.relpath(dirpath, source).replace(os.sep, '/')
+        remote_dir = posixpath.normpath(posixpath.join(prefix, relative_dir))
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            remote_path = posixpath.join(remote_dir, name)
+            if os.path.islink(path):
+                symlinks.append((remote_path, os.readlink(path)))
+            elif os.path.isdir(path):
+                dirs.append(remote_path)
+            elif os.path.isfile(path):
+                files.append((remote_path, path))
+    return (dirs, symlinks, files)
+
+
+def build_members(prefix, dirs, symlinks, files, keys, missing):
+    """
+    Build the tar stream sending the missing objects, and laying out the execution directory `prefix`.
+
+    :param keys: Dict of local path -> object key
+    :param missing: Set of the keys of the objects missing from the remote store
+    :return: Iterable of (`TarInfo`, local path or None) tuples for `RemoteHost.send()`
+    """
+    sent = set()
+    for path, key in sorted(keys.items()):
+        if key in missing and key not in sent:
+            sent.add(key)
+            info = make_tarinfo(
+                posixpath.join('objects', key[:2], key),
+                mode=(0o755 if key.endswith('.x') else 0o644),
+                size=os.stat(path).st_size,
+            )
+            yield (info, path)
+    for remote_path in dirs:
+        yield (make_tarinfo(remote_path, type=tarfile.DIRTYPE, mode=0o755), None)
+    # The container may not run as the user we're connecting as
+    yield (make_tarinfo(posixpath.join(prefix, 'outputs'), type=tarfile.DIRTYPE, mode=0o777), None)
+    for remote_path, target in symlinks:
+        yield (make_tarinfo(remote_path, type=tarfile.SYMTYPE, mode=0o777, linkname=target), None)
+    for remote_path, path in files:
+        key = keys[path]
+        yield (make_tarinfo(remote_path, type=tarfile.LNKTYPE, linkname=posixpath.join('objects', key[:2], key)), None)
+
+
+class OutputPuller:
+    """
+    Calls `pull()` every `interval` seconds on a background thread, until stopped.
+    """
+
+    def __init__(self, pull, interval):
+        self.pull = pull
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='output-puller', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.pull()
+            except (RuntimeError, OSError, tarfile.TarError):  # Retried next time around, and once the execution ends
+                pass
+
+
+class RemoteExecutor(LocalExecutor):
+    """
+    An executor running the container on a remote host over SSH, with the `docker` command there.
+
+    The repository and the inputs are mounted read-only, as they're hardlinks into the remote store.
+    Warm container pools, the Docker Engine API and telemetry are not available remotely.
+    """
+
+    def __init__(self, remote_host, output_sync_interval=DEFAULT_OUTPUT_SYNC_INTERVAL, **kwargs):
+        kwargs.update(container_pool=None, docker_client=None, telemetry_interval=None, lazy_inputs=False)
+        super().__init__(**kwargs)
+        self.remote_host = remote_host
+        self.output_sync_interval = output_sync_interval
+        self.input_mounts = []  # Recorded by `stage_inputs()`, to be synced in `sync_files()`
+        self.remote_dir = None  # Set once files have been synced to the remote host
+        self.output_puller = None
+
+    def get_remote_path(self, name):
+        return posixpath.join(self.remote_host.root, 'executions', self.execution_id, name)
+
+    def prepare(self, verbose):
+        command = super().prepare(verbose)
+        if command is None:  # Memoized
+            return None
+        with self.profiler.phase('sync_files'):
+            self.sync_files()
+        self.prepared_command = self.remote_host.wrap_command(command)
+        if self.output_sync_interval:
+            self.output_puller = OutputPuller(self.pull_outputs, self.output_sync_interval)
+            self.output_puller.start()
+        return self.prepared_command
+
+    def execute(self, verbose=False, save_logs=True, tee_output=True, output_files=None):
+        try:
+            return super().execute(verbose=verbose, save_logs=save_logs, tee_output=tee_output,
+                output_files=output_files)
+        finally:
+            self.stop_output_puller()
+            if self.remote_dir:
+                self.clean_up_remote(verbose)
+
+    def clean_up_remote(self, verbose):
+        try:
+            # The container keeps running if only the SSH connection was cut, e.g. by an interrupt
+            self.remote_host.remove_container(self.get_container_name(), docker_command=self.docker_command)
+            self.remote_host.remove(self.remote_dir)
+            self.remote_host.gc_objects()
+        except RuntimeError as exc:
+            warn('Could not clean up {}: {}'.format(self.remote_dir, exc), verbose=verbose)
+        self.remote_dir = None
+
+    def ensure_image(self, cancel=None):
+        # The image is needed on the remote host
+        output = self.remote_host.run(
+            '{0} image inspect {1} >/dev/null 2>&1 || {{ {0} pull --quiet {1} >/dev/null && echo pulled; }}'.format(
+                quote(self.docker_command),
+                quote(self.image),
+            ),
+        )
+        return bool(output.strip())
+
+    def stage_inputs(self, input_mounts):
+        # The inputs are laid out into a tree on the remote host instead; see `sync_files()`
+        self.input_mounts = list(input_mounts)
+        if not self.input_mounts:
+            return []
+        return [{
+            'source': self.get_remote_path('inputs'),
+            'destination': volume_mount_targets['inputs'],
+            'readonly': True,
+        }]
+
+    def get_volumes(self, input_volumes):
+        return [
+            {
+                'source': self.get_remote_path('repository'),
+                'destination': volume_mount_targets['repository'],
+                'readonly': True,
+            },
+            {'source': self.get_remote_path('outputs'), 'destination': volume_mount_targets['outputs']},
+        ] + list(input_volumes)
+
+    def build_volume_params(self, input_volumes):
+        volume_params = []
+        for volume in self.get_volumes(input_volumes):  # Remote paths; not to be resolved locally
+            volume_params.extend(['-v', '{}:{}{}'.format(
+                volume['source'],
+                volume['destination'],
+                (':ro' if volume.get('readonly') else ''),
+            )])
+        return volume_params
+
+    def sync_files(self):
+        """
+        Send the files of the repository and the inputs missing from the remote store, and lay them out
+        into the directory of the execution on the remote host as hardlinks to the store.
+        """
+        prefix = posixpath.join('executions', self.execution_id)
+        if not self.input_store:
+            self.input_store = InputStore()
+        dirs, symlinks, files = self.collect_files(prefix)
+        digests = self.input_store.get_digests(path for (remote_path, path) in files)
+        keys = {}  # Local path -> object key; executable files are stored separately, as links share their mode
+        for remote_path, path in files:
+            keys[path] = digests[path] + ('.x' if os.stat(path).st_mode & 0o111 else '')
+        missing = self.remote_host.find_missing_objects(set(keys.values()))
+        self.remote_dir = posixpath.join(self.remote_host.root, prefix)
+        n_bytes = self.remote_host.send(build_members(prefix, dirs, symlinks, files, keys, missing))
+        self.profiler.count('remote_upload_bytes', n_bytes)
+        self.profiler.count('remote_objects_sent', len(missing))
+        self.profiler.count('remote_objects_reused', len(set(keys.values()) - missing))
+
+    def collect_files(self, prefix):
+        """
+        :return: Tuple of directories, symlinks and files to create in the execution directory (see `walk_files()`)
+        """
+        exclude = []
+        if self.gitless:  # The working directory may hold more than the code; leave out Git, outputs and caches
+            exclude = [
+                os.path.join(self.repository_dir, '.git'),
+                self.output_root,
+                self.input_store.root,
+                DownloadCache().root,
+            ]
+        dirs, symlinks, files = walk_files(self.repository_dir, posixpath.join(prefix, 'repository'), exclude=exclude)
+        dirs.append(posixpath.join(prefix, 'inputs'))
+        for mount in self.input_mounts:
+            relative_path = posixpath.relpath(mount['destination'], volume_mount_targets['inputs'])
+            mount_prefix = posixpath.normpath(posixpath.join(prefix, 'inputs', relative_path))
+            for items, mount_items in zip((dirs, symlinks, files), walk_files(mount['source'], mount_prefix)):
+                items.extend(mount_items)
+        return (dirs, symlinks, files)
+
+    def pull_outputs(self):
+        """
+        Fetch the output files that are new or have changed since they were last fetched.
+        """
+        remote_files = self.remote_host.list_files(self.get_remote_path('outputs'))
+        changed = []
+        for name, (size, mtime) in sorted(remote_files.items()):
+            if name in RESERVED_OUTPUT_NAMES:  # Don't let the execution overwrite our logs and metadata
+                continue
+            try:
+                stat = os.stat(os.path.join(self.output_dir, name))
+                if stat.st_size == size and int(stat.st_mtime) == mtime:
+                    continue
+            except OSError:
+                pass
+            changed.append(name)
+        if changed:
+            self.remote_host.fetch_files(self.get_remote_path('outputs'), changed, self.output_dir)
+            self.profiler.count('remote_files_pulled', len(changed))
+
+    def stop_output_puller(self):
+        if self.output_puller:
+            self.output_puller.stop()
+            self.output_puller = None
+
+    def process_outputs(self):
+        if self.remote_dir:
+            self.stop_output_puller()
+            with self.profiler.phase('pull_outputs'):
+                self.pull_outputs()
+        super().process_outputs()
@@ -0,0 +1,266 @@
+"""
+A minimal client for S3 and S3-compatible object stores (e.g. MinIO), for fetching inputs.
+
+Requests are signed with AWS Signature Version 4, using the credentials from the standard
+environment variables (`AWS_ACCESS_KEY_ID`, `AWS_SECRET_ACCESS_KEY` and `AWS_SESSION_TOKEN`), or
+sent unsigned without them.  The endpoint is `AWS_ENDPOINT_URL` (or `AWS_ENDPOINT_URL_S3`), or AWS
+in `AWS_REGION` (or `AWS_DEFAULT_REGION`); buckets are addressed by path.
+"""
+import datetime
+import fnmatch
+import hashlib
+import hmac
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote, urlsplit
+
+from .excs import BadUsage
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+DEFAULT_REGION = 'us-east-1'
+PART_SIZE = 8 * 1048576  # Objects larger than this are downloaded in parts, with parallel ranged GETs
+PART_CONCURRENCY = 8
+GLOB_CHARS = re.compile(r'[*?[]')
+
+
+def is_s3_url(url):
+    return url.startswith('s3://')
+
+
+def parse_s3_url(url):
+    """
+    Split an `s3://bucket/key` URL into bucket and key.
+    """
+    parts = urlsplit(url)
+    if parts.scheme != 's3' or not parts.netloc:
+        raise BadUsage('Invalid S3 URL: {}'.format(url))
+    return (parts.netloc, parts.path.lstrip('/'))
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_request(method, url, headers, access_key, secret_key, region, now, payload_hash=UNSIGNED_PAYLOAD):
+    """
+    Sign a request with AWS Signature Version 4, adding the `Authorization`, `x-amz-date` and
+    `x-amz-content-sha256` headers to `headers` (in place).
+
+    The `host` header, `x-amz-*` headers and the `range` header are signed.
+
+    :param now: Time of the request, as an UTC `datetime`
+    """
+    parts = urlsplit(url)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+    signed = {'host': parts.netloc}
+    for name, value in headers.items():
+        if name.lower().startswith('x-amz-') or name.lower() == 'range':
+            signed[name.lower()] = ' '.join(str(value).split())
+    signed_names = ';'.join(sorted(signed))
+    query = sorted(
+        (quote(unquote(name), safe='-_.~'), quote(unquote(value), safe='-_.~'))
+        for (name, _, value) in (pair.partition('=') for pair in parts.query.split('&') if pair)
+    )
+    canonical_request = '\n'.join([
+        method,
+        quote(parts.path or '/', safe='/-_.~%'),
+        '&'.join('{}={}'.format(name, value) for (name, value) in query),
+        ''.join('{}:{}\n'.format(name, signed[name]) for name in sorted(signed)),
+        signed_names,
+        payload_hash,
+    ])
+    scope = '{}/{}/s3/aws4_request'.format(amz_date[:8], region)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac_sha256(key, part)
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+        access_key, scope, signed_names, signature,
+    )
+    return headers
+
+
+class S3Object:
+    def __init__(self, bucket, key, size, etag=None):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+
+    @property
+    def url(self):
+        return 's3://{}/{}'.format(self.bucket, self.key)
+
+
+class S3Client:
+    """
+    A client for fetching objects from S3; may be used from multiple threads.
+    """
+
+    def __init__(self, endpoint_url=None, region=None, access_key=None, secret_key=None, session_token=None):
+        self.region = (region or DEFAULT_REGION)
+        self.endpoint_url = (endpoint_url or 'https://s3.{}.amazonaws.com'.format(self.region)).rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.local = threading.local()
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = (os.environ if environ is None else environ)
+        return cls(
+            endpoint_url=(environ.get('AWS_ENDPOINT_URL_S3') or environ.get('AWS_ENDPOINT_URL')),
+            region=(environ.get('AWS_REGION') or environ.get('AWS_DEFAULT_REGION')),
+            access_key=environ.get('AWS_ACCESS_KEY_ID'),
+            secret_key=environ.get('AWS_SECRET_ACCESS_KEY'),
+            session_token=environ.get('AWS_SESSION_TOKEN'),
+        )
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            import requests
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def get_url(self, bucket, key='', query=''):
+        url = '{}/{}/{}'.format(self.endpoint_url, quote(bucket, safe=''), quote(key, safe='/-_.~'))
+        return (url + '?' + query if query else url)
+
+    def request(self, method, bucket, key='', query='', headers=None, stream=False):
+        url = self.get_url(bucket, key, query)
+        headers = dict(headers or {})
+        if self.access_key and self.secret_key:
+            if self.session_token:
+                headers['x-amz-security-token'] = self.session_token
+            sign_request(
+                method, url, headers,
+                access_key=self.access_key,
+                secret_key=self.secret_key,
+                region=self.region,
+                now=datetime.datetime.now(datetime.timezone.utc),
+            )
+        return self.session.request(method, url, headers=headers, stream=stream)
+
+    def head_object(self, bucket, key):
+        r = self.request('HEAD', bucket, key)
+        r.raise_for_status()
+        return S3Object(bucket, key, size=int(r.headers['content-length']), etag=r.headers.get('etag'))
+
+    def list_objects(self, bucket, prefix=''):
+        """
+        List the objects in a bucket whose key starts with `prefix` (with ListObjectsV2).
+
+        :return: List of `S3Object`s
+        """
+        objects = []
+        token = None
+        while True:
+            query = 'list-type=2&prefix={}'.format(quote(prefix, safe=''))
+            if token:
+                query += '&continuation-token={}'.format(quote(token, safe=''))
+            r = self.request('GET', bucket, query=query)
+            r.raise_for_status()
+            root = ET.fromstring(r.content)
+            namespace = (root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else '')
+            for contents in root.iter(namespace + 'Contents'):
+                objects.append(S3Object(
+                    bucket,
+                    key=contents.findtext(namespace + 'Key'),
+                    size=int(contents.findtext(namespace + 'Size') or 0),
+                    etag=contents.findtext(namespace + 'ETag'),
+                ))
+            token = root.findtext(namespace + 'NextContinuationToken')
+            if root.findtext(namespace + 'IsTruncated') != 'true' or not token:
+                return objects
+
+    def expand_url(self, url):
+        """
+        Expand an `s3://` URL with a prefix (ending with a slash) or glob pattern (e.g. `s3://bucket/data/*.csv`)
+        into the URLs of the matching objects.  Other URLs are returned as is.
+
+        :return: List of URLs
+        """
+        bucket, key = parse_s3_url(url)
+        glob_match = GLOB_CHARS.search(key)
+        if not glob_match and not key.endswith('/') and key:
+            return [url]
+        prefix = (key[:glob_match.start()] if glob_match else key)
+        urls = [
+            obj.url for obj in self.list_objects(bucket, prefix)
+            if not obj.key.endswith('/') and (not glob_match or fnmatch.fnmatchcase(obj.key, key))
+        ]
+        if not urls:
+            raise BadUsage('No objects match {}'.format(url))
+        return sorted(urls)
+
+    def download(self, url, path, on_data=None, cancel=None):
+        """
+        Download an object into a file.
+
+        :return: `S3Object` of the object downloaded
+        """
+        obj = self.head_object(*parse_s3_url(url))
+        self.download_object(obj, path, on_data=on_data, cancel=cancel)
+        return obj
+
+    def download_object(self, obj, path, on_data=None, cancel=None):
+        """
+        Download an object (as returned by `head_object()`) into a file.  Large objects are downloaded in parts
+        with parallel ranged GETs; each GET is conditional on the ETag, so an object being replaced during the
+        download is not mixed up.
+
+        :param on_data: Callable to call with the number of bytes received, for progress
+        :param cancel: `threading.Event` to cancel the download with
+        """
+        ranges = [(start, min(start + PART_SIZE, obj.size) - 1) for start in range(0, obj.size, PART_SIZE)]
+        with open(path, 'wb') as outf:
+            outf.truncate(obj.size)
+
+        failed = threading.Event()  # Stops the other parts once one of them fails
+
+        def get_range(byte_range):
+            try:
+                self._download_range(obj, path, byte_range, on_data=on_data, cancel_events=(failed, cancel))
+            except:  # noqa
+                failed.set()
+                raise
+
+        if len(ranges) > 1:
+            with ThreadPoolExecutor(max_workers=min(PART_CONCURRENCY, len(ranges))) as pool:
+                list(pool.map(get_range, ranges))  # Raises the first error, if any
+        elif ranges:
+            get_range(ranges[0])
+
+    def _download_range(self, obj, path, byte_range, on_data, cancel_events):
+        headers = {'Range': 'bytes={}-{}'.format(*byte_range)}
+        if obj.etag:
+            headers['If-Match'] = obj.etag
+        offset = byte_range[0]
+        r = self.request('GET', obj.bucket, obj.key, headers=headers, stream=True)
+        with r, open(path, 'r+b') as outf:
+            r.raise_for_status()
+            if r.status_code != 206 and byte_range != (0, obj.size - 1):
+                raise IOError('{} does not support ranged GETs'.format(self.endpoint_url))
+            outf.seek(offset)
+            for chunk in r.iter_content(chunk_size=1048576):
+                if any(event and event.is_set() for event in cancel_events):
+                    raise IOError('Download of {} cancelled'.format(obj.url))
+                outf.write(chunk)
+                offset += len(chunk)
+                if on_data:
+                    on_data(len(chunk))
+        if offset != byte_range[1] + 1:
+            raise IOError('Download of {} was truncated'.format(obj.url))
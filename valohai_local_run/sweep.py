@@ -0,0 +1,127 @@
+import itertools
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from click import echo, secho, style
+
+from .excs import BadUsage
+
+
+def parse_parameter_values(values, value_type=None):
+    """
+    Parse sweep values for a parameter.
+
+    Each value is either a literal or, for numeric parameters, an inclusive range `start:stop:step`
+    (e.g. `1:10:3` expands to 1, 4, 7, 10 and `0.1:0.3:0.1` to 0.1, 0.2, 0.3).
+
+    :param values: List of strings (or a single default value)
+    :param value_type: Type callable for the parameter (e.g. `int`), if any
+    :return: List of values
+    """
+    if not isinstance(values, (list, tuple)):
+        return [values]
+    parsed = []
+    for value in values:
+        if value_type and isinstance(value, str) and value.count(':') == 2:
+            parsed.extend(expand_range(value, value_type))
+        elif value_type:
+            try:
+                parsed.append(value_type(value))
+            except ValueError:
+                raise BadUsage('Invalid value {!r}'.format(value))
+        else:
+            parsed.append(value)
+    return parsed
+
+
+def expand_range(value, value_type):
+    try:
+        start, stop, step = (value_type(part) for part in value.split(':'))
+    except ValueError:
+        raise BadUsage('Invalid range {!r}'.format(value))
+    if not step or (stop - start) / step < 0:
+        raise BadUsage('Range {!r} is empty or infinite'.format(value))
+    n_steps = int((stop - start) / step + 1e-9)
+    # Round away float representation noise (0.30000000000000004 and friends)
+    return [value_type(round(start + i * step, 12)) for i in range(n_steps + 1)]
+
+
+def expand_parameter_sets(parameter_values, random_count=None, seed=None):
+    """
+    Expand a dict of parameter name -> list of values into a list of parameter dicts.
+
+    :param random_count: If set, pick this many distinct combinations at random instead of the full grid
+    :param seed: Random seed, for reproducible random sweeps
+    """
+    if random_count is not None and random_count < 1:
+        raise BadUsage('The number of random combinations must be positive')
+    names = sorted(parameter_values)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(parameter_values[name] for name in names))]
+    if not grid:
+        raise BadUsage('There are no parameter combinations to run')
+    if random_count is not None and random_count < len(grid):
+        grid = random.Random(seed).sample(grid, random_count)
+    return grid
+
+
+def format_parameters(parameters, varying=None):
+    return ' '.join(
+        '{}={}'.format(name, value)
+        for (name, value) in sorted(parameters.items())
+        if varying is None or name in varying
+    )
+
+
+def run_executions(executors, jobs, save_logs=True):
+    """
+    Run the given executors, at most `jobs` at a time.
+
+    Output of the executions is not passed through; it is saved in each execution's output directory.
+
+    :return: List of exit codes (None for executions that failed to start), in the order of `executors`
+    """
+    if not executors:
+        return []
+    varying = {
+        name for name in executors[0].parameters
+        if len({repr(executor.parameters.get(name)) for executor in executors}) > 1
+    }
+    lock = threading.Lock()
+    n_total = len(executors)
+    n_done = [0]
+
+    def run(executor):
+        description = format_parameters(executor.parameters, varying)
+        with lock:
+            echo('{} Starting {}'.format(style(executor.execution_id, bold=True), description))
+        try:
+            ret = executor.execute(verbose=False, save_logs=save_logs, tee_output=False)
+        except Exception as exc:
+            ret = None
+            with lock:
+                secho('{} Failed to run: {}'.format(executor.execution_id, exc), fg='red')
+        with lock:
+            n_done[0] += 1
+            secho('{} Finished with code {} ({}/{} done)'.format(
+                style(executor.execution_id, bold=True),
+                ret,
+                n_done[0],
+                n_total,
+            ), fg=('green' if ret == 0 else 'red'))
+        return ret
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(run, executors))
+
+    secho('=== Sweep finished: {} of {} executions succeeded ==='.format(
+        sum(1 for ret in results if ret == 0),
+        n_total,
+    ), bold=True)
+    for executor, ret in zip(executors, results):
+        secho('{code:>4}  {output_dir}  {parameters}'.format(
+            code=('-' if ret is None else ret),
+            output_dir=executor.output_dir,
+            parameters=format_parameters(executor.parameters, varying),
+        ), fg=('green' if ret == 0 else 'red'))
+    return results
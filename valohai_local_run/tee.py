@@ -1,5 +1,16 @@
+import io
+import os
+import selectors
 import subprocess
-from select import select
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+READ_SIZE = 1048576
+PIPE_SIZE = 1048576
+F_SETPIPE_SZ = 1031  # Linux-specific; not exposed by the `fcntl` module before Python 3.10
 
 
 def tee_spawn(command, stdout_files, stderr_files):
@@ -7,6 +18,13 @@ def tee_spawn(command, stdout_files, stderr_files):
     Spawn `command` as a subprocess and tee its stdout and/or stderr
     to the given files.
 
+    The streams are read until EOF, so no output is lost even if the process
+    exits while its output is still buffered in the pipes.
+
+    A file that fails to accept data is not written to again; the exceptions
+    raised are available as `(file, exception)` pairs in `proc.tee_errors`.
+    The number of bytes read from each stream is available in `proc.tee_bytes`.
+
     :param command: Command to spawn (see `subprocess.Popen`)
     :param stdout_files: Iterable of writable files for stdout
     :param stderr_files: Iterable of writable files for stderr
@@ -18,26 +36,100 @@ def tee_spawn(command, stdout_files, stderr_files):
         stdout=(subprocess.PIPE if stdout_files else None),
         stderr=(subprocess.PIPE if stderr_files else None),
     )
-    fd_map = {}
+    tees = {}
     if stdout_files:
-        fd_map[proc.stdout] = list(stdout_files)
+        tees[proc.stdout] = Tee(stdout_files)
     if stderr_files:
-        fd_map[proc.stderr] = list(stderr_files)
+        tees[proc.stderr] = Tee(stderr_files)
 
-    while proc.poll() is None:
-        try:
-            r_fds, w_fds, x_fds = select(fd_map.keys(), [], [], 0.1)
-            for from_fd in r_fds:
-                data = from_fd.read(10240)
-                if not data:  # EOF? Weird!
-                    continue
-                for to_file in fd_map.get(from_fd, ()):
-                    try:
-                        to_file.write(data)
-                    except:  # pragma: no cover
-                        pass
-        except:
-            proc.kill()
-            proc.wait(timeout=10)
-            raise
+    try:
+        pump(tees)
+        proc.wait()
+    except:  # noqa
+        proc.kill()
+        proc.wait(timeout=10)
+        raise
+    finally:
+        for stream in tees:
+            stream.close()
+    proc.tee_errors = [error for tee in tees.values() for error in tee.errors]
+    proc.tee_bytes = {
+        name: tees[stream].n_bytes
+        for (name, stream) in (('stdout', proc.stdout), ('stderr', proc.stderr))
+        if stream in tees
+    }
     return proc
+
+
+def pump(tees):
+    """
+    Copy data from readable pipes to `Tee`s until all of the pipes reach EOF.
+
+    Writes are blocking, so a slow writer stalls reading, which in turn makes
+    the writing process block on its full pipe instead of us buffering without bound.
+
+    :param tees: Dict of readable file -> `Tee`
+    """
+    selector = selectors.DefaultSelector()
+    for stream, tee in tees.items():
+        grow_pipe(stream)
+        selector.register(stream, selectors.EVENT_READ, tee)
+    try:
+        while selector.get_map():
+            for key, events in selector.select():
+                data = os.read(key.fd, READ_SIZE)
+                if not data:  # EOF
+                    selector.unregister(key.fileobj)
+                    continue
+                key.data.write(data)
+    finally:
+        selector.close()
+
+
+def grow_pipe(stream):
+    # Fewer, larger reads are considerably cheaper for chatty processes
+    if fcntl:
+        try:
+            fcntl.fcntl(stream.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+        except (OSError, ValueError):  # pragma: no cover
+            pass
+
+
+def write_fully(file, data):
+    """
+    Write all of `data` into `file`, even if it is a raw or non-blocking file that accepts partial writes.
+    """
+    while data:
+        try:
+            n_written = file.write(data)
+        except BlockingIOError as bie:
+            n_written = bie.characters_written
+        if n_written is None and not isinstance(file, io.RawIOBase):
+            return  # Not all file-like objects report the number of bytes written
+        n_written = (n_written or 0)
+        if n_written >= len(data):
+            return
+        with selectors.DefaultSelector() as selector:  # Wait until the file can take more data
+            selector.register(file, selectors.EVENT_WRITE)
+            selector.select()
+        data = memoryview(data)[n_written:]
+
+
+class Tee:
+    """
+    Writes data into a number of files, dropping the files that fail.
+    """
+
+    def __init__(self, files):
+        self.files = list(files)
+        self.errors = []
+        self.n_bytes = 0
+
+    def write(self, data):
+        self.n_bytes += len(data)
+        for file in list(self.files):
+            try:
+                write_fully(file, data)
+            except Exception as exc:
+                self.files.remove(file)
+                self.errors.append((file, exc))
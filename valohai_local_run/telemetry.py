@@ -0,0 +1,348 @@
+import csv
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from urllib.parse import quote
+
+from .consts import TELEMETRY_CSV_NAME
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MAX_OVERHEAD = 0.02  # Fraction of wall time the sampler may spend sampling (in CPU time); samples are spaced out
+FIELDS = ('cpu', 'memory', 'io_read', 'io_write', 'net_rx', 'net_tx')
+PEAK_FIELDS = ('cpu', 'memory')  # Instantaneous values; the others are cumulative byte counts
+
+
+docker_size_units = {
+    'b': 1,
+    'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'tb': 1000 ** 4,
+    'kib': 1 << 10, 'mib': 1 << 20, 'gib': 1 << 30, 'tib': 1 << 40,
+}
+
+
+def parse_docker_size(value):
+    """
+    Parse a size as formatted by `docker stats`, e.g. `1.5MiB` (binary) or `3.2kB` (decimal).
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*$', value, re.I)
+    if not match or match.group(2).lower() not in docker_size_units:
+        raise ValueError('Invalid size: {}'.format(value))
+    return int(round(float(match.group(1)) * docker_size_units[match.group(2).lower()]))
+
+
+class CgroupSource:
+    """
+    Reads the usage of a container from its cgroup (v2) directly.
+
+    Sampled values are cumulative, except for `memory`; CPU usage is given as `cpu_time` in seconds.
+    """
+    name = 'cgroup'
+
+    def __init__(self, path, proc_root='/proc'):
+        self.path = path
+        self.proc_root = proc_root
+
+    @classmethod
+    def find(cls, container_id, root=CGROUP_ROOT):
+        """
+        Find the cgroup of a container, with either the systemd or the cgroupfs cgroup driver.
+
+        :return: `CgroupSource`, or None if the host doesn't use cgroup v2 or the cgroup isn't found
+        """
+        if not os.path.isfile(os.path.join(root, 'cgroup.controllers')):
+            return None
+        for path in (
+            os.path.join(root, 'system.slice', 'docker-{}.scope'.format(container_id)),
+            os.path.join(root, 'docker', container_id),
+        ):
+            if os.path.isfile(os.path.join(path, 'cpu.stat')):
+                return cls(path)
+        return None
+
+    def read(self):
+        sample = {
+            'cpu_time': self._read_keyed('cpu.stat').get('usage_usec', 0) / 1e6,
+            'memory': int(self._read('memory.current') or 0),
+            'io_read': 0,
+            'io_write': 0,
+        }
+        for line in self._read('io.stat').splitlines():  # e.g. `8:0 rbytes=1024 wbytes=0 rios=1 ...`
+            values = dict(field.split('=', 1) for field in line.split()[1:] if '=' in field)
+            sample['io_read'] += int(values.get('rbytes', 0))
+            sample['io_write'] += int(values.get('wbytes', 0))
+        sample.update(self._read_network())
+        return sample
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name), 'r') as infp:
+                return infp.read()
+        except OSError:  # e.g. the controller isn't enabled, or the container is gone
+            return ''
+
+    def _read_keyed(self, name):
+        return {
+            key: int(value)
+            for (key, value) in (line.split() for line in self._read(name).splitlines() if line.strip())
+        }
+
+    def _read_network(self):
+        # Network usage isn't accounted in cgroups, but per network namespace; any process of the container will do
+        pids = self._read('cgroup.procs').split()
+        if not pids:
+            return {}
+        rx = tx = 0
+        try:
+            with open(os.path.join(self.proc_root, pids[0], 'net', 'dev'), 'r') as infp:
+                for line in infp.readlines()[2:]:  # Skip the headers
+                    interface, _, values = line.partition(':')
+                    if interface.strip() == 'lo':
+                        continue
+                    values = values.split()
+                    rx += int(values[0])
+                    tx += int(values[8])
+        except OSError:
+            return {}
+        return {'net_rx': rx, 'net_tx': tx}
+
+
+class StreamingSource:
+    """
+    Keeps the latest of the samples streamed by the Docker daemon (about once a second), reading them
+    on a thread of its own, so that sampling doesn't wait for the daemon.
+    """
+    name = 'docker stats'
+
+    def __init__(self, samples, close):
+        """
+        :param samples: Iterable of samples
+        :param close: Callable that stops the stream
+        """
+        self.latest = None
+        self.close = close
+        self.thread = threading.Thread(target=self._consume, args=(samples,), name='telemetry-stream', daemon=True)
+        self.thread.start()
+
+    def _consume(self, samples):
+        try:
+            for sample in samples:
+                self.latest = sample
+        except (OSError, ValueError):  # e.g. the stream was closed
+            pass
+
+    def read(self):
+        return self.latest
+
+
+def stream_docker_stats(container, docker_command='docker'):
+    """
+    Stream the usage of a container with `docker stats`, for hosts without cgroup v2 (or access to it).
+    """
+    proc = subprocess.Popen(
+        [docker_command, 'stats', '--format', '{{json .}}', container],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+
+    def read_samples():
+        for line in proc.stdout:
+            start = line.find(b'{')  # Each update begins with terminal control codes to clear the screen
+            if start != -1:
+                yield parse_docker_stats(json.loads(line[start:].decode('utf-8')))
+
+    def close():
+        proc.terminate()
+        proc.wait()
+        proc.stdout.close()
+
+    return StreamingSource(read_samples(), close=close)
+
+
+def parse_docker_stats(stats):
+    """
+    Parse a line of `docker stats --format '{{json .}}'`.
+    """
+    sample = {}
+    if stats.get('CPUPerc', '--') != '--':
+        sample['cpu'] = float(stats['CPUPerc'].rstrip('%')) / 100
+    for key, fields in (
+        ('MemUsage', ('memory', None)),
+        ('BlockIO', ('io_read', 'io_write')),
+        ('NetIO', ('net_rx', 'net_tx')),
+    ):
+        values = [value.strip() for value in stats.get(key, '').split('/')]
+        for field, value in zip(fields, values):
+            if field and value and value != '--':
+                sample[field] = parse_docker_size(value)
+    return sample
+
+
+def parse_api_stats(stats):
+    """
+    Parse the statistics of a container from the Docker Engine API (`/containers/<id>/stats`).
+    """
+    sample = {
+        'cpu_time': stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0) / 1e9,
+        'memory': stats.get('memory_stats', {}).get('usage', 0),
+        'io_read': 0,
+        'io_write': 0,
+        'net_rx': 0,
+        'net_tx': 0,
+    }
+    for entry in (stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or ()):
+        field = {'read': 'io_read', 'write': 'io_write'}.get(entry.get('op', '').lower())
+        if field:
+            sample[field] += entry.get('value', 0)
+    for network in (stats.get('networks') or {}).values():
+        sample['net_rx'] += network.get('rx_bytes', 0)
+        sample['net_tx'] += network.get('tx_bytes', 0)
+    return sample
+
+
+def find_container_id(container, docker_command='docker', docker_client=None):
+    """
+    :return: Full ID of the container, or None if it doesn't exist (yet)
+    """
+    if docker_client:
+        from .dockerapi import DockerAPIError
+        try:
+            return docker_client.request('GET', '/containers/{}/json'.format(quote(container)))['Id']
+        except DockerAPIError:
+            return None
+    try:
+        output = subprocess.check_output(
+            [docker_command, 'inspect', '--format', '{{.Id}}', container],
+            stderr=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return (output.decode('utf-8').strip() or None)
+
+
+def get_source(container, docker_command='docker', docker_client=None):
+    """
+    Get a source of samples for a running container: its cgroup, or the statistics streamed by the
+    Docker daemon if the cgroup can't be read.
+
+    :return: Source, or None if the container isn't running (yet)
+    """
+    container_id = find_container_id(container, docker_command=docker_command, docker_client=docker_client)
+    if not container_id:
+        return None
+    source = CgroupSource.find(container_id)
+    if source:
+        return source
+    if docker_client:
+        response = docker_client.stream('GET', '/containers/{}/stats'.format(quote(container_id)))
+        return StreamingSource((parse_api_stats(json.loads(line.decode('utf-8'))) for line in response),
+            close=response.close)
+    return stream_docker_stats(container_id, docker_command=docker_command)
+
+
+class TelemetrySampler:
+    """
+    Samples the resource usage of a container on a background thread, while the container is running.
+
+    Samples are written into `valohai-telemetry.csv` in the output directory, with the columns `time`
+    (seconds since sampling started), `cpu` (CPU cores in use), `memory` (bytes), and cumulative byte counts
+    `io_read`, `io_write`, `net_rx` and `net_tx`.  Peaks, means and totals are available from `summary()`,
+    along with the CPU time spent sampling, which is kept under 2% of the (wall) time by spacing out samples
+    if need be.
+    """
+
+    def __init__(self, output_dir, get_source, interval=1.0):
+        """
+        :param get_source: Callable returning a source of samples (with a `read()` method returning a dict),
+                           or None if the container isn't running yet
+        """
+        self.path = os.path.join(output_dir, TELEMETRY_CSV_NAME)
+        self.get_source = get_source
+        self.interval = interval
+        self.source = None
+        self.samples = []
+        self.previous_cpu_time = None  # (time, cumulative CPU time) of the previous sample
+        self.overhead = 0.0
+        self.start_time = None
+        self.end_time = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.end_time = time.monotonic()
+        if self.source and hasattr(self.source, 'close'):
+            self.source.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def run(self):
+        with open(self.path, 'w', newline='') as outf:
+            writer = csv.writer(outf)
+            writer.writerow(('time',) + FIELDS)
+            while not self.stop_event.is_set():
+                sample_start = time.monotonic()
+                # CPU time of this thread, which (unlike wall time) doesn't include waiting for the scheduler or the GIL
+                cpu_start = time.thread_time()
+                sample = self.sample()
+                self.overhead += time.thread_time() - cpu_start
+                if sample:
+                    writer.writerow([sample['time']] + [sample.get(field, '') for field in FIELDS])
+                    outf.flush()
+                    self.samples.append(sample)
+                # Space out the samples if sampling has been slow, to keep its overhead under `MAX_OVERHEAD`
+                next_time = max(sample_start + self.interval, self.start_time + self.overhead / MAX_OVERHEAD)
+                self.stop_event.wait(max(0, next_time - time.monotonic()))
+
+    def sample(self):
+        if not self.source:
+            self.source = self.get_source()
+            if not self.source:
+                return None
+        values = self.source.read()
+        if values is None:
+            return None
+        now = time.monotonic()
+        sample = {'time': round(now - self.start_time, 3)}
+        sample.update(values)
+        cpu_time = sample.pop('cpu_time', None)
+        if cpu_time is not None:  # Derive the CPU cores in use from the cumulative CPU time
+            if self.previous_cpu_time:
+                previous_now, previous_cpu_time = self.previous_cpu_time
+                sample['cpu'] = round((cpu_time - previous_cpu_time) / max(now - previous_now, 1e-6), 3)
+            self.previous_cpu_time = (now, cpu_time)
+        return sample
+
+    def summary(self):
+        elapsed = ((self.end_time or time.monotonic()) - self.start_time) if self.start_time else 0
+        data = {
+            'source': (self.source.name if self.source else None),
+            'samples': len(self.samples),
+            'interval': self.interval,
+            'overhead': {
+                'seconds': round(self.overhead, 6),
+                'fraction': (round(self.overhead / elapsed, 6) if elapsed else 0),
+            },
+        }
+        for field in FIELDS:
+            values = [sample[field] for sample in self.samples if sample.get(field) is not None]
+            if not values:
+                continue
+            if field in PEAK_FIELDS:
+                data[field] = {'peak': max(values), 'mean': sum(values) / len(values)}
+            else:  # Counted since the container started
+                data[field] = {'total': values[-1]}
+        return data
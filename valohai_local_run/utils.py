@@ -1,40 +1,144 @@
+import bisect
+import hashlib
+import logging
 import os
 import random
 import re
 import string
-
-from click import style
+import time
 
 from .compat import text_type
 from .excs import BadUsage
 
+log = logging.getLogger('valohai_local_run')
+
 
 def get_random_string(length=12, keyspace=(string.ascii_letters + string.digits)):
     return ''.join(random.choice(keyspace) for x in range(length))
 
 
-def ensure_makedirs(path, mode=0o744):
-    # http://stackoverflow.com/questions/5231901/permission-problems-when-creating-a-dir-with-os-makedirs-python
-    original_umask = os.umask(0)
+def warn(message, verbose=True, fg='yellow'):
+    """
+    Tell about a problem that doesn't stop the execution: on stderr if `verbose`, otherwise only
+    through the `valohai_local_run` logger, so library use stays quiet unless logging is configured.
+    """
+    if verbose:
+        from click import secho
+        secho(message, fg=fg, err=True)
+    else:
+        log.warning(message)
+
+
+def claim_periodic_run(path, interval):
+    """
+    Tell whether a periodic chore (such as garbage collection) is due, i.e. whether the timestamp file `path`
+    is missing or more than `interval` seconds old.  If it is, the file is touched, so other processes
+    skip the chore until another `interval` has passed.
+    """
     try:
-        # only newly create directories get the defined mode
-        os.makedirs(path, mode=mode, exist_ok=True)
-        # ensure that the last directory has the right mode if it exists
-        os.chmod(path, mode=mode)
-    finally:
-        os.umask(original_umask)
+        if time.time() - os.stat(path).st_mtime < interval:
+            return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+    return True
+
+
+def ensure_makedirs(path, mode=0o744):
+    """
+    Create a directory and its missing parents with the given mode, regardless of the umask,
+    and set the mode of the directory if it exists already.
+
+    The process umask is left alone, so this is safe to use from multiple threads.
+    """
+    missing = []
+    parent = os.path.abspath(path)
+    while not os.path.isdir(parent):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    for directory in reversed(missing):
+        try:
+            os.mkdir(directory, mode)
+        except FileExistsError:  # Created concurrently
+            continue
+        os.chmod(directory, mode)  # The mode given to `mkdir` is masked by the umask
+    os.chmod(path, mode)
+
+
+def hash_file(path, algorithm='sha256', chunk_size=1048576):
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as infp:
+        for chunk in iter(lambda: infp.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+size_suffixes = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """
+    Parse a human-readable size such as `500M` or `20G` (binary units) into bytes.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', text_type(value), re.I)
+    if not match:
+        raise BadUsage('Invalid size: {}'.format(value))
+    return int(float(match.group(1)) * size_suffixes[match.group(2).upper()])
+
+
+def format_size(n):
+    for suffix in ('', 'K', 'M', 'G'):
+        if abs(n) < 1024:
+            break
+        n /= 1024.0
+    else:
+        suffix = 'T'
+    return ('%d B' % n if not suffix else '%.1f %siB' % (n, suffix))
+
+
+def sanitize_name(name):
+    return re.sub(r'[_ ]', '-', name).lower()
+
+
+class PrefixIndex:
+    """
+    Case-insensitive prefix lookups among a set of names, by bisecting a sorted list.
+    """
+
+    def __init__(self, names=(), pairs=None):
+        """
+        :param names: Names to index
+        :param pairs: Alternatively, the `pairs` of a previously built index
+        """
+        if pairs is None:
+            pairs = sorted([text_type(name).lower(), name] for name in names)
+        self.pairs = pairs
+        self.keys = [key for (key, name) in pairs]
+
+    def find(self, prefix):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo=start)
+        return [name for (key, name) in self.pairs[start:end]]
 
 
 def match_prefix(choices, value):
-    value_re = re.compile('^' + re.escape(value), re.I)
-    choices = [choice for choice in choices if value_re.match(text_type(choice))]
-    return choices
+    return PrefixIndex(choices).find(value)
 
 
 def match_step(config, step):
+    """
+    Find the step whose name is or starts with `step`.
+
+    :param config: Object with a `steps` mapping, and optionally a `PrefixIndex` of the steps as `index`
+    """
     if step in config.steps:
         return step
-    step_matches = match_prefix(config.steps, step)
+    from click import style
+    index = (getattr(config, 'index', None) or PrefixIndex(config.steps))
+    step_matches = index.find(step)
     if not step_matches:
         raise BadUsage(
             '"{step}" is not a known step (try one of {steps})'.format(